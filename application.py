@@ -42,7 +42,7 @@ def applySettings(args):
 def run(settings):
   print settings
   if settings["replay"] is not None:
-    replay = pickle.load(open(settings["replay"], 'rb'))
+    replay = domination.core.load_replay(settings["replay"])
     replay.play()
   else:
     try:
@@ -66,7 +66,7 @@ if __name__ == "__main__":
     print " .-------------------------------------------------------------."
     print " | Setting:  | Default:  | Values:                             |"
     print " |-------------------------------------------------------------|"
-    print " | --replay  | None      | Path to pickle file                 |"
+    print " | --replay  | None      | Path to replay file                 |"
     print " | --agent   | default   | {default|sander|frank|daniel|sicco  |"
     print " |                          offence|defence|reactive}          |"
     print " | --mode    | test      | {test|one_on_one|replay}            |"
@@ -4,4 +4,4 @@
 import core
 __version__ = core.__version__
 
-__all__ = ["core","run","renderer","test"]
\ No newline at end of file
+__all__ = ["core","run","corpus","analysis","shared","analytics","renderer","test"]
\ No newline at end of file
@@ -0,0 +1,211 @@
+""" Domination game engine for Reinforcement Learning research.
+
+Contains functions for dividing a field into regions (open areas), that are
+connected by chokepoints (narrow passages), so that agents can reason about a
+small graph of areas instead of about positions.
+
+The regions are found with a watershed on the distance transform: every open
+tile gets its distance to the nearest wall (its clearance), and the tiles are
+flooded from the highest clearance down. Where two floods meet, the tile
+is a chokepoint between them, unless the passage there is almost as wide as
+one of the areas themselves, in which case the two are merged.
+
+"""
+
+### IMPORTS ###
+# Python
+from collections import deque
+
+### CONSTANTS ###
+
+NEIGHBORS_4 = ((1, 0), (-1, 0), (0, 1), (0, -1))
+NEIGHBORS_8 = NEIGHBORS_4 + ((1, 1), (1, -1), (-1, 1), (-1, -1))
+
+### FUNCTIONS ###
+
+def clearance(grid):
+    """ Returns the distance (in tiles, 8-connected) from each tile
+        to the nearest wall, as a list of lists. Walls get 0.
+
+        >>> clearance([[1,1,1,1],[1,0,0,1],[1,1,1,1]])
+        [[0, 0, 0, 0], [0, 1, 1, 0], [0, 0, 0, 0]]
+    """
+    h, w = len(grid), len(grid[0])
+    dist = [[(0 if grid[y][x] else None) for x in xrange(w)] for y in xrange(h)]
+    edge = deque((x, y) for y in xrange(h) for x in xrange(w) if grid[y][x])
+    # Outside the field counts as wall too
+    for y in xrange(h):
+        for x in xrange(w):
+            if (dist[y][x] is None and
+                (x == 0 or y == 0 or x == w - 1 or y == h - 1)):
+                dist[y][x] = 1
+                edge.append((x, y))
+    while edge:
+        x, y = edge.popleft()
+        d = dist[y][x] + 1
+        for dx, dy in NEIGHBORS_8:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < w and 0 <= ny < h and dist[ny][nx] is None:
+                dist[ny][nx] = d
+                edge.append((nx, ny))
+    return dist
+
+def find_regions(grid, merge_ratio=0.75):
+    """ Divides the open tiles of the grid into regions.
+
+        :param grid:        The wall grid, 1 for walls.
+        :param merge_ratio: Two areas are merged if the passage between them
+                            is at least this fraction of the clearance at
+                            the center of the smaller one.
+
+        Returns a dictionary with plain data, that :class:`Regions` is made
+        from:
+
+          labels     - The region of each tile, as a list of lists,
+                       -1 for walls.
+          clearance  - The clearance of each tile, see :func:`clearance`.
+          peaks      - The tile with the largest clearance in each region.
+          chokepoints - A list of (tile, region, region) tuples, for the
+                        tiles where two regions first meet.
+
+        >>> grid = [[1,1,1,1,1,1,1,1,1],
+        ...         [1,0,0,0,1,0,0,0,1],
+        ...         [1,0,0,0,0,0,0,0,1],
+        ...         [1,0,0,0,1,0,0,0,1],
+        ...         [1,1,1,1,1,1,1,1,1]]
+        >>> regions = find_regions(grid)
+        >>> regions['labels'][2]
+        [-1, 0, 0, 0, 0, 1, 1, 1, -1]
+        >>> regions['chokepoints']
+        [((5, 2), 0, 1)]
+    """
+    h, w = len(grid), len(grid[0])
+    dist = clearance(grid)
+    tiles = [(x, y) for y in xrange(h) for x in xrange(w) if not grid[y][x]]
+    # Flood from the highest clearance down
+    tiles.sort(key=lambda (x, y): -dist[y][x])
+    parent = {}   # Union-find over the floods, by their first tile
+    peak = {}     # Clearance at the top of each flood
+    owner = {}
+    chokes = []
+    def find(a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+    for (x, y) in tiles:
+        d = dist[y][x]
+        floods = []
+        for dx, dy in NEIGHBORS_4:
+            n = (x + dx, y + dy)
+            if n in owner:
+                r = find(owner[n])
+                if r not in floods:
+                    floods.append(r)
+        if not floods:
+            parent[(x, y)] = (x, y)
+            peak[(x, y)] = d
+            owner[(x, y)] = (x, y)
+            continue
+        # Join the flood with the highest peak
+        floods.sort(key=lambda r: -peak[r])
+        owner[(x, y)] = floods[0]
+        for r in floods[1:]:
+            a, b = find(floods[0]), find(r)
+            if a == b:
+                continue
+            if d >= merge_ratio * min(peak[a], peak[b]):
+                parent[b] = a
+                peak[a] = max(peak[a], peak[b])
+            else:
+                chokes.append(((x, y), a, b))
+    # Number the regions in order of their peaks
+    roots = sorted(set(find(r) for r in parent), key=lambda (x, y): (-peak[(x, y)], y, x))
+    number = dict((r, i) for (i, r) in enumerate(roots))
+    labels = [[-1] * w for _ in xrange(h)]
+    for (x, y) in tiles:
+        labels[y][x] = number[find(owner[(x, y)])]
+    # Keep the tiles where each pair of regions first met, the widest
+    # part of the border between them.
+    chokepoints, level = [], {}
+    for (tile, a, b) in chokes:
+        a, b = number[find(a)], number[find(b)]
+        if a != b:
+            pair = (min(a, b), max(a, b))
+            d = level.setdefault(pair, dist[tile[1]][tile[0]])
+            if dist[tile[1]][tile[0]] == d:
+                chokepoints.append((tile,) + pair)
+    return {'labels': labels,
+            'clearance': dist,
+            'peaks': roots,
+            'chokepoints': chokepoints}
+
+### CLASSES ###
+
+class Regions(object):
+    """ The regions of a field, and the graph of how they connect.
+        A field's regions are computed the first time they are asked
+        for, and available as :attr:`~domination.core.Field.regions`.
+        Agents get them as their ``field_regions`` argument::
+
+            self.regions = field_regions
+            here = self.regions.region(obs.loc)
+    """
+
+    def __init__(self, data, tilesize=16, markers={}):
+        """ Constructor for Regions class.
+
+            :param data:     The result of :func:`find_regions`.
+            :param tilesize: Size of each tile in game units.
+            :param markers:  A dictionary of lists of tiles, like
+                             ``{'controlpoints': [(x,y), ...]}``, to
+                             find the contents of each region.
+        """
+        ts = tilesize
+        center = lambda (x, y): ((x + 0.5) * ts, (y + 0.5) * ts)
+        self.tilesize  = tilesize
+        self.labels    = data['labels']     #: The region of each tile, -1 for walls
+        self.clearance = data['clearance']  #: Distance from each tile to a wall, in tiles
+        #: The center (the point furthest from walls) of each region
+        self.centers   = [center(p) for p in data['peaks']]
+        #: The tiles of the chokepoints between each pair of regions (a < b)
+        self.chokepoints = {}
+        for (tile, a, b) in data['chokepoints']:
+            self.chokepoints.setdefault((a, b), []).append(center(tile))
+        #: Graph of the regions, graph[a][b] is the distance between their centers
+        self.graph = dict((i, {}) for i in xrange(len(self.centers)))
+        for (a, b) in self.chokepoints:
+            (ax, ay), (bx, by) = self.centers[a], self.centers[b]
+            self.graph[a][b] = self.graph[b][a] = ((ax - bx)**2 + (ay - by)**2)**0.5
+        #: What each region contains, contents[region][name] is a list of tiles
+        self.contents = [dict((name, []) for name in markers) for _ in self.centers]
+        for name, tiles in markers.iteritems():
+            for (x, y) in tiles:
+                if self.labels[y][x] >= 0:
+                    self.contents[self.labels[y][x]][name].append((x, y))
+
+    @classmethod
+    def from_grid(cls, grid, tilesize=16, markers={}, merge_ratio=0.75):
+        """ Finds the regions of the given wall grid. """
+        return cls(find_regions(grid, merge_ratio), tilesize, markers)
+
+    def __len__(self):
+        return len(self.centers)
+
+    def region(self, point):
+        """ Returns the region at the given point (in game units),
+            or -1 if it is inside a wall.
+        """
+        x, y = int(point[0] // self.tilesize), int(point[1] // self.tilesize)
+        if 0 <= y < len(self.labels) and 0 <= x < len(self.labels[0]):
+            return self.labels[y][x]
+        return -1
+
+    def chokepoint(self, a, b):
+        """ Returns the point where two neighboring regions first met
+            during the flood, or None if they are not neighbors.
+        """
+        points = self.chokepoints.get((min(a, b), max(a, b)))
+        if not points:
+            return None
+        return points[0]
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+""" Domination game engine for Reinforcement Learning research.
+
+Contains functions for analysing the replays of many games at once, like
+all the ``_replays.zip`` archives of a tournament. Each replay is played
+again without rendering, in a pool of processes, and the results are
+combined per agent:
+
+  positions   - How often a tank of the agent was on each tile.
+  deaths      - On which tiles its tanks got shot.
+  shots       - From which tiles its tanks fired.
+  cp_share    - The fraction of the time it held the controlpoints.
+  captures    - How often it took a controlpoint.
+
+Heatmaps are dictionaries of {(x, y): count}, in tile coordinates, which
+:func:`heatmap` turns into a grid and :func:`save_pgm` into an image.
+
+Custom metrics can be computed with a mapper and a reducer. The mapper is
+called with the game after every step, and the values it returns are
+combined with the reducer, first within each game and then over all games.
+Both must be module level functions, so that they can be sent to the
+worker processes.
+
+"""
+
+### IMPORTS ###
+# Python
+import os
+import zipfile
+import argparse
+import multiprocessing
+
+# Local
+import core
+from run import markdown_table
+
+### CLASSES ###
+
+class AgentStats(object):
+    """ The combined statistics of one agent, over all its games. """
+    def __init__(self):
+        self.games     = 0
+        self.steps     = 0
+        self.positions = {}  #: Heatmap of where its tanks were
+        self.deaths    = {}  #: Heatmap of where its tanks got shot
+        self.shots     = {}  #: Heatmap of where its tanks fired from
+        self.cp_steps  = 0   #: Steps x controlpoints that it held
+        self.cp_total  = 0   #: Steps x controlpoints in its games
+        self.captures  = 0   #: How many times it took a controlpoint
+        self.size      = (0, 0) #: Size of the largest field, in tiles
+
+    @property
+    def cp_share(self):
+        """ The fraction of the time that it held the controlpoints. """
+        return self.cp_steps / float(self.cp_total) if self.cp_total else 0.0
+
+    @property
+    def hold_time(self):
+        """ The average number of steps it held a controlpoint after
+            taking it.
+        """
+        return self.cp_steps / float(self.captures) if self.captures else 0.0
+
+    def merge(self, other):
+        """ Adds the statistics of other to this one. """
+        self.games += other.games
+        self.steps += other.steps
+        for name in ('positions', 'deaths', 'shots'):
+            mine = getattr(self, name)
+            for tile, count in getattr(other, name).iteritems():
+                mine[tile] = mine.get(tile, 0) + count
+        self.cp_steps += other.cp_steps
+        self.cp_total += other.cp_total
+        self.captures += other.captures
+        self.size = (max(self.size[0], other.size[0]), max(self.size[1], other.size[1]))
+        return self
+
+### FUNCTIONS ###
+
+def find_replays(sources):
+    """ Returns a list of (zipfile, name) tuples for all replays in the
+        given sources, which can be ``_replays.zip`` archives, replay
+        files, or folders that contain either. The zipfile is None for
+        replays that are files of their own.
+    """
+    replays = []
+    for source in sources:
+        if os.path.isdir(source):
+            for folder, _, files in sorted(os.walk(source)):
+                for fn in sorted(files):
+                    replays.extend(find_replays([os.path.join(folder, fn)]))
+        elif source.endswith('.zip'):
+            names = zipfile.ZipFile(source).namelist()
+            replays.extend((source, name) for name in sorted(names) if _is_replay(name))
+        elif _is_replay(source):
+            replays.append((None, source))
+    return replays
+
+def _is_replay(name):
+    return name.endswith('.pickle') or name.endswith('.replay')
+
+def analyze_replay(replay, mapper=None, reducer=None):
+    """ Plays a replay without rendering, and returns a dictionary with
+        the :class:`AgentStats` of both teams, by name, and the reduced
+        value of the mapper (or None).
+    """
+    state = {'value': None, 'first': True}
+    def callback(game):
+        value = mapper(game)
+        if value is not None:
+            state['value'] = value if state['first'] else reducer(state['value'], value)
+            state['first'] = False
+    # The step callback runs before each step, so it sees the game after
+    # the previous one. The last step is handled after the game ends.
+    before = lambda game: callback(game) if game.step > 1 else None
+    game = core.Game(replay=replay, rendered=False, verbose=False, trace=True,
+                     step_callback=None if mapper is None else before)
+    game.run()
+    if mapper is not None:
+        callback(game)
+    trace = game.trace
+    ts = game.field.tilesize
+    n, m, steps = trace.tanks, trace.cps, trace.steps
+    x, y = trace.column('x'), trace.column('y')
+    alive, shots, cps = trace.column('alive'), trace.column('shots'), trace.column('cps')
+    team = trace.column('team')
+    teams = [AgentStats(), AgentStats()]
+    for stats in teams:
+        stats.games, stats.steps = 1, steps
+        stats.size = (game.field.width, game.field.height)
+        stats.cp_total = steps * m
+    half = core.Tank.SIZE / 2.0
+    tile = lambda i: (int((x[i] + half) // ts), int((y[i] + half) // ts))
+    for s in xrange(steps):
+        for k in xrange(n):
+            i = s * n + k
+            stats = teams[team[k]]
+            if alive[i]:
+                t = tile(i)
+                stats.positions[t] = stats.positions.get(t, 0) + 1
+                if shots[i]:
+                    stats.shots[t] = stats.shots.get(t, 0) + 1
+            elif s > 0 and alive[i - n]:
+                # Shot during this step, it was last seen one step earlier
+                t = tile(i - n)
+                stats.deaths[t] = stats.deaths.get(t, 0) + 1
+        for k in xrange(m):
+            owner = cps[s * m + k]
+            if owner < 2:
+                teams[owner].cp_steps += 1
+                if s == 0 or cps[(s - 1) * m + k] != owner:
+                    teams[owner].captures += 1
+    agents = {}
+    for name, stats in ((replay.red_name, teams[0]), (replay.blue_name, teams[1])):
+        agents[name] = agents[name].merge(stats) if name in agents else stats
+    return {'agents': agents, 'value': state['value'], 'first': state['first']}
+
+def _analyze_entry((path, name, mapper, reducer)):
+    """ Analyses one replay, in a worker process. """
+    if path is None:
+        data = open(name, 'rb').read()
+    else:
+        data = zipfile.ZipFile(path).read(name)
+    return analyze_replay(core.load_replay_data(data), mapper, reducer)
+
+def analyze(sources, mapper=None, reducer=None, processes=None):
+    """ Analyses all replays in the given sources (see :func:`find_replays`)
+        in parallel, and returns a dictionary with the number of games,
+        the :class:`AgentStats` of each agent by name, and the reduced
+        value of the mapper over all games. ::
+
+            def shots_fired(game):
+                return sum(1 for tank in game.tanks if tank.shoots)
+
+            result = analyze(['result/'], shots_fired, operator.add)
+            print result['agents'].keys(), result['value']
+
+        :param mapper:    Function called with the game after every step.
+        :param reducer:   Function that combines two values of the mapper.
+        :param processes: The number of processes, defaults to the number of CPUs.
+    """
+    jobs = [(path, name, mapper, reducer) for (path, name) in find_replays(sources)]
+    if processes == 1:
+        pool = None
+        results = map(_analyze_entry, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_analyze_entry, jobs)
+    agents, value, first = {}, None, True
+    for result in results:
+        for name, stats in result['agents'].iteritems():
+            agents[name] = agents[name].merge(stats) if name in agents else stats
+        if not result['first']:
+            value = result['value'] if first else reducer(value, result['value'])
+            first = False
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return {'games': len(jobs), 'agents': agents, 'value': value}
+
+def heatmap(counts, size):
+    """ Turns a heatmap dictionary into a list of lists of the given
+        (width, height).
+
+        >>> heatmap({(0, 0): 3, (2, 1): 1}, (3, 2))
+        [[3, 0, 0], [0, 0, 1]]
+    """
+    w, h = size
+    grid = [[0] * w for _ in xrange(h)]
+    for (x, y), count in counts.iteritems():
+        if 0 <= x < w and 0 <= y < h:
+            grid[y][x] = count
+    return grid
+
+def save_pgm(grid, path, scale=8):
+    """ Writes a grid of counts as a greyscale PGM image, where the
+        highest count is white, with each cell scale pixels wide.
+    """
+    top = max(max(row) for row in grid) or 1
+    rows = []
+    for row in grid:
+        line = ''.join(chr(int(255 * v / float(top))) * scale for v in row)
+        rows.extend([line] * scale)
+    f = open(path, 'wb')
+    f.write('P5 %d %d 255\n' % (len(grid[0]) * scale, len(grid) * scale))
+    f.write(''.join(rows))
+    f.close()
+
+### MAIN ###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Analyse the replays of many games.")
+    parser.add_argument('sources', nargs='+', help="Replay archives, files or folders")
+    parser.add_argument('-j', '--processes', type=int, default=None, help="Number of processes")
+    parser.add_argument('-o', '--output', default=None, help="Folder to write heatmap images to")
+    args = parser.parse_args()
+    result = analyze(args.sources, processes=args.processes)
+    print "Analysed %d games.\n" % result['games']
+    table = []
+    for name, stats in sorted(result['agents'].items()):
+        table.append([name, stats.games, '%.2f' % stats.cp_share, stats.captures,
+                      '%.1f' % stats.hold_time, sum(stats.deaths.values()), sum(stats.shots.values())])
+    print markdown_table(table, header=['Agent', 'Games', 'CP share', 'Captures',
+                                        'Hold time', 'Deaths', 'Shots'])
+    if args.output is not None:
+        if not os.path.exists(args.output):
+            os.makedirs(args.output)
+        for name, stats in result['agents'].iteritems():
+            safe = ''.join(c if c.isalnum() else '_' for c in name)
+            for kind in ('positions', 'deaths', 'shots'):
+                save_pgm(heatmap(getattr(stats, kind), stats.size),
+                         os.path.join(args.output, '%s_%s.pgm' % (safe, kind)))
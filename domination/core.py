@@ -20,16 +20,32 @@ import time
 import datetime
 import itertools
 import copy
+import inspect
+import shutil
+import struct
+import mmap
+import zipfile
+import ast
+from cStringIO import StringIO
+from array import array
 import traceback
 import bisect
 import hashlib
 import logging
+import zlib
 from pprint import pprint
 import cPickle as pickle
 
+# Optional
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Local
 from utilities import *
 from libs import *
+from analysis import Regions, find_regions
 
 # Shortcuts
 sqrt = math.sqrt
@@ -60,6 +76,12 @@ ENDGAME_CRUMBS = 2 #: End game when all crumbs are picked up
 DEFAULT_AGENT_FILE = os.path.join(os.path.dirname(__file__), 'agent.py')
 ILLEGAL_PATH_CHARS = r'[:*?"<>\|\n]+'
 
+REPLAY_MAGIC  = 'DOMRPLY1'
+REPLAY_HEADER = struct.Struct('<8sI')  # Magic, length of the compressed header
+REPLAY_FOOTER = struct.Struct('<QQ8s') # End of the steps, offset of the keyframe index, magic
+KEYFRAMES_MAGIC = 'DOMKEYS1'
+REPLAY_ACTIONS = 'd' # Type of the turns and speeds in binary replays
+
 AGENT_GLOBALS = globals().copy()
 
 ### CLASSES ###
@@ -241,6 +263,9 @@ class Game(object):
     
     SIMULATION_SUBSTEPS = 10
     SIMULATION_MAXITER  = 20
+    #: Recorded games store a snapshot of the game state every this many
+    #: steps, so that replays can :meth:`seek`. None turns them off.
+    KEYFRAME_INTERVAL   = 50
     
     STATE_NEW       = 0
     STATE_READY     = 1
@@ -258,7 +283,11 @@ class Game(object):
                        replay=None,
                        rendered=True, 
                        verbose=True,
-                       step_callback=None):
+                       step_callback=None,
+                       agent_cache=None,
+                       replay_file=None,
+                       trace=False,
+                       seed=None):
         """ Constructor for Game class 
             
             :param red:               Descriptor of the red agent.
@@ -275,10 +304,24 @@ class Game(object):
             :param rendered:          Enable/disable the renderer.
             :param verbose:           Print game log to output.
             :param step_callback:     Function that is called on every step. Useful for debugging.
+            :param agent_cache:       An :class:`~domination.core.AgentCache`, that gives 
+                                        agents a folder for this field as ``cache_dir``.
+            :param replay_file:       A path or open file to stream a binary replay to, 
+                                        see :class:`~domination.core.ReplayWriter`.
+            :param trace:             Keep a :class:`~domination.core.StateTrace` of 
+                                        the game, as ``game.trace``.
+            :param seed:              Seed for the random numbers of the game itself
+                                        (like respawn positions), defaults to ``RANDOMSEED``.
+                                        It is stored in the replay.
         """
         self.record = record
         self.verbose = verbose
         self.step_callback = step_callback
+        self.agent_cache = agent_cache
+        self.replay_file = replay_file
+        self.replay_writer = None
+        self.trace = trace
+        self.seed = RANDOMSEED if seed is None else seed
         
         # Public properties
         self.log    = GameLog(self.verbose) #: The game log as an instance of class:`~domination.core.GameLog`
@@ -303,6 +346,7 @@ class Game(object):
                 print >> sys.stderr, ("WARNING: Replay is for version %s, you have %s."%(replay.version, __version__))
             self.settings = replay.settings
             self.field = replay.field
+            self.seed = getattr(replay, 'seed', RANDOMSEED)
             self.red.setname(replay.red_name)
             self.blue.setname(replay.blue_name)
 
@@ -332,7 +376,12 @@ class Game(object):
         print "Playing `%s` vs. `%s`"%(self.red.fullname(), self.blue.fullname())
         
         self.random = random.Random()
-        self.random.seed(RANDOMSEED)
+        self.random.seed(self.seed)
+        # Digests of each step, to check that a replay matches the recording
+        self.expected_digests = None
+        self.diverged = None   #: The first step where a replay differed from its recording
+        if self.replay is not None and not self.record:
+            self.expected_digests = getattr(self.replay, 'digests', None)
         # Initialize new replay
         if self.record:
             self.replay = ReplayData(self)
@@ -383,6 +432,7 @@ class Game(object):
                     for i,s in enumerate(reds):
                         kwargs = copy.deepcopy(brain_kwargs)
                         kwargs.update(self.red.init_kwargs)
+                        kwargs.update(self._optional_kwargs(self.red, red_brain_class))
                         brain = red_brain_class(i, TEAM_RED, **kwargs)
                         t = Tank(s.x+2, s.y+2, s.angle, i, team=TEAM_RED, brain=brain, spawn=s, record=self.record)
                         self.tanks.append(t)
@@ -398,6 +448,7 @@ class Game(object):
                     for i,s in enumerate(blues):
                         kwargs = copy.deepcopy(brain_kwargs)
                         kwargs.update(self.blue.init_kwargs)
+                        kwargs.update(self._optional_kwargs(self.blue, blue_brain_class))
                         brain = blue_brain_class(i, TEAM_BLUE, **kwargs)
                         t = Tank(s.x+2, s.y+2, s.angle, i, team=TEAM_BLUE, brain=brain, spawn=s, record=self.record)
                         self.tanks.append(t)
@@ -410,15 +461,22 @@ class Game(object):
         else:
             # Initialize tanks to play replays
             for i,(s,a) in enumerate(zip(reds,self.replay.actions_red)):
-                t = Tank(s.x+2, s.y+2, s.angle, i, team=TEAM_RED, spawn=s, actions=a[:])
+                t = Tank(s.x+2, s.y+2, s.angle, i, team=TEAM_RED, spawn=s, actions=a)
                 self.tanks.append(t)
                 self._add_object(t)
             for i,(s,a) in enumerate(zip(blues,self.replay.actions_blue)):
-                t = Tank(s.x+2, s.y+2, s.angle, i, team=TEAM_BLUE, spawn=s, actions=a[:])
+                t = Tank(s.x+2, s.y+2, s.angle, i, team=TEAM_BLUE, spawn=s, actions=a)
                 self.tanks.append(t)
                 self._add_object(t)
         self.tanks_red = [tank for tank in self.tanks if tank.team == TEAM_RED]
         self.tanks_blue = [tank for tank in self.tanks if tank.team == TEAM_BLUE]
+        if self.trace:
+            self.trace = StateTrace(self.settings.max_steps, len(self.tanks), len(self.controlpoints))
+            self.trace.columns['team'].extend(t.team for t in self.tanks)
+        if self.replay_file is not None:
+            self.replay_writer = ReplayWriter(self.replay_file, self.settings, self.field,
+                                              self.red.fullname(), self.blue.fullname(),
+                                              len(self.tanks_red), len(self.tanks_blue), self.seed)
         self.state = Game.STATE_READY
         self.interrupted = False
         
@@ -426,108 +484,16 @@ class Game(object):
         """ Start and loop the game. """
         if self.state != Game.STATE_READY:
             self._setup()
-        res      = Game.SIMULATION_SUBSTEPS
-        render   = self.renderer is not None
-        settings = self.settings
+        elif sys.stdout is not self.log:
+            # Set up by seek(), which gave back stdout
+            self.old_stdout = sys.stdout
+            sys.stdout = self.log
         ## MAIN GAME LOOP
         self.state = Game.STATE_RUNNING
         try:
-            for s in xrange(settings.max_steps):
-                self.step = s+1
-                if self.step % 10 == 0:
-                    print "Step %d: %d - %d"%(self.step, self.score_red, self.score_blue)
-                if self.step_callback is not None:
-                    self.step_callback(self)
-                ## UPDATE & CHECK VICTORY
-                p = time.clock()
-                for o in self.objects:
-                    o.update()
-                for t in self.tanks:
-                    t.send_observation()
-                for t in self.tanks:
-                    t.get_action()
-                # Compute shooting
-                for tank in self.tanks:
-                    tank.hit = None
-                    if tank.shoots:
-                        tcx, tcy = tank._x + tank.width/2, tank._y + tank.height/2
-                        target = (cos(tank.angle) * settings.max_range + tcx, 
-                                  sin(tank.angle) * settings.max_range + tcy)
-                        hits   = self._raycast((tcx, tcy), target, exclude=tank)
-                        tank._hitx, tank._hity = target
-                        if hits:
-                            t, (px,py), who = hits[0]
-                            tank._hitx, tank._hity = px, py
-                            if isinstance(who, Tank):
-                                tank.hit = who.team
-                                who.respawn_in = self.settings.spawn_time
-                
-                # Record times
-                self.update_time_total += time.clock() - p
-                sum_red = sum(tank.time_thought for tank in self.tanks_red)
-                sum_blue = sum(tank.time_thought for tank in self.tanks_blue)
-                self.stats.think_time_red += sum_red
-                self.stats.think_time_blue += sum_blue
-                if self.tanks_red:
-                    self.think_time_red = sum_red / len(self.tanks_red)
-                if self.tanks_blue:
-                    self.think_time_blue = sum_blue / len(self.tanks_blue)
-                # Score ending condition
-                if ((self.settings.end_condition & ENDGAME_SCORE) and 
-                    (self.score_red == 0 or self.score_blue == 0)):
-                    break
-                # No crumbs left ending condition
-                if ((self.settings.end_condition & ENDGAME_CRUMBS) and
-                    not any(True for o in allobjects if isinstance(o, Crumb))):
+            for s in xrange(self.step, self.settings.max_steps):
+                if not self._step(s):
                     break
-                ## RESET SOME STUFF
-                if render:
-                    self.clicked = None
-                    self.keys = []
-                ## SIMULATE AND RENDER
-                for o in self.objects:
-                    if o.movable:
-                        o._dx = (o.x - o._x) / res
-                        o._dy = (o.y - o._y) / res
-                        if render:
-                            o._da = (o.angle - o._a) / renderer.ROTATION_FRAMES
-                # Render rotation/shooting
-                if render:
-                    for _ in xrange(renderer.ROTATION_FRAMES):
-                        for o in self.objects:
-                            o._a += o._da
-                        self.renderer.render(self)
-                    for f in xrange(renderer.SHOOTING_FRAMES):
-                        self.renderer.render(self, shooting_frame = f)
-                
-                # Reset tanks that got shot
-                for tank in self.tanks:
-                    if tank.respawn_in == self.settings.spawn_time:
-                        if tank.team == TEAM_RED:
-                            self.stats.deaths_red += 1
-                        else:
-                            self.stats.deaths_blue += 1
-                        tank.ammo = 0
-                        tank.x = tank._x = tank.spawn.x + 2
-                        tank.y = tank._y = tank.spawn.y + 2
-                        tank._dx = tank._dy = 0
-                        tank.angle = tank._a = tank.spawn.angle                        
-                
-                # Simulate/Render movement
-                self.sim_time = 0.0
-                for step in xrange(res):
-                    p = time.clock()
-                    # Perform one physics substep
-                    self._substep()
-                    self.sim_time += time.clock() - p
-                    if render:
-                        self.renderer.render(self)
-                self.sim_time_total += self.sim_time
-                for o in self.objects:
-                    if o.movable:
-                        o.x = o._x
-                        o.y = o._y
-                        o._a = o.angle = angle_fix(o.angle)
         except GameInterrupt:
             self.state = Game.STATE_INTERRUPT
         except KeyboardInterrupt:
@@ -535,6 +501,216 @@ class Game(object):
         self._end(interrupted=(self.state==Game.STATE_INTERRUPT))
         return self # For chaining, if you're into that.
     
+    def _step(self, s):
+        """ Plays step s+1 of the game, returns False if the game has ended. """
+        res      = Game.SIMULATION_SUBSTEPS
+        render   = self.renderer is not None
+        settings = self.settings
+        if (s and self.KEYFRAME_INTERVAL and s % self.KEYFRAME_INTERVAL == 0 and
+            (self.record or self.replay_writer is not None)):
+            keyframe = self.snapshot()
+            if self.record:
+                self.replay.keyframes[s] = keyframe
+            if self.replay_writer is not None:
+                self.replay_writer.add_keyframe(s, keyframe)
+        self.step = s+1
+        if self.step % 10 == 0:
+            print "Step %d: %d - %d"%(self.step, self.score_red, self.score_blue)
+        if self.step_callback is not None:
+            self.step_callback(self)
+        ## UPDATE & CHECK VICTORY
+        p = time.clock()
+        for o in self.objects:
+            o.update()
+        for t in self.tanks:
+            t.send_observation()
+        for t in self.tanks:
+            t.get_action()
+        if self.replay_writer is not None:
+            self.replay_writer.write_step([t.last_action for t in self.tanks])
+        # Compute shooting
+        for tank in self.tanks:
+            tank.hit = None
+            if tank.shoots:
+                tcx, tcy = tank._x + tank.width/2, tank._y + tank.height/2
+                target = (cos(tank.angle) * settings.max_range + tcx, 
+                          sin(tank.angle) * settings.max_range + tcy)
+                hits   = self._raycast((tcx, tcy), target, exclude=tank)
+                tank._hitx, tank._hity = target
+                if hits:
+                    t, (px,py), who = hits[0]
+                    tank._hitx, tank._hity = px, py
+                    if isinstance(who, Tank):
+                        tank.hit = who.team
+                        who.respawn_in = self.settings.spawn_time
+
+        # Record times
+        self.update_time_total += time.clock() - p
+        sum_red = sum(tank.time_thought for tank in self.tanks_red)
+        sum_blue = sum(tank.time_thought for tank in self.tanks_blue)
+        self.stats.think_time_red += sum_red
+        self.stats.think_time_blue += sum_blue
+        if self.tanks_red:
+            self.think_time_red = sum_red / len(self.tanks_red)
+        if self.tanks_blue:
+            self.think_time_blue = sum_blue / len(self.tanks_blue)
+        # Score ending condition
+        if ((self.settings.end_condition & ENDGAME_SCORE) and 
+            (self.score_red == 0 or self.score_blue == 0)):
+            return False
+        # No crumbs left ending condition
+        if ((self.settings.end_condition & ENDGAME_CRUMBS) and
+            not any(True for o in allobjects if isinstance(o, Crumb))):
+            return False
+        ## RESET SOME STUFF
+        if render:
+            self.clicked = None
+            self.keys = []
+        ## SIMULATE AND RENDER
+        for o in self.objects:
+            if o.movable:
+                o._dx = (o.x - o._x) / res
+                o._dy = (o.y - o._y) / res
+                if render:
+                    o._da = (o.angle - o._a) / renderer.ROTATION_FRAMES
+        # Render rotation/shooting
+        if render:
+            for _ in xrange(renderer.ROTATION_FRAMES):
+                for o in self.objects:
+                    o._a += o._da
+                self.renderer.render(self)
+            for f in xrange(renderer.SHOOTING_FRAMES):
+                self.renderer.render(self, shooting_frame = f)
+
+        # Reset tanks that got shot
+        for tank in self.tanks:
+            if tank.respawn_in == self.settings.spawn_time:
+                if tank.team == TEAM_RED:
+                    self.stats.deaths_red += 1
+                else:
+                    self.stats.deaths_blue += 1
+                tank.ammo = 0
+                tank.x = tank._x = tank.spawn.x + 2
+                tank.y = tank._y = tank.spawn.y + 2
+                tank._dx = tank._dy = 0
+                tank.angle = tank._a = tank.spawn.angle                        
+
+        # Simulate/Render movement
+        self.sim_time = 0.0
+        for step in xrange(res):
+            p = time.clock()
+            # Perform one physics substep
+            self._substep()
+            self.sim_time += time.clock() - p
+            if render:
+                self.renderer.render(self)
+        self.sim_time_total += self.sim_time
+        for o in self.objects:
+            if o.movable:
+                o.x = o._x
+                o.y = o._y
+                o._a = o.angle = angle_fix(o.angle)
+        if self.trace:
+            self.trace.add_step(self)
+        ## RECORD OR CHECK STATE DIGEST
+        expected = self.expected_digests
+        if self.record or self.replay_writer is not None or expected:
+            digest = self.digest()
+            if self.record:
+                self.replay.digests.append(digest)
+            if self.replay_writer is not None:
+                self.replay_writer.add_digest(digest)
+            if (expected and self.diverged is None and self.step <= len(expected) and
+                expected[self.step - 1] != digest):
+                self.diverged = self.step
+                print >> sys.stderr, ("WARNING: Replay differs from the recorded game from step %d on." % self.step)
+        return True
+    
+    def digest(self):
+        """ Returns a checksum of the tanks' positions, angles, ammo and
+            respawn times, and the scores, to check that a replay 
+            reproduces the game it was recorded from.
+        """
+        values, counts = [], []
+        for t in self.tanks:
+            values.extend((t.x, t.y, t.angle))
+            counts.extend((t.ammo, t.respawn_in))
+        counts.extend((self.score_red, self.score_blue))
+        packed = struct.pack('<%dd%di' % (len(values), len(counts)), *(values + counts))
+        return zlib.crc32(packed) & 0xffffffff
+    
+    def snapshot(self):
+        """ Returns the full state of the game (the objects, scores, 
+            statistics and random state) as a compressed string, which
+            :meth:`restore` can bring the game back to. The agents' 
+            brains are not part of it, and neither are their think times,
+            so that the same game always gives the same snapshot.
+        """
+        external = {id(self): 'game'}
+        for i, tank in enumerate(self.tanks):
+            for name in ('brain', 'actions', 'observation'):
+                external[id(getattr(tank, name))] = (name, i)
+        external.pop(id(None), None)
+        stats = dict((k, v) for (k, v) in self.stats.__dict__.iteritems() 
+                     if not k.startswith('think_time'))
+        state = (self.objects, self.broadphase_mov, self.broadphase_stat, 
+                 self.tanks, self.controlpoints, stats, self.random,
+                 self.step, self.score_red, self.score_blue, self.object_uid)
+        f = StringIO()
+        pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = lambda obj: external.get(id(obj))
+        pickler.dump(state)
+        return zlib.compress(f.getvalue())
+    
+    def restore(self, snapshot):
+        """ Brings a game that has been set up back to the state in a
+            :meth:`snapshot`. The tanks keep their brains, or, in a
+            replay, continue with the actions after that step.
+        """
+        old = self.tanks
+        def persistent_load(key):
+            if key == 'game':
+                return self
+            name, i = key
+            return getattr(old[i], name)
+        unpickler = pickle.Unpickler(StringIO(zlib.decompress(snapshot)))
+        unpickler.persistent_load = persistent_load
+        (self.objects, self.broadphase_mov, self.broadphase_stat, 
+         self.tanks, self.controlpoints, stats, self.random,
+         self.step, self.score_red, self.score_blue, self.object_uid) = unpickler.load()
+        self.stats.__dict__.update(stats)
+        for (tank, before) in zip(self.tanks, old):
+            tank.brain = before.brain
+            tank.record = before.record
+            tank.time_thought = before.time_thought
+            tank.next_action = self.step
+            # Make sure the walls are observed again
+            tank.grid_x = tank.grid_y = -1
+        self.tanks_red = [tank for tank in self.tanks if tank.team == TEAM_RED]
+        self.tanks_blue = [tank for tank in self.tanks if tank.team == TEAM_BLUE]
+    
+    def seek(self, step):
+        """ Moves a replay to the given step (which is then the number
+            of steps that have been played), by restoring the latest 
+            keyframe before it and simulating from there. Call 
+            :meth:`run` afterwards to play on from that step.
+        """
+        if self.state != Game.STATE_READY or step < self.step:
+            self._setup()
+        keyframes = getattr(self.replay, 'keyframes', {})
+        start = max([k for k in keyframes if k <= step] or [0])
+        if start > self.step:
+            self.restore(keyframes[start])
+        renderer, self.renderer = self.renderer, None
+        try:
+            for s in xrange(self.step, min(step, self.settings.max_steps)):
+                if not self._step(s):
+                    break
+        finally:
+            self.renderer = renderer
+            sys.stdout = self.old_stdout
+        return self
+    
     def _end(self, interrupted=False):
         """ End the game  and tells all the agents that the game
              is over so that they can write any remaining info.
@@ -555,6 +731,8 @@ class Game(object):
             self.replay.field = self.field
             self.replay.actions_red = [tank.actions for tank in self.tanks_red]
             self.replay.actions_blue = [tank.actions for tank in self.tanks_blue]
+        if self.replay_writer is not None:
+            self.replay_writer.close()
         # Finalize tanks brains.
         if self.record or self.replay is None:
             for tank in self.tanks:
@@ -562,6 +740,26 @@ class Game(object):
         # Set the stdout back to whatever it was before
         sys.stdout = self.old_stdout
     
+    def _optional_kwargs(self, team, brain_class):
+        """ Returns the keyword arguments that agents only get if they
+            accept them: the ``cache_dir`` if there is an agent cache, and
+            the field's ``flow_field`` method and ``field_regions`` if the
+            field is known.
+        """
+        try:
+            spec = inspect.getargspec(brain_class.__init__)
+        except TypeError:
+            return {}
+        accepts = lambda name: name in spec.args or spec.keywords is not None
+        kwargs = {}
+        if self.agent_cache is not None and accepts('cache_dir'):
+            kwargs['cache_dir'] = self.agent_cache.folder_for(team, self.field)
+        if self.settings.field_known and accepts('flow_field'):
+            kwargs['flow_field'] = self.field.flow_field
+        if self.settings.field_known and accepts('field_regions'):
+            kwargs['field_regions'] = self.field.regions
+        return kwargs
+    
     def _substep(self):
         """ Performs a single physics substep. All objects are moved by
             their respective _dx and _dy amounts, collisions are computed,
@@ -880,6 +1078,20 @@ class Field(object):
     CLEAR     = '_'
     REACHABLE = '.'
     
+    # NAV MESH PARAMETERS
+    MESH_OFFSET   = 7
+    MESH_SIMPLIFY = 0.3
+    
+    #: How to merge wall tiles into rects: 'stack' merges rows and columns
+    #: of tiles, 'minimal' uses as few rects as possible (see 
+    #: :func:`~domination.utilities.rects_decompose`)
+    WALL_MERGE    = 'stack'
+    
+    #: A :class:`FieldCache` to store unpacked fields in, or None
+    cache = None
+    # The parts of _unpacked that are stored in the cache
+    CACHED = ('wallrects', 'mesh', 'grid', 'mirrored', 'rectcounts', 'regions')
+    
     def __init__(self, width, height, tilesize):
         # Settings variables
         self.width            = width
@@ -914,6 +1126,14 @@ class Field(object):
                 self.tiles == other.tiles)
     
     ## SAVING/LOADING
+    def hash(self):
+        """ Returns a hash of the tiles, the tilesize and the nav
+            mesh parameters, which identifies the unpacked field.
+        """
+        content = '%d %r %r %s\n%s' % (self.tilesize, self.MESH_OFFSET, self.MESH_SIMPLIFY, 
+                                        self.WALL_MERGE, self)
+        return hashlib.md5(content).hexdigest()
+        
     @classmethod
     def from_string(cls, s):
         """ Returns a new Field from given ASCII representation. """
@@ -990,6 +1210,24 @@ class Field(object):
             clear = self.find(Field.CLEAR, bounds=bounds)
             points = random.sample(clear, num)
             self.set(points, marker)
+    
+    def is_mirrored(self):
+        """ Whether the field is left/right symmetric, with the red
+            and blue spawns swapped, like the fields made by a
+            FieldGenerator with mirror=True.
+        """
+        swap = {Field.RED: Field.BLUE, Field.BLUE: Field.RED}
+        for row in self.tiles:
+            for j in xrange((self.width + 1) // 2):
+                if swap.get(row[j], row[j]) != row[self.width-1-j]:
+                    return False
+        return True
+    
+    def mirror(self, point):
+        """ Returns the mirror image of given point (in game units)
+            on the other half of the field.
+        """
+        return (self.width * self.tilesize - point[0], point[1])
                     
     def fill_unreachable(self):
         spawn = self.find(Field.RED)[0] or self.find(Field.BLUE)[0]
@@ -1019,18 +1257,35 @@ class Field(object):
     
     ## ACCESS BY GAME
     
-    def unpack(self):
+    def unpack(self, cached=None):
         """ Unpacks the tilemap and generates derivative
             properties like the navigation mesh, wall rects, 
             and game objects. Game objects are not
             actually created yet, but GENERATED ON THE FLY
             when the game asks for them, so that each
             game gets a shiny new batch of game objects.
+            
+            :param cached: The result of :meth:`unpacked_data` for a 
+                           field with the same tiles, so that the mesh
+                           doesn't have to be computed again. It can
+                           also hold the ``navgraph``, and the
+                           ``flowfields`` to share with other fields.
         """
         _unpacked = {'wallrects':[],
                      'objects': [],
                      'mesh': None,
-                     'grid': None}
+                     'grid': None,
+                     'navgraph': None,
+                     'flowfields': {},
+                     'mirrored': None,
+                     'rectcounts': None,
+                     'regions': None,
+                     'regionmap': None}
+        # Look for a stored copy of the expensive parts
+        key = None
+        if cached is None and Field.cache is not None:
+            key = self.hash()
+            cached = Field.cache.get(key)
         
         def create_object(x, y, marker):
             """ Creates an object from a tile marker """
@@ -1061,27 +1316,70 @@ class Field(object):
                     _unpacked["wallrects"].append((j*self.tilesize, i*self.tilesize, self.tilesize, self.tilesize))
                 elif tile not in self.CLEAR + self.REACHABLE:
                     _unpacked["objects"].append(create_object(j, i, tile))
-
-        # Optimize the walls and generate Wall objects
-        _unpacked['wallrects'] = rects_merge(_unpacked['wallrects'])
+        
+        if cached is not None:
+            for k in self.CACHED:
+                _unpacked[k] = cached.get(k)
+            _unpacked['navgraph'] = cached.get('navgraph')
+            _unpacked['flowfields'] = cached.get('flowfields', {})
+        else:
+            # On symmetric fields only half of the work is done
+            _unpacked['mirrored'] = self.is_mirrored()
+            mirror_width = self.width * self.tilesize if _unpacked['mirrored'] else None
+            
+            # Optimize the walls
+            tiles = len(_unpacked['wallrects'])
+            _unpacked['wallrects'] = rects_merge(_unpacked['wallrects'], mirror_width=mirror_width)
+            _unpacked['rectcounts'] = {'tiles': tiles, 'stack': len(_unpacked['wallrects'])}
+            if self.WALL_MERGE == 'minimal':
+                _unpacked['wallrects'] = rects_decompose(self._wallgrid(), self.tilesize)
+                _unpacked['rectcounts']['minimal'] = len(_unpacked['wallrects'])
+                # These rects aren't symmetric
+                mirror_width = None
+            
+            # Generate nav mesh
+            add_points = [(o.cx, o.cy) for o in _unpacked['objects'] if 
+                            (isinstance(o,Ammo) or isinstance(o,ControlPoint))]
+            _unpacked['mesh'] = make_nav_mesh(_unpacked['wallrects'], offset=self.MESH_OFFSET,
+                                              simplify=self.MESH_SIMPLIFY, add_points=add_points,
+                                              mirror_width=mirror_width)
+            
+            # Generate wall grid
+            _unpacked['grid'] = self._wallgrid()
+            
+        # Generate Wall objects
         _unpacked['objects'].extend( (Wall, {'x':x, 'y':y, 'width':w, 'height':h}) 
                                         for (x,y,w,h) in _unpacked['wallrects'] )
-        
-        # Generate nav mesh
-        add_points = [(o.cx, o.cy) for o in _unpacked['objects'] if 
-                        (isinstance(o,Ammo) or isinstance(o,ControlPoint))]
-        _unpacked['mesh'] = make_nav_mesh(_unpacked['wallrects'], simplify=0.3,add_points=add_points)
-        
-        # Generate wall grid
-        _unpacked['grid'] = [[(1 if t == self.WALL else 0) for t in row] for row in self.tiles]
 
         self._unpacked = _unpacked
+        if key is not None and cached is None:
+            Field.cache.put(key, self.unpacked_data())
+    
+    def unpacked_data(self):
+        """ Returns the parts of the unpacked field that take long to 
+            compute (wall rects, nav mesh, wall grid), as a dictionary.
+        """
+        if not self._unpacked: self.unpack()
+        return dict((k, self._unpacked[k]) for k in self.CACHED)
+        
+    def _wallgrid(self):
+        return [[(1 if t == self.WALL else 0) for t in row] for row in self.tiles]
         
     @property
     def mesh(self):
         if not self._unpacked: self.unpack()
         return self._unpacked['mesh']
     
+    @property
+    def navgraph(self):
+        """ The nav mesh as a :class:`~domination.libs.csrgraph.CSRGraph`,
+            converted only once per field.
+        """
+        if not self._unpacked: self.unpack()
+        if self._unpacked['navgraph'] is None:
+            self._unpacked['navgraph'] = CSRGraph.from_mesh(self.mesh)
+        return self._unpacked['navgraph']
+    
     @property
     def wallgrid(self):
         if not self._unpacked: self.unpack()
@@ -1092,12 +1390,418 @@ class Field(object):
         if not self._unpacked: self.unpack()
         return self._unpacked['wallrects']
     
+    @property
+    def rect_counts(self):
+        """ The number of wall tiles, and the number of wall rects they
+            were merged into, by each method that was used. 
+        """
+        if not self._unpacked: self.unpack()
+        return self._unpacked['rectcounts']
+    
+    @property
+    def regions(self):
+        """ The :class:`~domination.analysis.Regions` of this field, with 
+            the controlpoints, ammo and spawns in each region. Computed only
+            the first time it is asked for, and then stored in the 
+            :attr:`cache` along with the rest of the unpacked field.
+            Agents that take a ``field_regions`` argument get them.
+        """
+        if not self._unpacked: self.unpack()
+        if self._unpacked['regionmap'] is None:
+            if self._unpacked['regions'] is None:
+                self._unpacked['regions'] = find_regions(self.wallgrid)
+                if Field.cache is not None:
+                    Field.cache.put(self.hash(), self.unpacked_data())
+            markers = {'controlpoints': self.find(Field.CONTROL),
+                       'ammo': self.find(Field.AMMO),
+                       'red': self.find(Field.RED),
+                       'blue': self.find(Field.BLUE)}
+            self._unpacked['regionmap'] = Regions(self._unpacked['regions'], 
+                                                  self.tilesize, markers)
+        return self._unpacked['regionmap']
+    
     def get_objects(self):
         """ Creates the gameobjects and returns them """
         if not self._unpacked: self.unpack()
         return [cls(**kwargs) for (cls, kwargs) in self._unpacked['objects']]
     
+    def flow_field(self, goal):
+        """ Returns a :class:`~domination.utilities.FlowField` towards the
+            given goal point (or list of points), computing it only the
+            first time it is asked for on this field. Agents that take a 
+            ``flow_field`` argument get this method, so the flow fields are
+            shared by all agents and games on the field, and should not
+            be changed.
+        """
+        if not self._unpacked: self.unpack()
+        if goal and not hasattr(goal[0], '__len__'):
+            goal = [goal]
+        key = tuple(tuple(g) for g in goal)
+        flowfields = self._unpacked['flowfields']
+        if key not in flowfields:
+            mirrored = tuple(self.mirror(g) for g in key)
+            # Reflect the field for the mirrored goals, unless they're on a tile edge
+            if (self._unpacked['mirrored'] and mirrored in flowfields and 
+                all(g[0] % self.tilesize for g in key)):
+                flowfields[key] = flowfields[mirrored].mirrored()
+            else:
+                flowfields[key] = FlowField(key, self.wallgrid, self.tilesize)
+        return flowfields[key]
+    
         
+class FieldCache(object):
+    """ Keeps unpacked fields (the wall rects, nav mesh and wall grid)
+        in a folder, by :meth:`Field.hash`, so that they are loaded
+        instead of computed when the same field is unpacked again. Each
+        field is a compressed pickle. When the folder grows beyond 
+        max_bytes, the least recently used fields are removed. The
+        folder is made when the first field is stored. If a field can't
+        be stored, it is just not cached.
+        
+        Turn it on by setting ``Field.cache = FieldCache('some/folder')``,
+        the DOMINATION_FIELD_CACHE environment variable, or
+        :attr:`~domination.run.Scenario.FIELD_CACHE`.
+    """
+    EXTENSION = '.field'
+    
+    def __init__(self, folder, max_bytes=64*1024*1024):
+        self.folder    = folder
+        self.max_bytes = max_bytes
+    
+    def _path(self, key):
+        return os.path.join(self.folder, key + self.EXTENSION)
+    
+    def get(self, key):
+        """ Returns the stored data for key, or None. """
+        path = self._path(key)
+        try:
+            data = pickle.loads(zlib.decompress(open(path, 'rb').read()))
+            # Mark as recently used
+            os.utime(path, None)
+            return data
+        except (IOError, OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            return None
+    
+    def put(self, key, data):
+        """ Stores data under key, and removes old entries if the
+            folder has become too big.
+        """
+        path = self._path(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.folder):
+                os.makedirs(self.folder)
+            f = open(tmp, 'wb')
+            try:
+                f.write(zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)))
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except (IOError, OSError), e:
+            # Another process stored it first (on Windows), or the 
+            # folder can't be written to, or the disk is full.
+            if os.path.exists(tmp):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+            if not os.path.exists(path):
+                print "Could not store field in cache: %s" % e
+            return
+        self.evict()
+    
+    def evict(self):
+        """ Removes the least recently used entries until the folder 
+            is smaller than max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith(self.EXTENSION):
+                path = os.path.join(self.folder, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+class AgentCache(object):
+    """ Gives agents a folder to store what they have computed about
+        a field, so that they can load it again in the next game on the 
+        same field, instead of computing it again. Each agent gets a 
+        folder for each field, keyed by the agent's name and code, and 
+        by :meth:`Field.hash`. The agent receives it as the ``cache_dir``
+        keyword argument, if its constructor has one::
+        
+            def __init__(self, id, team, cache_dir=None, **kwargs):
+                path = os.path.join(cache_dir, 'spots.pickle')
+                if os.path.exists(path):
+                    self.spots = pickle.load(open(path, 'rb'))
+        
+        and can write its files there in ``finalize``. When the folder
+        grows beyond max_bytes, :meth:`evict` removes the least recently
+        used field folders.
+        
+        Pass it to :class:`Game` as ``agent_cache``, and call :meth:`evict`
+        when the games are done, or set 
+        :attr:`~domination.run.Scenario.AGENT_CACHE`, which evicts once 
+        after each run, when no agent is using the folders any more.
+    """
+    def __init__(self, folder, max_bytes=256*1024*1024):
+        self.folder    = folder
+        self.max_bytes = max_bytes
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    
+    def identity(self, team):
+        """ Returns the name under which a team's files are kept. A changed
+            agent gets a new name, so it never loads stale data.
+        """
+        code = hashlib.md5(team.brain_string).hexdigest()[:10]
+        return '%s_%s' % (team.name_internal, code)
+    
+    def folder_for(self, team, field):
+        """ Returns the folder for the given team and field, and
+            marks it as recently used.
+        """
+        path = os.path.join(self.folder, self.identity(team), field.hash())
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # Another game created it first
+                pass
+        os.utime(path, None)
+        return path
+    
+    def evict(self):
+        """ Removes the least recently used field folders until the 
+            cache is smaller than max_bytes.
+        """
+        entries = []
+        for agent in os.listdir(self.folder):
+            agent = os.path.join(self.folder, agent)
+            if not os.path.isdir(agent):
+                continue
+            for key in os.listdir(agent):
+                path = os.path.join(agent, key)
+                try:
+                    size = sum(os.path.getsize(os.path.join(d, f)) 
+                               for (d, _, files) in os.walk(path) for f in files)
+                    entries.append((os.stat(path).st_mtime, size, path))
+                except OSError:
+                    continue
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+if os.environ.get('DOMINATION_FIELD_CACHE'):
+    Field.cache = FieldCache(os.environ['DOMINATION_FIELD_CACHE'])
+
+
+class _TileRow(object):
+    """ One row of the tiles of an :class:`ArrayField`, that reads and
+        writes markers straight from and to the array.
+    """
+    __slots__ = ('row',)
+    
+    def __init__(self, row):
+        self.row = row
+    
+    def __len__(self):
+        return len(self.row)
+    
+    def __iter__(self):
+        return iter([chr(c) for c in self.row.tolist()])
+    
+    def __getitem__(self, x):
+        if isinstance(x, slice):
+            return [chr(c) for c in self.row[x].tolist()]
+        return chr(self.row[x])
+    
+    def __setitem__(self, x, marker):
+        if isinstance(x, slice):
+            self.row[x] = [ord(t) for t in marker]
+        else:
+            self.row[x] = ord(marker)
+    
+    def __eq__(self, other):
+        return list(self) == list(other)
+    
+    def __ne__(self, other):
+        return not self == other
+
+class _TileRows(object):
+    """ The tiles of an :class:`ArrayField`, as rows of markers. """
+    __slots__ = ('array',)
+    
+    def __init__(self, array):
+        self.array = array
+    
+    def __len__(self):
+        return len(self.array)
+    
+    def __iter__(self):
+        return (_TileRow(row) for row in self.array)
+    
+    def __getitem__(self, y):
+        if isinstance(y, slice):
+            return [_TileRow(row) for row in self.array[y]]
+        return _TileRow(self.array[y])
+    
+    def __setitem__(self, y, row):
+        self.array[y] = [ord(t) for t in row]
+    
+    def __eq__(self, other):
+        return len(self) == len(other) and all(a == b for (a, b) in zip(self, other))
+    
+    def __ne__(self, other):
+        return not self == other
+
+class ArrayField(Field):
+    """ A Field that stores its tiles in a numpy array, one byte per
+        tile, so that finding and setting tiles is done in bulk. It
+        needs numpy, which the plain Field doesn't.
+        
+        The ``tiles`` are still available as rows of markers, but
+        they are a view onto the array: assigning to ``tiles[y][x]``
+        changes the array too. Changing many tiles at once is a lot
+        faster with :meth:`set`.
+        
+        Use :meth:`from_field` to convert a generated field::
+        
+            field = ArrayField.from_field(FieldGenerator().generate())
+    """
+    
+    def __init__(self, width, height, tilesize):
+        if np is None:
+            raise ImportError("ArrayField needs numpy.")
+        Field.__init__(self, width, height, tilesize)
+    
+    @classmethod
+    def from_field(cls, field):
+        """ Returns a new ArrayField with the same tiles as the given field. """
+        f = cls(field.width, field.height, field.tilesize)
+        f.tiles = field.tiles
+        return f
+    
+    @property
+    def tiles(self):
+        """ The tiles as rows of markers, a view onto the array. """
+        return _TileRows(self.array)
+    
+    @tiles.setter
+    def tiles(self, tiles):
+        self.array = np.array([[ord(t) for t in row] for row in tiles], dtype=np.uint8)
+    
+    def _match(self, match, array=None):
+        """ Returns a boolean array of where the markers match. """
+        if array is None:
+            array = self.array
+        if match.startswith(Field.NOT):
+            codes = np.array([ord(c) for c in match[1:]], dtype=np.uint8)
+            return ~np.in1d(array, codes).reshape(array.shape)
+        codes = np.array([ord(c) for c in match], dtype=np.uint8)
+        return np.in1d(array, codes).reshape(array.shape)
+    
+    def _reachable(self, (x, y)):
+        """ Boolean array of the tiles that can be reached from (x, y),
+            by growing the area one step at a time, like 
+            :func:`~domination.utilities.reachable`.
+        """
+        free = self.array != ord(Field.WALL)
+        reach = np.zeros(free.shape, dtype=bool)
+        reach[y, x] = free[y, x]
+        while True:
+            grown = reach.copy()
+            grown[1:, :] |= reach[:-1, :]
+            grown[:-1, :] |= reach[1:, :]
+            grown[:, 1:] |= reach[:, :-1]
+            grown[:, :-1] |= reach[:, 1:]
+            grown &= free
+            if (grown == reach).all():
+                return reach
+            reach = grown
+    
+    ## MANIPULATION
+    def clone(self):
+        """ Returns an exact copy of this field, that can
+            be modified without changing this one. 
+        """
+        f = self.__class__(self.width, self.height, self.tilesize)
+        f.array = self.array.copy()
+        return f
+        
+    def find(self, match, bounds=None, mask=None):
+        """ Find all (x,y) positions of given tile marker,
+            in the same order as :meth:`Field.find`.
+        """
+        if bounds is None:
+            bounds = (0, 0, self.width, self.height)
+        x0, y0, x1, y1 = bounds
+        found = self._match(match, self.array[y0:y1, x0:x1])
+        if mask is not None:
+            found &= np.asarray(mask, dtype=bool)[y0:y1, x0:x1]
+        ys, xs = np.nonzero(found)
+        return zip((xs + x0).tolist(), (ys + y0).tolist())
+    
+    def set(self, coords, marker, mirror=False, match='^'):
+        """ Set tiles in coords to a marker, but only 
+            if it matches the given match expression. All
+            tiles are matched before any of them is set.
+        """
+        if len(coords) and type(coords[0]) == int:
+            coords = [coords]
+        if not len(coords):
+            return
+        xs, ys = np.array(coords, dtype=int).T
+        matches = self._match(match, self.array[ys, xs])
+        xs, ys = xs[matches], ys[matches]
+        self.array[ys, xs] = ord(marker)
+        if mirror:
+            self.array[ys, self.width-1-xs] = ord(marker)
+    
+    def is_mirrored(self):
+        """ Whether the field is left/right symmetric, with the red
+            and blue spawns swapped.
+        """
+        a = self.array
+        swapped = a.copy()
+        swapped[a == ord(Field.RED)] = ord(Field.BLUE)
+        swapped[a == ord(Field.BLUE)] = ord(Field.RED)
+        return bool((swapped[:, ::-1] == a).all())
+    
+    def fill_unreachable(self):
+        spawn = self.find(Field.RED)[0] or self.find(Field.BLUE)[0]
+        reach = self._reachable(spawn)
+        a = self.array
+        a[(a == ord(Field.CLEAR)) & ~reach] = ord(Field.WALL)
+        a[a == ord(Field.REACHABLE)] = ord(Field.CLEAR)
+    
+    def valid(self):
+        """ Check if map is valid, i.e. all points are
+            reachable
+        """
+        spawn = self.find(Field.RED)[0] or self.find(Field.BLUE)[0]
+        reach = self._reachable(spawn)
+        objects = self._match(Field.AMMO + Field.CONTROL + Field.BLUE + Field.RED)
+        return not (objects & ~reach).any()
+    
+    def _wallgrid(self):
+        return (self.array == ord(Field.WALL)).astype(np.uint8).tolist()
+    
+
 class FieldGenerator(object):
     """ Generates field objects from random distribution """
 
@@ -1176,8 +1880,8 @@ class FieldGenerator(object):
         else:
             min_len, max_len = self.wall_len, self.wall_len
         attempts = 100
-        while len(field.find('W')) < min_filled and attempts:
-            new = field.clone()
+        walls = len(field.find(Field.WALL))
+        while walls < min_filled and attempts:
             # Create horizontal section
             if rand() < self.wall_orientation:
                 sec_width = random.randint(min_len,max_len)
@@ -1198,12 +1902,11 @@ class FieldGenerator(object):
             x = (x // self.wall_gridsize) * self.wall_gridsize
             y = (y // self.wall_gridsize) * self.wall_gridsize
             
-            pts = new.find('W_.', bounds=(x, y, x + sec_width, y + sec_height))
+            pts = field.find('W_.', bounds=(x, y, x + sec_width, y + sec_height))
             if len(pts) == sec_width*sec_height:
-                new.set(pts, Field.WALL, self.mirror)
-                if new.valid():
-                    field = new
-                    new.fill_unreachable()
+                added = self._add_walls(field, pts, walls)
+                if added is not None:
+                    walls = added
                     continue                
             attempts -= 1
         
@@ -1217,6 +1920,55 @@ class FieldGenerator(object):
         field.scatter(Field.AMMO, self.num_ammo)
         
         return field
+    
+    def _add_walls(self, field, pts, walls):
+        """ Turns the tiles at pts (and their mirror images) into walls,
+            but only if everything stays reachable. Then fills up the
+            parts that can no longer be reached, like fill_unreachable.
+            Returns the new number of walls, or None if the walls were
+            not added. 
+            
+            Before the walls are added, all open tiles are connected. So
+            if the open tiles around the new walls are still connected 
+            to each other, nothing else can have been cut off, and the 
+            full flood fill is skipped.
+        """
+        tiles = field.tiles
+        blocks = [pts]
+        if self.mirror:
+            blocks.append([(field.width-1-x, y) for (x, y) in pts])
+        changed = []
+        local = True
+        for block in blocks:
+            for (x, y) in block:
+                if tiles[y][x] != Field.WALL:
+                    local = local and tiles[y][x] in Field.CLEAR + Field.REACHABLE
+                    changed.append((x, y, tiles[y][x]))
+                    tiles[y][x] = Field.WALL
+            local = local and self._ring_connected(field, block)
+        if local:
+            return walls + len(changed)
+        if field.valid():
+            field.fill_unreachable()
+            return len(field.find(Field.WALL))
+        # Undo
+        for (x, y, tile) in reversed(changed):
+            tiles[y][x] = tile
+        return None
+    
+    def _ring_connected(self, field, block):
+        """ Whether the open tiles in the ring around a rectangular
+            block of tiles are all connected through that ring.
+        """
+        xs, ys = [x for (x, y) in block], [y for (x, y) in block]
+        x0, y0, x1, y1 = min(xs) - 1, min(ys) - 1, max(xs) + 1, max(ys) + 1
+        # Walk around the ring, and count the stretches of open tiles.
+        ring = ([(x, y0) for x in xrange(x0, x1)] + [(x1, y) for y in xrange(y0, y1)] +
+                [(x, y1) for x in xrange(x1, x0, -1)] + [(x0, y) for y in xrange(y1, y0, -1)])
+        is_open = [0 <= x < field.width and 0 <= y < field.height and 
+                   field.tiles[y][x] != Field.WALL for (x, y) in ring]
+        stretches = sum(1 for i in xrange(len(ring)) if is_open[i] and not is_open[i-1])
+        return stretches <= 1
 
 
 class GameObject(object):
@@ -1310,6 +2062,8 @@ class Tank(GameObject):
         self.spawn       = spawn
         # A list of actions, either for recording or playing back.
         self.actions = actions if actions is not None else []
+        self.next_action = 0
+        self.last_action = (0, 0, False)
         self.record = record
         self.time_thought = 0.0
         # Additional hidden vars
@@ -1317,6 +2071,12 @@ class Tank(GameObject):
         self._hity = 0.0
         self.grid_x = 0
         self.grid_y = 0
+    
+    def __getstate__(self):
+        """ Used for snapshots, leaves out the measured think time """
+        state = self.__dict__.copy()
+        state['time_thought'] = 0.0
+        return state
         
     def added_to_game(self, game):
         # Initialize observation
@@ -1403,10 +2163,9 @@ class Tank(GameObject):
         
     def get_action(self):
         ## Ask brain for action (or replay)
-        if not self.record and self.actions:
-            # print "i gots actions %s-%d"%('BLU' if self.team==TEAM_BLUE else 'RED',self.id)
-            # print len(self.actions)
-            (turn, speed, shoot) = self.actions.pop(0)
+        if not self.record and self.next_action < len(self.actions):
+            (turn, speed, shoot) = self.actions[self.next_action]
+            self.next_action += 1
         else:
             last_clock = time.clock()
             try:
@@ -1430,6 +2189,7 @@ class Tank(GameObject):
                 self.actions.append((turn,speed,shoot))
             if self.game.renderer is not None and self.game.renderer.active_team == self.team:
                 self.brain.debug(self.game.renderer.agent_debug)
+        self.last_action = (turn, speed, shoot)
         self.shoots = False
         if self.respawn_in == -1:
             max_turn = self.game.settings.max_turn
@@ -1639,15 +2399,399 @@ class ReplayData(object):
     def __init__(self, game):
         self.settings = game.settings
         self.version = __version__
+        self.seed = game.seed
         self.actions_red  = [] # List of lists of red agents' actions
         self.actions_blue = [] # List of lists of blue agents' actions        
+        self.keyframes    = {} # Snapshots of the game by step, see Game.snapshot
+        self.digests      = array('I') # Checksum of the state after each step, see Game.digest
+
+    def play(self):
+        """ Convenience method for setting up a game to play this replay. 
+        """
+        g = Game(replay=self,rendered=True)
+        g.run()
+        return g
+
+class ReplayWriter(object):
+    """ Writes a compact binary replay while the game runs, one record
+        per step, so a replay never has to be held in memory. Pass a
+        path or file as ``replay_file`` to :class:`Game`, or use
+        :meth:`ReplayWriter.convert` on an existing :class:`ReplayData`.
+        
+        The file starts with a magic string and a compressed header with
+        the version, settings, field and team names. Each step is then
+        a record of a double precision turn and speed for every tank 
+        (red first), followed by the shoot flags packed as bits, so the
+        actions are stored exactly as the agents gave them. (Replays of 
+        older versions stored them as float32.)
+        Keyframes (see :meth:`Game.snapshot`) are kept until the replay
+        is closed, and then written after the steps, with an index and
+        a footer.
+    """
+    def __init__(self, f, settings, field, red_name, blue_name, tanks_red, tanks_blue,
+                 seed=RANDOMSEED):
+        """ Starts a replay and writes its header.
+            
+            :param f:          A path or an open file.
+            :param tanks_red:  The number of red tanks.
+            :param tanks_blue: The number of blue tanks.
+            :param seed:       The seed of the game, see :class:`Game`.
+        """
+        self.owned = isinstance(f, basestring)
+        self.file = open(f, 'wb') if self.owned else f
+        n = tanks_red + tanks_blue
+        self.record = struct.Struct('<%d%s%dB' % (2 * n, REPLAY_ACTIONS, (n + 7) // 8))
+        header = {'version': __version__,
+                  'actions': REPLAY_ACTIONS,
+                  'settings': settings,
+                  'field': str(field),
+                  'tilesize': field.tilesize,
+                  'field_hash': field.hash(),
+                  'red_name': red_name,
+                  'blue_name': blue_name,
+                  'tanks_red': tanks_red,
+                  'tanks_blue': tanks_blue,
+                  'seed': seed}
+        header = zlib.compress(pickle.dumps(header, pickle.HIGHEST_PROTOCOL))
+        self.file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, len(header)))
+        self.file.write(header)
+        self.size = REPLAY_HEADER.size + len(header)
+        self.keyframes = []
+        self.digests = array('I')
+    
+    def write_step(self, actions):
+        """ Appends a list of (turn, speed, shoot) actions, one for each
+            tank, red first.
+        """
+        values = []
+        bits = [0] * ((len(actions) + 7) // 8)
+        for i, (turn, speed, shoot) in enumerate(actions):
+            values.append(turn)
+            values.append(speed)
+            if shoot:
+                bits[i // 8] |= 1 << (i % 8)
+        self.file.write(self.record.pack(*(values + bits)))
+        self.size += self.record.size
+    
+    def add_keyframe(self, step, snapshot):
+        """ Adds a snapshot of the game after the given number of steps. """
+        self.keyframes.append((step, snapshot))
+    
+    def add_digest(self, digest):
+        """ Adds the digest of the state after the next step. """
+        self.digests.append(digest)
+    
+    def close(self):
+        """ Writes the keyframes and digests, and closes the file if 
+            the writer opened it, otherwise flushes it. 
+        """
+        if self.keyframes or self.digests:
+            end, index = self.size, {'keyframes': [], 'digests': None}
+            for (step, snapshot) in self.keyframes:
+                self.file.write(snapshot)
+                index['keyframes'].append((step, self.size, len(snapshot)))
+                self.size += len(snapshot)
+            digests = self.digests.tostring()
+            self.file.write(digests)
+            index['digests'] = (self.size, len(self.digests))
+            self.size += len(digests)
+            index = pickle.dumps(index, pickle.HIGHEST_PROTOCOL)
+            self.file.write(index)
+            self.file.write(REPLAY_FOOTER.pack(end, self.size, KEYFRAMES_MAGIC))
+            self.size += len(index) + REPLAY_FOOTER.size
+            self.keyframes = []
+            self.digests = array('I')
+        if self.owned:
+            self.file.close()
+        else:
+            self.file.flush()
+    
+    @classmethod
+    def convert(cls, replay, f):
+        """ Writes a :class:`ReplayData` to a binary replay. """
+        writer = cls(f, replay.settings, replay.field, replay.red_name, replay.blue_name,
+                     len(replay.actions_red), len(replay.actions_blue),
+                     getattr(replay, 'seed', RANDOMSEED))
+        for actions in zip(*(replay.actions_red + replay.actions_blue)):
+            writer.write_step(actions)
+        for step, snapshot in sorted(getattr(replay, 'keyframes', {}).items()):
+            writer.add_keyframe(step, snapshot)
+        writer.digests.extend(getattr(replay, 'digests', []))
+        writer.close()
+        
 
+class BinaryReplay(object):
+    """ A replay written by :class:`ReplayWriter`. It can be passed to
+        :class:`Game` as ``replay``, just like a :class:`ReplayData`. 
+        The actions are read from the file (or string) when they are 
+        used, without loading the whole replay.
+    """
+    def __init__(self, source):
+        """ Constructor for BinaryReplay class.
+            
+            :param source: A path, or a string with the replay data.
+        """
+        if source.startswith(REPLAY_MAGIC):
+            self.file = None
+            self.data = source
+        else:
+            self.file = open(source, 'rb')
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = REPLAY_HEADER.unpack_from(self.data, 0)
+        if magic != REPLAY_MAGIC:
+            raise ValueError("Not a binary replay.")
+        start = REPLAY_HEADER.size + length
+        header = pickle.loads(zlib.decompress(self.data[REPLAY_HEADER.size:start]))
+        self.version   = header['version']
+        self.settings  = header['settings']
+        self.red_name  = header['red_name']
+        self.blue_name = header['blue_name']
+        self.field_hash = header['field_hash']
+        self.seed      = header.get('seed', RANDOMSEED)
+        self.field = Field.from_string(header['field'])
+        self.field.tilesize = header['tilesize']
+        n_red, n = header['tanks_red'], header['tanks_red'] + header['tanks_blue']
+        #: The struct of one (turn, speed) pair
+        self.pair = struct.Struct('<2' + header.get('actions', 'f'))
+        self.record = struct.Struct('<%d%s%dB' % (2 * n, self.pair.format[-1], (n + 7) // 8))
+        # Look for keyframes and digests after the steps
+        end = len(self.data)
+        self.keyframes = {} #: Snapshots of the game by step, see :meth:`Game.snapshot`
+        self.digests = array('I') #: Checksums of the state after each step, see :meth:`Game.digest`
+        if end >= start + REPLAY_FOOTER.size:
+            steps_end, index, magic = REPLAY_FOOTER.unpack_from(self.data, end - REPLAY_FOOTER.size)
+            if magic == KEYFRAMES_MAGIC:
+                index = pickle.loads(self.data[index:end - REPLAY_FOOTER.size])
+                for (step, offset, length) in index['keyframes']:
+                    self.keyframes[step] = self.data[offset:offset + length]
+                offset, count = index['digests']
+                self.digests.fromstring(self.data[offset:offset + count * self.digests.itemsize])
+                end = steps_end
+        #: The number of steps in the replay
+        self.steps = (end - start) // self.record.size
+        self.start = start
+        tanks = [ReplayActions(self, i, n) for i in xrange(n)]
+        self.actions_red = tanks[:n_red]
+        self.actions_blue = tanks[n_red:]
+    
+    def step(self, i):
+        """ Returns the actions of all tanks at step i, red first. """
+        values = self.record.unpack_from(self.data, self.start + i * self.record.size)
+        n = len(self.actions_red) + len(self.actions_blue)
+        return [(values[2 * t], values[2 * t + 1], bool(values[2 * n + t // 8] & (1 << (t % 8))))
+                for t in xrange(n)]
+    
     def play(self):
         """ Convenience method for setting up a game to play this replay. 
         """
         g = Game(replay=self,rendered=True)
         g.run()
         return g
+        
+    def close(self):
+        if self.file is not None:
+            self.data.close()
+            self.file.close()
+
+
+class ReplayActions(object):
+    """ The actions of one tank in a :class:`BinaryReplay`, which
+        behaves like a read-only list of (turn, speed, shoot) tuples.
+    """
+    def __init__(self, replay, tank, tanks):
+        self.replay = replay
+        self.offset = replay.pair.size * tank
+        self.bit    = (replay.pair.size * tanks + tank // 8, 1 << (tank % 8))
+    
+    def __len__(self):
+        return self.replay.steps
+    
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.replay.steps
+        if not 0 <= i < self.replay.steps:
+            raise IndexError("replay step out of range")
+        at = self.replay.start + i * self.replay.record.size
+        turn, speed = self.replay.pair.unpack_from(self.replay.data, at + self.offset)
+        flags = struct.unpack_from('<B', self.replay.data, at + self.bit[0])[0]
+        return (turn, speed, bool(flags & self.bit[1]))
+    
+    def __iter__(self):
+        for i in xrange(self.replay.steps):
+            yield self[i]
+
+class StateTrace(object):
+    """ The state of the game after every step, stored by column in 
+        arrays that are allocated before the game starts, so that 
+        keeping it costs very little time. Play a game with 
+        ``trace=True`` to get one as ``game.trace``.
+        
+        The columns (with their shape) are:
+        
+        ===========  ==============  ============================================
+        x, y, angle  (steps, tanks)  Position and heading of each tank
+        ammo         (steps, tanks)  Ammo of each tank
+        alive        (steps, tanks)  Whether the tank was on the field
+        shots        (steps, tanks)  Whether the tank shot
+        hits         (steps, tanks)  The team the tank hit, or -1
+        cps          (steps, cps)    The team that owned each controlpoint
+        score_red    (steps,)        Red's score
+        score_blue   (steps,)        Blue's score
+        team         (tanks,)        The team of each tank
+        ===========  ==============  ============================================
+        
+        :meth:`save` writes them to an ``.npz`` file (without needing
+        numpy), so that analysis scripts can ``numpy.load`` them.
+    """
+    COLUMNS = {'x': 'f', 'y': 'f', 'angle': 'f', 'ammo': 'i', 'alive': 'B',
+               'shots': 'B', 'hits': 'b', 'cps': 'B', 'score_red': 'i',
+               'score_blue': 'i', 'team': 'B'}
+    DTYPES  = {'f': '<f4', 'i': '<i4', 'b': '|i1', 'B': '|u1'}
+    BOOLEAN = ('alive', 'shots')
+    
+    def __init__(self, steps, tanks, cps):
+        self.steps = 0
+        self.tanks = tanks
+        self.cps = cps
+        self.columns = {}
+        for name, typecode in self.COLUMNS.iteritems():
+            width = self.width(name)
+            self.columns[name] = array(typecode, [0]) * (steps * width)
+        self.columns['team'] = array('B')
+    
+    def width(self, name):
+        """ The number of values per step in a column. """
+        if name == 'cps':
+            return self.cps
+        if name.startswith('score'):
+            return 1
+        return self.tanks
+    
+    def add_step(self, game):
+        """ Stores the state of the game after its current step. """
+        c, i, n = self.columns, self.steps * self.tanks, self.tanks
+        x, y, angle, ammo = c['x'], c['y'], c['angle'], c['ammo']
+        alive, shots, hits = c['alive'], c['shots'], c['hits']
+        for k, t in enumerate(game.tanks):
+            x[i + k], y[i + k], angle[i + k] = t.x, t.y, t.angle
+            ammo[i + k] = t.ammo
+            alive[i + k] = (t.respawn_in == -1)
+            shots[i + k] = t.shoots
+            hits[i + k] = -1 if t.hit is None else t.hit
+        j = self.steps * self.cps
+        for k, cp in enumerate(game.controlpoints):
+            c['cps'][j + k] = cp.team
+        c['score_red'][self.steps] = game.score_red
+        c['score_blue'][self.steps] = game.score_blue
+        self.steps += 1
+    
+    def column(self, name):
+        """ Returns the values of a column for the steps that were played, 
+            as a flat array.
+        """
+        if name == 'team':
+            return self.columns[name]
+        return self.columns[name][:self.steps * self.width(name)]
+    
+    def shape(self, name):
+        if name == 'team':
+            return (self.tanks,)
+        if name.startswith('score'):
+            return (self.steps,)
+        return (self.steps, self.width(name))
+    
+    def save(self, f):
+        """ Writes the trace to a path or file, as a numpy ``.npz`` file. """
+        zipf = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+        for name in sorted(self.columns):
+            values = self.column(name)
+            if sys.byteorder == 'big':
+                values = array(values.typecode, values)
+                values.byteswap()
+            dtype = '|b1' if name in self.BOOLEAN else self.DTYPES[values.typecode]
+            header = "{'descr': '%s', 'fortran_order': False, 'shape': %r, }" % (dtype, self.shape(name))
+            # Pad so the data starts at a multiple of 16 bytes
+            header += ' ' * (-(len(header) + 11) % 16) + '\n'
+            npy = '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header + values.tostring()
+            zipf.writestr(name + '.npy', npy)
+        zipf.close()
+    
+    @classmethod
+    def load(cls, f):
+        """ Reads a trace written by :meth:`save`. With numpy, 
+            ``numpy.load(f)`` works too.
+        """
+        zipf = zipfile.ZipFile(f)
+        typecodes = dict((dtype, typecode) for (typecode, dtype) in cls.DTYPES.iteritems())
+        typecodes['|b1'] = 'B'
+        columns, shapes = {}, {}
+        for entry in zipf.namelist():
+            npy = zipf.read(entry)
+            length = struct.unpack_from('<H', npy, 8)[0]
+            header = ast.literal_eval(npy[10:10 + length])
+            name = entry[:-len('.npy')]
+            columns[name] = array(typecodes[header['descr']], npy[10 + length:])
+            if sys.byteorder == 'big':
+                columns[name].byteswap()
+            shapes[name] = header['shape']
+        zipf.close()
+        trace = cls(0, shapes['x'][1], shapes['cps'][1])
+        trace.columns = columns
+        trace.steps = shapes['x'][0]
+        return trace
+
+### FUNCTIONS ###
+
+def verify_replay(replay):
+    """ Plays a replay without rendering, and returns the first step
+        where it differs from the game it was recorded from, or None
+        if it is the same.
+    """
+    if not getattr(replay, 'digests', None):
+        raise ValueError("Replay has no digests to check against.")
+    game = Game(replay=replay, rendered=False, verbose=False)
+    game._setup()
+    try:
+        for s in xrange(game.settings.max_steps):
+            if not game._step(s) or game.diverged is not None:
+                break
+    finally:
+        sys.stdout = game.old_stdout
+    return game.diverged
+
+def load_replay(source):
+    """ Loads a replay from a path, either a :class:`BinaryReplay` or
+        a pickled :class:`ReplayData`.
+    """
+    f = open(source, 'rb')
+    magic = f.read(len(REPLAY_MAGIC))
+    if magic == REPLAY_MAGIC:
+        f.close()
+        return BinaryReplay(source)
+    f.seek(0)
+    try:
+        return load_replay_data(f.read())
+    finally:
+        f.close()
+
+def load_replay_data(data):
+    """ Loads a replay from a string, either a :class:`BinaryReplay` or
+        a pickled :class:`ReplayData`. Pickles refer to ``domination.core``,
+        which is mapped to the core module that is loaded here, so they
+        load from anywhere.
+    """
+    if data.startswith(REPLAY_MAGIC):
+        return BinaryReplay(data)
+    def find_global(module, name):
+        if module.startswith('domination.'):
+            module = module[len('domination.'):]
+        if module == 'core':
+            module = __name__
+        __import__(module)
+        return getattr(sys.modules[module], name)
+    unpickler = pickle.Unpickler(StringIO(data))
+    unpickler.find_global = find_global
+    return unpickler.load()
 
 if __name__ == "__main__":
     g = Game(verbose=True, rendered=True).run()
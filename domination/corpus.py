@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+""" Domination game engine for Reinforcement Learning research.
+
+Contains functions for generating a corpus of fields ahead of time, so
+that games don't have to wait for a field to be generated, and so that
+different agents can be compared on exactly the same fields.
+
+A corpus is a single file. It starts with a header and an index of
+(seed, offset, length) entries, followed by one compressed record for each
+field, holding the tiles and the unpacked wall rects, nav mesh, grid
+and regions.
+The file is memory mapped when it is read, so only the fields that are
+used are loaded.
+
+"""
+
+### IMPORTS ###
+# Python
+import sys
+import random
+import struct
+import mmap
+import zlib
+import argparse
+import multiprocessing
+import cPickle as pickle
+
+# Local
+import core
+
+### CONSTANTS ###
+
+MAGIC  = 'DOMCORP1'
+HEADER = struct.Struct('<8sI')   # Magic, number of fields
+ENTRY  = struct.Struct('<qQI')   # Seed, offset, length
+
+### CLASSES ###
+
+class FieldCorpus(object):
+    """ A corpus of fields that have been generated and unpacked
+        beforehand. Made with :func:`build_corpus`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a field corpus." % path)
+        self.index = [ENTRY.unpack_from(self.data, HEADER.size + i * ENTRY.size)
+                      for i in xrange(count)]
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def seeds(self):
+        """ The seed each field was generated from. """
+        return [seed for (seed, _, _) in self.index]
+
+    def field(self, i):
+        """ Returns the i-th field of the corpus, already unpacked. """
+        if not 0 <= i < len(self.index):
+            raise IndexError("Field %d is not in the corpus of %d fields." % (i, len(self.index)))
+        seed, offset, length = self.index[i]
+        record = pickle.loads(zlib.decompress(self.data[offset:offset + length]))
+        field = core.Field.from_string(record['tiles'])
+        field.tilesize = record['tilesize']
+        field.unpack(cached=record['unpacked'])
+        return field
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+### FUNCTIONS ###
+
+def generate_field(seed, generator=None):
+    """ Generates a field from the given seed. The same seed and
+        generator settings always give the same field.
+    """
+    if generator is None:
+        generator = core.FieldGenerator()
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        return generator.generate()
+    finally:
+        random.setstate(state)
+
+def _generate_record((seed, generator)):
+    """ Generates and unpacks a field, and packs it into a corpus record.
+        This runs in the worker processes.
+    """
+    field = generate_field(seed, generator)
+    # Regions are only found when they are first asked for, this makes
+    # sure that they are part of the unpacked data that is stored.
+    field.regions
+    record = {'tiles': str(field),
+              'tilesize': field.tilesize,
+              'unpacked': field.unpacked_data()}
+    return seed, zlib.compress(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+
+def build_corpus(path, seeds, generator=None, processes=None):
+    """ Generates a field for each seed, and writes them all to a
+        corpus file.
+
+        :param path:      The file to write the corpus to.
+        :param seeds:     A list of seeds, one for each field.
+        :param generator: The :class:`~domination.core.FieldGenerator` to use.
+        :param processes: The number of processes to generate fields in,
+                          defaults to the number of CPUs.
+    """
+    seeds = list(seeds)
+    jobs = [(seed, generator) for seed in seeds]
+    if processes == 1:
+        pool = None
+        records = map(_generate_record, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        records = pool.imap(_generate_record, jobs)
+    f = open(path, 'wb')
+    # Leave room for the index, which is written at the end.
+    offset = HEADER.size + ENTRY.size * len(seeds)
+    f.write('\0' * offset)
+    index = []
+    for seed, data in records:
+        f.write(data)
+        index.append(ENTRY.pack(seed, offset, len(data)))
+        offset += len(data)
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, len(seeds)))
+    f.write(''.join(index))
+    f.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+### MAIN ###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a corpus of fields.")
+    parser.add_argument('path', help="File to write the corpus to")
+    parser.add_argument('-n', '--num', type=int, default=100, help="Number of fields")
+    parser.add_argument('-s', '--seed', type=int, default=0, help="Seed of the first field")
+    parser.add_argument('-j', '--processes', type=int, default=None, help="Number of processes")
+    args = parser.parse_args()
+    build_corpus(args.path, xrange(args.seed, args.seed + args.num), processes=args.processes)
+    print "Wrote %d fields to %s" % (args.num, args.path)
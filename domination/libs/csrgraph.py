@@ -0,0 +1,193 @@
+""" Compact graphs for fast shortest path searches.
+
+A CSRGraph stores a static graph in "compressed sparse row" form: nodes are
+integers, the neighbors of node n are targets[offsets[n]:offsets[n+1]], with
+the matching edge weights in weights. Node coordinates are kept in flat arrays
+so that the A* heuristic does not need to call back into Python functions.
+Use :func:`~domination.libs.astar.astar` for arbitrary graphs.
+"""
+
+from array import array
+from heapq import heappush, heappop
+from sys import maxint
+
+# Shortcuts
+try:
+    inf = float('inf')
+except ValueError:
+    inf = 1e1000000
+
+
+class CSRGraph(object):
+
+    """ A static graph with integer node ids.
+
+        >>> mesh = {(0, 0): {(3, 0): 3.0, (0, 4): 4.0},
+        ...         (3, 0): {(0, 0): 3.0, (3, 4): 4.0},
+        ...         (0, 4): {(0, 0): 4.0},
+        ...         (3, 4): {(3, 0): 4.0}}
+        >>> graph = CSRGraph.from_mesh(mesh)
+        >>> nodes, length = graph.astar(graph.node((0, 4)), graph.node((3, 4)))
+        >>> [graph.positions[n] for n in nodes], length
+        ([(0, 0), (3, 0), (3, 4)], 11.0)
+    """
+
+    def __init__(self, positions, offsets, targets, weights):
+        """ Constructor for CSRGraph class.
+
+            :param positions: A list of (x, y) coordinates, one for each node.
+            :param offsets:   Start of each node's edges in targets/weights,
+                              with one extra element at the end.
+            :param targets:   Flat array of edge endpoints.
+            :param weights:   Flat array of edge weights.
+        """
+        self.positions = [tuple(p) for p in positions]
+        self.xs        = array('d', (p[0] for p in self.positions))
+        self.ys        = array('d', (p[1] for p in self.positions))
+        self.offsets   = array('l', offsets)
+        self.targets   = array('l', targets)
+        self.weights   = array('d', weights)
+        self.index     = dict((p, n) for (n, p) in enumerate(self.positions))
+
+    @classmethod
+    def from_mesh(cls, mesh):
+        """ Converts a dict-of-dicts mesh, like the one made by
+            :func:`~domination.utilities.make_nav_mesh`.
+        """
+        positions = sorted(mesh)
+        index = dict((p, n) for (n, p) in enumerate(positions))
+        offsets, targets, weights = [0], [], []
+        for p in positions:
+            for q, w in sorted(mesh[p].items()):
+                targets.append(index[q])
+                weights.append(w)
+            offsets.append(len(targets))
+        return cls(positions, offsets, targets, weights)
+
+    @classmethod
+    def from_arrays(cls, xs, ys, offsets, targets, weights):
+        """ Makes a graph that uses the given arrays as they are, without
+            copying them, so that they can live in shared memory (see
+            :mod:`domination.shared`). Any sequence that supports indexing
+            works, like an array or a numpy array.
+        """
+        graph = cls.__new__(cls)
+        graph.positions = [(float(x), float(y)) for (x, y) in zip(xs, ys)]
+        graph.xs, graph.ys = xs, ys
+        graph.offsets, graph.targets, graph.weights = offsets, targets, weights
+        graph.index = dict((p, n) for (n, p) in enumerate(graph.positions))
+        return graph
+
+    def __len__(self):
+        return len(self.positions)
+
+    def node(self, pos):
+        """ Returns the id of the node at the given position. """
+        return self.index[pos]
+
+    def neighbors(self, n):
+        """ Returns a list of (node, weight) tuples. """
+        o0, o1 = self.offsets[n], self.offsets[n + 1]
+        return zip(self.targets[o0:o1], self.weights[o0:o1])
+
+    def shortest_path(self, sources, targets, point=None, limit=maxint):
+        """ Finds the shortest path from any of the sources to any of the
+            targets.
+
+            Arguments:
+
+              sources  - A list of (node, cost) tuples, the cost of getting
+                         from the actual start to each of these nodes.
+              targets  - A dictionary of {node: cost}, the cost of getting
+                         from each of these nodes to the actual goal.
+              point    - The (x, y) coordinate of the goal, used for the
+                         heuristic. Without it the search is a Dijkstra.
+              limit    - The maximum number of nodes to expand.
+
+            Returns the list of nodes on the path and its length. If no
+            target can be reached, the path towards the node closest to
+            point is returned, with an infinite length, like
+            :func:`~domination.libs.astar.astar` does.
+        """
+        xs, ys = self.xs, self.ys
+        offsets, tgts, weights = self.offsets, self.targets, self.weights
+        n = len(self.positions)
+        g = [inf] * n
+        parent = [-1] * n
+        closed = [False] * n
+        if point is None:
+            h = lambda m: 0.0
+        else:
+            px, py = point
+            h = lambda m: ((xs[m] - px) ** 2 + (ys[m] - py) ** 2) ** 0.5
+        heap = []
+        for (m, c) in sources:
+            if c < g[m]:
+                g[m] = c
+                heappush(heap, (c + h(m), c, m))
+        best, best_h = -1, inf
+        goal_g, goal_parent = inf, -1
+        expanded = 0
+        while heap and expanded < limit:
+            f, gu, u = heappop(heap)
+            if u == -1:
+                # Popped the virtual goal, nothing can be shorter.
+                break
+            if closed[u] or gu > g[u]:
+                continue
+            closed[u] = True
+            expanded += 1
+            hu = f - gu
+            if hu < best_h:
+                best, best_h = u, hu
+            if u in targets:
+                gt = gu + targets[u]
+                if gt < goal_g:
+                    goal_g, goal_parent = gt, u
+                    heappush(heap, (gt, gt, -1))
+            for k in xrange(offsets[u], offsets[u + 1]):
+                v = tgts[k]
+                gv = gu + weights[k]
+                if gv < g[v]:
+                    g[v] = gv
+                    parent[v] = u
+                    heappush(heap, (gv + h(v), gv, v))
+        end = goal_parent if goal_parent != -1 else best
+        path = []
+        while end != -1:
+            path.append(end)
+            end = parent[end]
+        path.reverse()
+        return path, goal_g
+
+    def astar(self, start, goal, limit=maxint):
+        """ Shortest path between two nodes, returns the path (excluding
+            start) and its length.
+        """
+        if start == goal:
+            return [], 0.0
+        nodes, length = self.shortest_path([(start, 0.0)], {goal: 0.0},
+                                           self.positions[goal], limit)
+        return nodes[1:], length
+
+    def dijkstra(self, sources):
+        """ Returns the distance to each node from the closest of the
+            given source nodes, as an array.
+        """
+        offsets, tgts, weights = self.offsets, self.targets, self.weights
+        dist = array('d', [inf]) * len(self.positions)
+        heap = []
+        for m in sources:
+            dist[m] = 0.0
+            heap.append((0.0, m))
+        while heap:
+            d, u = heappop(heap)
+            if d > dist[u]:
+                continue
+            for k in xrange(offsets[u], offsets[u + 1]):
+                v = tgts[k]
+                dv = d + weights[k]
+                if dv < dist[v]:
+                    dist[v] = dv
+                    heappush(heap, (dv, v))
+        return dist
@@ -0,0 +1,187 @@
+""" Incremental shortest path planning with D* Lite.
+
+Based on "D* Lite" by Sven Koenig and Maxim Likhachev (AAAI 2002). The
+planner searches backwards from the goal, so that its search state stays
+valid when the start moves. A goal that moves is treated as a change in the
+cost of a (virtual) edge to the goal, so the search is repaired rather than
+restarted as well.
+"""
+
+from heapq import heappush, heappop
+from sys import maxint
+
+# Shortcuts
+try:
+    inf = float('inf')
+except ValueError:
+    inf = 1e1000000
+
+# Keys are sums of costs added up in different orders, so they are rounded
+# to this many digits. Otherwise rounding errors in the first element of a
+# key can defeat the tie-breaking on the second element.
+KEY_DIGITS = 9
+
+
+class DStarLite(object):
+
+    """ Keeps the search state for repeatedly finding a path between a
+        moving start and a moving goal on the same graph.
+
+        Arguments:
+
+          neighbors(pos)    - A function returning all neighbor positions of
+                              the given position. The graph is assumed to be
+                              undirected.
+          cost(a, b)        - A function returning the cost for moving from
+                              one position to another.
+          heuristic(a, b)   - A function returning an estimate of the cost of
+                              moving from a to b. Must not overestimate.
+
+        >>> line = lambda p: [n for n in (p-1, p+1) if 0 <= n <= 10]
+        >>> planner = DStarLite(line, lambda a, b: 1, lambda a, b: abs(a-b))
+        >>> planner.plan(2, 5)
+        ([3, 4, 5], 3)
+        >>> planner.plan(3, 6)
+        ([4, 5, 6], 3)
+    """
+
+    def __init__(self, neighbors, cost, heuristic):
+        self.neighbors = neighbors
+        self.cost      = cost
+        self.heuristic = heuristic
+        self.reset()
+
+    def reset(self):
+        """ Throws away all search state. """
+        self.g       = {}
+        self.rhs     = {}
+        self.queue   = []
+        self.queued  = {}  # Current key of each position in the queue
+        self.km      = 0
+        self.start   = None
+        self.last    = None
+        self.goal    = None
+        self.nums    = iter(xrange(maxint))
+
+    def _key(self, s):
+        m = min(self.g.get(s, inf), self.rhs.get(s, inf))
+        return (round(m + self.heuristic(self.start, s) + self.km, KEY_DIGITS),
+                round(m, KEY_DIGITS))
+
+    def _push(self, s):
+        key = self._key(s)
+        self.queued[s] = key
+        heappush(self.queue, (key, self.nums.next(), s))
+
+    def _update_vertex(self, u):
+        if u == self.goal:
+            self.rhs[u] = 0
+        else:
+            g, cost = self.g, self.cost
+            best = inf
+            for s in self.neighbors(u):
+                c = cost(u, s) + g.get(s, inf)
+                if c < best:
+                    best = c
+            self.rhs[u] = best
+        # Queue entries are invalidated lazily, by comparing to self.queued
+        self.queued.pop(u, None)
+        if self.g.get(u, inf) != self.rhs.get(u, inf):
+            self._push(u)
+
+    def _top(self):
+        """ Discard stale queue entries, returns the top key. """
+        queue, queued = self.queue, self.queued
+        while queue and queued.get(queue[0][2]) != queue[0][0]:
+            heappop(queue)
+        return queue[0][0] if queue else (inf, inf)
+
+    def _compute(self, limit):
+        """ Expands positions until the start is consistent, or the limit is
+            reached. Returns whether the search completed.
+        """
+        g, rhs, start = self.g, self.rhs, self.start
+        expanded = 0
+        while (self._top() < self._key(start) or
+               rhs.get(start, inf) != g.get(start, inf)):
+            if expanded >= limit:
+                return False
+            expanded += 1
+            k_old, _, u = heappop(self.queue)
+            del self.queued[u]
+            k_new = self._key(u)
+            if k_old < k_new:
+                self._push(u)
+            elif g.get(u, inf) > rhs.get(u, inf):
+                g[u] = rhs[u]
+                for s in self.neighbors(u):
+                    self._update_vertex(s)
+            else:
+                g[u] = inf
+                self._update_vertex(u)
+                for s in self.neighbors(u):
+                    self._update_vertex(s)
+        return True
+
+    def update(self, positions):
+        """ Tells the planner that the costs of the edges around the
+            given positions have changed.
+        """
+        if self.goal is None:
+            return
+        for u in positions:
+            self._update_vertex(u)
+            for s in self.neighbors(u):
+                self._update_vertex(s)
+
+    def plan(self, start, goal, limit=maxint):
+        """ Find the shortest path from start to goal, reusing the search
+            state of previous calls.
+
+            Arguments:
+
+              start   - The starting position.
+              goal    - The goal position.
+              limit   - The maximum number of positions to expand in this
+                        call. If the search is not complete, it is resumed
+                        by the next call.
+
+            Returns the path (excluding start) and its length, like
+            :func:`~domination.libs.astar.astar`. If the search could not
+            be completed within the limit, the best path known so far is
+            returned with an infinite length.
+        """
+        if self.goal is None:
+            self.start = self.last = start
+            self.goal = goal
+            self._update_vertex(goal)
+        else:
+            if start != self.start:
+                self.start = start
+                self.km += self.heuristic(self.last, start)
+                self.last = start
+            if goal != self.goal:
+                # Moving the goal changes the cost of reaching it from
+                # the old and the new goal position only.
+                old, self.goal = self.goal, goal
+                self._update_vertex(old)
+                self._update_vertex(goal)
+        complete = self._compute(limit)
+        # Follow the gradient of g from the start to the goal.
+        g, cost = self.g, self.cost
+        path, seen = [], set([start])
+        current = start
+        while current != goal:
+            best, best_cost = None, inf
+            for s in self.neighbors(current):
+                c = cost(current, s) + g.get(s, inf)
+                if c < best_cost and s not in seen:
+                    best, best_cost = s, c
+            if best is None:
+                break
+            path.append(best)
+            seen.add(best)
+            current = best
+        if complete and current == goal:
+            return path, self.rhs.get(start, inf)
+        return path, inf
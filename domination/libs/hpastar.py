@@ -0,0 +1,298 @@
+""" Hierarchical path planning on large tile grids.
+
+An implementation of HPA* ("Near Optimal Hierarchical Path-Finding" by Adi
+Botea, Martin Mueller and Jonathan Schaeffer, 2004). The grid is split into
+square clusters. Where two clusters touch, each open stretch of border is an
+entrance, with one or two transition tiles on either side. The distances
+between the transition tiles inside each cluster are computed once, which
+gives a small abstract graph that paths are planned on. Only the stretches of
+the path that are needed are then refined into tiles.
+
+Moves are 8-connected, but never cut the corner of a wall, like the tanks
+would get stuck on it. Paths through the transition tiles can take long
+detours, especially on cluttered grids, so the tiles are not taken from the
+abstract path directly. Instead, the clusters it passes through, and the ones
+around them, form a corridor that an exact search on the grid is confined to.
+That path is never longer than the abstract one, and almost always as short
+as the shortest path on the full grid.
+"""
+
+from heapq import heappush, heappop
+
+# Shortcuts
+try:
+    inf = float('inf')
+except ValueError:
+    inf = 1e1000000
+
+DIAGONAL = 2 ** 0.5
+DIRECTIONS = ((0,1),(0,-1),(1,0),(-1,0),(1,1),(1,-1),(-1,1),(-1,-1))
+
+
+def octile((ax, ay), (bx, by)):
+    """ Shortest distance between two tiles on an empty grid. """
+    dx, dy = abs(ax - bx), abs(ay - by)
+    return (dx + dy) + (DIAGONAL - 2) * min(dx, dy)
+
+
+class HierarchicalPlanner(object):
+
+    """ Plans paths on a (large) wall grid using a precomputed abstract graph.
+
+        >>> grid = [[0,0,0,0,0,0],
+        ...         [0,0,1,0,0,0],
+        ...         [0,0,1,0,0,0],
+        ...         [0,0,1,1,0,0]]
+        >>> planner = HierarchicalPlanner(grid, tilesize=1, cluster_size=3)
+        >>> sorted(planner.transitions[(0, 0)])
+        [(1, 2), (2, 0)]
+        >>> planner.find_path((0.5, 3.5), (4.5, 2.5))
+        [(1.5, 0.5), (3.5, 0.5), (4.5, 2.5)]
+    """
+
+    def __init__(self, grid, tilesize=16, cluster_size=10, max_entrance=6):
+        """ Constructor for HierarchicalPlanner class. This builds the
+            abstract graph, which takes a while on large grids.
+
+            :param grid:         The wall grid, 1 for walls.
+            :param tilesize:     Size of each tile in game units.
+            :param cluster_size: Width and height of the clusters in tiles.
+            :param max_entrance: Entrances at least this wide get a transition
+                                 at both ends instead of one in the middle.
+        """
+        self.grid         = grid
+        self.tilesize     = tilesize
+        self.cluster_size = cs = cluster_size
+        self.width        = w = len(grid[0])
+        self.height       = h = len(grid)
+        self.graph        = {}  # Abstract graph: graph[tile][tile] = cost
+        self.transitions  = {}  # Transition tiles in each cluster
+        # Find entrances along the borders between clusters
+        for x in xrange(cs, w, cs):
+            self._add_entrances([((x - 1, y), (x, y)) for y in xrange(h)], max_entrance)
+        for y in xrange(cs, h, cs):
+            self._add_entrances([((x, y - 1), (x, y)) for x in xrange(w)], max_entrance)
+        # Connect the transitions within each cluster
+        for cluster, tiles in self.transitions.iteritems():
+            bounds = self._bounds(cluster)
+            for i, a in enumerate(tiles):
+                dist, _ = self._dijkstra(a, bounds, tiles[i + 1:])
+                for b in tiles[i + 1:]:
+                    if b in dist:
+                        self.graph[a][b] = self.graph[b][a] = dist[b]
+
+    def _add_entrances(self, pairs, max_entrance):
+        """ Adds transitions for runs of pairs of tiles on either side
+            of a border that are both free.
+        """
+        grid, runs = self.grid, [[]]
+        for (a, b) in pairs:
+            if grid[a[1]][a[0]] or grid[b[1]][b[0]]:
+                runs.append([])
+                continue
+            # Runs also end where the border between clusters ends.
+            if runs[-1] and self._cluster(runs[-1][-1][0]) != self._cluster(a):
+                runs.append([])
+            runs[-1].append((a, b))
+        for run in runs:
+            if not run:
+                continue
+            if len(run) >= max_entrance:
+                chosen = [run[0], run[-1]]
+            else:
+                chosen = [run[len(run) // 2]]
+            for (ta, tb) in chosen:
+                for t in (ta, tb):
+                    if t not in self.graph:
+                        self.graph[t] = {}
+                        self.transitions.setdefault(self._cluster(t), []).append(t)
+                self.graph[ta][tb] = self.graph[tb][ta] = 1
+
+    def _cluster(self, (x, y)):
+        return (x // self.cluster_size, y // self.cluster_size)
+
+    def _bounds(self, (cx, cy)):
+        cs = self.cluster_size
+        return (cx * cs, cy * cs, min(self.width, (cx + 1) * cs), min(self.height, (cy + 1) * cs))
+
+    def _neighbors(self, (x, y), (x0, y0, x1, y1), clusters=None):
+        grid, cs = self.grid, self.cluster_size
+        for dx, dy in DIRECTIONS:
+            nx, ny = x + dx, y + dy
+            if x0 <= nx < x1 and y0 <= ny < y1 and not grid[ny][nx]:
+                if dx and dy and (grid[y][nx] or grid[ny][x]):
+                    continue
+                if clusters is not None and (nx // cs, ny // cs) not in clusters:
+                    continue
+                yield (nx, ny), (DIAGONAL if dx and dy else 1)
+
+    def _dijkstra(self, source, bounds, targets=()):
+        """ Distances and parents from source to tiles within bounds, stops
+            once all targets have been reached.
+        """
+        dist, parent = {source: 0}, {source: None}
+        left = set(targets)
+        left.discard(source)
+        heap = [(0, source)]
+        closed = set()
+        while heap and (left or not targets):
+            d, u = heappop(heap)
+            if u in closed:
+                continue
+            closed.add(u)
+            left.discard(u)
+            for v, c in self._neighbors(u, bounds):
+                if d + c < dist.get(v, inf):
+                    dist[v] = d + c
+                    parent[v] = u
+                    heappush(heap, (d + c, v))
+        return dist, parent
+
+    def _local_path(self, a, b, bounds, clusters=None):
+        """ A* from a to b within bounds (and the given clusters, if any),
+            returns tiles excluding a.
+        """
+        g, parent = {a: 0}, {a: None}
+        heap = [(octile(a, b), 0, a)]
+        while heap:
+            _, d, u = heappop(heap)
+            if u == b:
+                break
+            if d > g[u]:
+                continue
+            for v, c in self._neighbors(u, bounds, clusters):
+                if d + c < g.get(v, inf):
+                    g[v] = d + c
+                    parent[v] = u
+                    heappush(heap, (d + c + octile(v, b), d + c, v))
+        if b not in parent:
+            return None, inf
+        return self._trace(parent, b), g[b]
+
+    def _corridor_path(self, start, goal, tiles):
+        """ The shortest path from start to goal through the clusters of
+            the given tiles and the clusters around them.
+        """
+        clusters = set()
+        for (cx, cy) in set(self._cluster(t) for t in tiles):
+            clusters.update((cx + dx, cy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+        return self._local_path(start, goal, (0, 0, self.width, self.height), clusters)
+
+    def _trace(self, parent, tile):
+        path = []
+        while parent[tile] is not None:
+            path.append(tile)
+            tile = parent[tile]
+        path.reverse()
+        return path
+
+    def find_tile_path(self, start, goal, refine=None):
+        """ Finds a path between two tiles.
+
+            Arguments:
+
+              start   - The starting tile (x, y).
+              goal    - The goal tile (x, y).
+              refine  - The number of abstract steps to turn into tiles,
+                        all of them if None. The steps after that are
+                        given as just the transition tiles.
+
+            Returns the path (excluding start) and its length. The path
+            is None if the goal can't be reached.
+        """
+        grid = self.grid
+        if grid[start[1]][start[0]] or grid[goal[1]][goal[0]]:
+            return None, inf
+        if start == goal:
+            return [], 0
+        cs, cg = self._cluster(start), self._cluster(goal)
+        local, local_cost = None, inf
+        if cs == cg:
+            local, local_cost = self._local_path(start, goal, self._bounds(cs))
+        # Connect start and goal to the transitions of their clusters.
+        sdist, sparent = self._dijkstra(start, self._bounds(cs), self.transitions.get(cs, ()))
+        gdist, gparent = self._dijkstra(goal, self._bounds(cg), self.transitions.get(cg, ()))
+        targets = dict((t, gdist[t]) for t in self.transitions.get(cg, ()) if t in gdist)
+        # A* on the abstract graph, with a virtual node for the goal.
+        g, parent, heap = {}, {}, []
+        for t in self.transitions.get(cs, ()):
+            if t in sdist:
+                g[t], parent[t] = sdist[t], None
+                heappush(heap, (sdist[t] + octile(t, goal), sdist[t], t))
+        best, best_cost = None, local_cost
+        while heap:
+            f, d, u = heappop(heap)
+            if f >= best_cost:
+                break
+            if u is None:
+                best, best_cost = parent[None], d
+                break
+            if d > g[u]:
+                continue
+            if u in targets and d + targets[u] < g.get(None, inf):
+                g[None], parent[None] = d + targets[u], u
+                heappush(heap, (d + targets[u], d + targets[u], None))
+            for v, c in self.graph[u].iteritems():
+                if d + c < g.get(v, inf):
+                    g[v] = d + c
+                    parent[v] = u
+                    heappush(heap, (d + c + octile(v, goal), d + c, v))
+        if best is None:
+            if local is None:
+                return None, inf
+            return self._corridor_path(start, goal, [start])
+        abstract = [best]
+        while parent[abstract[-1]] is not None:
+            abstract.append(parent[abstract[-1]])
+        abstract.reverse()
+        # Refine the first steps of the abstract path, through a corridor
+        # around them, and give the transitions after that.
+        if refine is None or refine >= len(abstract):
+            return self._corridor_path(start, goal, [start, goal] + abstract)
+        path, cost = self._corridor_path(start, abstract[refine], [start] + abstract[:refine + 1])
+        return path + abstract[refine + 1:] + [goal], best_cost
+
+    def visible(self, (x0, y0), (x1, y1)):
+        """ Whether the straight line between the centers of two tiles
+            stays clear of walls. Lines through the corner between two
+            tiles need both of them to be free.
+        """
+        grid = self.grid
+        nx, ny = abs(x1 - x0), abs(y1 - y0)
+        sx, sy = (1 if x1 > x0 else -1), (1 if y1 > y0 else -1)
+        x, y, ix, iy = x0, y0, 0, 0
+        while ix < nx or iy < ny:
+            decision = (1 + 2 * ix) * ny - (1 + 2 * iy) * nx
+            if decision == 0:
+                if grid[y][x + sx] or grid[y + sy][x]:
+                    return False
+                x, y, ix, iy = x + sx, y + sy, ix + 1, iy + 1
+            elif decision < 0:
+                x, ix = x + sx, ix + 1
+            else:
+                y, iy = y + sy, iy + 1
+            if grid[y][x]:
+                return False
+        return True
+
+    def find_path(self, start, end, refine=None):
+        """ Returns a list of waypoints from start to end, in game units,
+            like :func:`~domination.utilities.find_path` does. The tile
+            path is shortened by skipping over tiles that can be seen
+            from an earlier waypoint.
+        """
+        ts = self.tilesize
+        s = (int(start[0] // ts), int(start[1] // ts))
+        e = (int(end[0] // ts), int(end[1] // ts))
+        tiles, length = self.find_tile_path(s, e, refine)
+        if tiles is None:
+            return []
+        waypoints = []
+        anchor, last = s, s
+        for tile in tiles:
+            if not self.visible(anchor, tile):
+                waypoints.append(((last[0] + 0.5) * ts, (last[1] + 0.5) * ts))
+                anchor = last
+            last = tile
+        waypoints.append(end)
+        return waypoints
@@ -11,19 +11,30 @@ import datetime
 import sys
 import os
 import csv
+import json
 import glob
 import cPickle as pickle
 import zipfile
+from cStringIO import StringIO
 import math
+import random
+import tempfile
+import multiprocessing
 from collections import defaultdict
 
 # Local
 import core
+import corpus
+import shared
 from utilities import *
+from libs import trueskill
 
 # Shortcuts
 pi = math.pi
 
+#: What :func:`verify_replays` gives for replays without digests to check
+NO_DIGESTS = 'no digests'
+
 ### CLASSES ###
 
 class Scenario(object):
@@ -37,6 +48,17 @@ class Scenario(object):
     REPEATS     = 2      #: How many times to repeat each game
     SWAP_TEAMS  = True   #: Repeat each run with blue/red swapped
     DRAW_MARGIN = 0.05
+    FIELD_CACHE = None   #: Folder to store unpacked fields in, see :class:`~domination.core.FieldCache`
+    CORPUS      = None   #: Play the n-th repeat of each game on the n-th field from this corpus file, which needs at least REPEATS fields
+    AGENT_CACHE = None   #: Folder in which agents can keep data per field, see :class:`~domination.core.AgentCache`
+    TRACE       = False  #: Also write a :class:`~domination.core.StateTrace` of each game
+    JOBS        = 1      #: Number of processes to play games in, None for one per CPU
+    SEED        = None   #: Seed from which each game gets its own, set it to repeat a run exactly
+    RESUME      = True   #: Continue an unfinished run in the output folder, see :class:`ResultWriter`
+    CONFIDENCE  = None   #: Stop playing a matchup once it is this sure who is stronger, see :meth:`decided`
+    MATCHMAKING = 'quality' #: How :meth:`ladder` picks games, 'quality' or 'uncertainty'
+    LADDER_SIGMA = 4.2   #: Uncertainty (standard deviation) below which :meth:`ranked` takes a rating as settled
+    LADDER_GAMES = 30    #: Games per agent that :meth:`ladder` plays at most, unless max_games is given
             
     def setup(self):
         """ Function is called once before any games 
@@ -50,23 +72,81 @@ class Scenario(object):
         pass
         
     def after_each(self, game):
-        """ Function that is run after each game.
+        """ Function that is run after each game. With more than one
+            of :attr:`JOBS`, it runs in the process that played the game.
             
             :param game: The previous game
         """
         pass
     
+    def expected_duration(self, red, blue):
+        """ Estimates how long a game between red and blue takes, so that
+            the longest games are started first when :attr:`JOBS` is more
+            than one. Only the order matters. By default, it is the size of
+            both agents and their blobs, as agents with a lot of learned
+            data tend to think longest.
+        """
+        size = 0
+        for agent in (red, blue):
+            for path in (agent, os.path.splitext(agent)[0] + '_blob'):
+                if os.path.exists(path):
+                    size += os.path.getsize(path)
+        return size
+    
+    def decided(self, points_a, points_b):
+        """ Whether a matchup is decided, given the points that both agents
+            scored against each other so far (2 for a win, 1 for a draw).
+            Only used when :attr:`CONFIDENCE` is set: an agent is taken to be
+            the stronger one once the probability that it wins more than half
+            of its games is at least that high, see 
+            :func:`~domination.utilities.win_probability`. Close matchups 
+            are played up to :attr:`REPEATS` times.
+        """
+        p = win_probability(points_a / 2.0, points_b / 2.0)
+        return p >= self.CONFIDENCE or p <= 1.0 - self.CONFIDENCE
+    
+    def ranked(self, ranking, ratings):
+        """ Whether :meth:`ladder` is sure of the ranking, given the agents
+            from best to worst and their ratings as [mu, sigma, games], 
+            where sigma is a variance. Each agent has to be ahead of the 
+            next by more than both their uncertainties (mu - sd > mu + sd), 
+            unless both uncertainties are below :attr:`LADDER_SIGMA`. 
+            Ratings do not get much more certain than that, because
+            the ratings drift a little after every game.
+        """
+        for (a, b) in zip(ranking, ranking[1:]):
+            sd_a, sd_b = math.sqrt(ratings[a][1]), math.sqrt(ratings[b][1])
+            if ratings[a][0] - sd_a <= ratings[b][0] + sd_b and max(sd_a, sd_b) >= self.LADDER_SIGMA:
+                return False
+        return True
+    
         
     """ You shouldn't have to override any
         of the methods below, but you may.
     """ 
-    def _single(self, red, blue, rendered=False):
+    def _single(self, red, blue, rendered=False, index=0, seed=None):
         """ Runs a single game, returns results, called repeatedly
             by :meth:`Scenario._multi`.
+            
+            :param index: Which repeat of this game it is.
+            :param seed:  Seeds the global random numbers (used by the field
+                          generator and agents) and those of the game.
         """
-        if self.GENERATOR is not None:
+        if seed is not None:
+            random.seed(seed)
+        if self.CORPUS is not None:
+            if getattr(self, '_corpus', None) is None:
+                self._corpus = corpus.FieldCorpus(self.CORPUS)
+            self.FIELD = self._corpus.field(index)
+        elif self.GENERATOR is not None:
             self.FIELD = self.GENERATOR.generate()
         self.before_each()
+        field = self.FIELD
+        if field is not None and field is getattr(self, '_shared_source', None):
+            # Attach to the published copy, once in each process
+            if getattr(self, '_shared_field', None) is None:
+                self._shared_field = shared.SharedField(self._shared_path)
+            field = self._shared_field.field()
         # Open blobs for reading if we can find 'em
         red_blob = os.path.splitext(red)[0] + '_blob'
         blue_blob = os.path.splitext(blue)[0] + '_blob'
@@ -75,8 +155,10 @@ class Scenario(object):
         # Run the game
         game = core.Game(red, blue, 
                     red_init=red_init, blue_init=blue_init,
-                    field=self.FIELD, settings=self.SETTINGS,
-                    record=True, verbose=False, rendered=False)
+                    field=field, settings=self.SETTINGS,
+                    record=True, verbose=False, rendered=False,
+                    agent_cache=getattr(self, '_agent_cache', None),
+                    trace=self.TRACE, seed=seed)
         if rendered:
             game.add_renderer()
         game.run()
@@ -87,101 +169,240 @@ class Scenario(object):
             blue_init['blob'].close()
         self.after_each(game)
         return game
+    
+    def _play(self, (i, red, blue, index, seed), rendered=False):
+        """ Plays game i of the playlist made by :meth:`Scenario._multi`,
+            and returns i with the results. The replay is returned as
+            a binary replay string, which is small to send between processes.
+        """
+        game = self._single(red, blue, rendered=rendered, index=index, seed=seed)
+        replay = StringIO()
+        core.ReplayWriter.convert(game.replay, replay)
+        return i, (red, blue, game.stats, replay.getvalue(), game.log.truncated(kbs=32), game.trace)
+        
         
+    def _start(self):
+        """ Prepares the scenario for a run of games. """
+        self.setup()
+        self._field_cache = core.Field.cache
+        if self.FIELD_CACHE is not None:
+            core.Field.cache = core.FieldCache(self.FIELD_CACHE)
+        if self.AGENT_CACHE is not None:
+            self._agent_cache = core.AgentCache(self.AGENT_CACHE)
+        # When all games are on one field, the worker processes share it
+        self._shared_source = None
+        if self.JOBS != 1 and self.GENERATOR is None and self.CORPUS is None and self.FIELD is not None:
+            self._shared_folder = tempfile.mkdtemp(dir=shared.default_folder())
+            self._shared_path = shared.publish(self.FIELD, self._shared_folder)
+            self._shared_source = self.FIELD
+    
+    def _stop(self, pool=None, writer=None, finished=True):
+        """ Undoes what :meth:`_start` changed outside of the scenario,
+            when the run of games has ended. The pool is stopped first,
+            because its workers use the shared field. If the run did not
+            finish, the workers are terminated and the writer leaves
+            its manifest unfinished, so that the run can be continued.
+        """
+        try:
+            if pool is not None:
+                if finished:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+            if writer is not None:
+                writer.close(finished)
+            if self.AGENT_CACHE is not None:
+                self._agent_cache.evict()
+        finally:
+            core.Field.cache = self._field_cache
+            if self._shared_source is not None:
+                shared.unpublish(self._shared_path)
+                os.rmdir(self._shared_folder)
+                self._shared_source = self._shared_field = None
         
     def _multi(self, teams, output_folder=None, rendered=False):
         """ Runs multiple games, given as  a list of
             (red, red_init, blue, blue_init) tuples. 
         """
-        self.setup()
-        # Manipulate the playlist a bit
-        teams = teams * self.REPEATS
-        if self.SWAP_TEAMS:
-            teams = teams + [(b, r) for (r, b) in teams]
-        # Run the games
-        gameinfo = []
-        # print '\n'.join("%r vs. %r"%(r,b) for (r, b) in teams)
-        for i, (red, blue) in enumerate(teams):
-            game = self._single(red, blue, rendered=rendered)
-            print "======= Game %d/%d done. =======" % (i+1, len(teams))
-            print game.stats
-            gameinfo.append((red, blue, game.stats, game.replay, game.log))
-            
-        if output_folder is not None:
-            self._write(gameinfo, output_folder)
+        pool, writer, finished = None, None, False
+        self._start()
+        try:
+            # Manipulate the playlist a bit
+            pairings = len(teams)
+            teams = teams * self.REPEATS
+            repeats = len(teams)
+            if self.SWAP_TEAMS:
+                teams = teams + [(b, r) for (r, b) in teams]
+            # Every game gets its own seed, so it plays the same in any process
+            seeder = random.Random(self.SEED)
+            games = [(i, red, blue, (i % repeats) // pairings, seeder.getrandbits(32))
+                     for i, (red, blue) in enumerate(teams)]
+            # Skip the games that a previous run already played
+            if output_folder is not None:
+                writer = ResultWriter(output_folder, self.DRAW_MARGIN, games, self.RESUME)
+                games = [game for game in writer.plan if game[0] not in writer.done]
+            # Run the games
+            if self.JOBS != 1 and not rendered:
+                pool = multiprocessing.Pool(self.JOBS, _init_worker, (self,))
+            if self.CONFIDENCE is None:
+                for _ in self._play_games(games, writer, pool, rendered):
+                    pass
+            else:
+                # Play one repeat of each matchup at a time, and the next
+                # one as soon as it is done, if the matchup is undecided.
+                points = defaultdict(lambda: [0, 0])
+                def count(red, blue, score):
+                    points_red, points_blue = game_points(score, self.DRAW_MARGIN)
+                    points[(red, blue)][0] += points_red
+                    points[(blue, red)][1] += points_red
+                    points[(blue, red)][0] += points_blue
+                    points[(red, blue)][1] += points_blue
+                for row in ([] if writer is None else writer.done.values()):
+                    count(row['red_file'], row['blue_file'], row['score'])
+                matchup = lambda red, blue: (min(red, blue), max(red, blue))
+                todo, playing, playlist = defaultdict(list), {}, []
+                for game in sorted(games, key=lambda g: (g[3], g[0])):
+                    todo[matchup(game[1], game[2])].append(game)
+                def queue(m):
+                    """ Adds the next repeat of matchup m to the playlist. """
+                    if todo[m] and not self.decided(*points[m]):
+                        repeat = [game for game in todo[m] if game[3] == todo[m][0][3]]
+                        del todo[m][:len(repeat)]
+                        playing[m] = len(repeat)
+                        playlist.extend(repeat)
+                for m in sorted(todo):
+                    queue(m)
+                for (i, (red, blue, stats, _, _, _)) in self._play_games(playlist, writer, pool, rendered):
+                    count(red, blue, stats.score)
+                    playing[matchup(red, blue)] -= 1
+                    if not playing[matchup(red, blue)]:
+                        queue(matchup(red, blue))
+            finished = True
+        finally:
+            self._stop(pool, writer, finished)
+    
+    def _play_games(self, games, writer=None, pool=None, rendered=False):
+        """ Plays a list of games, in the pool if there is one, and writes
+            each as soon as it is done. Yields the (i, results) of each 
+            game in the order they finish. Games that are added to the
+            list in the meantime are played too.
+        """
+        done, started, running = 0, 0, []
+        while done < len(games):
+            if pool is None:
+                i, info = self._play(games[done], rendered)
+            else:
+                # Longest games first, so no process is left with one at the end
+                new = sorted(games[started:], key=lambda g: -self.expected_duration(g[1], g[2]))
+                running.extend(pool.apply_async(_play_entry, (game,)) for game in new)
+                started = len(games)
+                while not any(result.ready() for result in running):
+                    running[0].wait(0.05)
+                result = [result for result in running if result.ready()][0]
+                running.remove(result)
+                i, info = result.get()
+            done += 1
+            print "======= Game %d/%d done. =======" % (done, len(games))
+            print info[2]
+            if writer is not None:
+                writer.add(i, *info)
+            yield i, info
             
+    def _matchups(self, agents, ratings):
+        """ Picks a round of games for :meth:`ladder`, in which each agent
+            plays at most once. With :attr:`MATCHMAKING` set to 'quality',
+            the closest matches (see :func:`~domination.libs.trueskill.quality`)
+            are played first. With 'uncertainty', the agents whose rating is
+            least certain play first, each against its closest match.
+        """
+        quality = lambda (a, b): trueskill.quality(ratings[a][:2], ratings[b][:2])
+        if self.MATCHMAKING == 'quality':
+            candidates = sorted(all_pairs(agents), key=quality, reverse=True)
+        elif self.MATCHMAKING == 'uncertainty':
+            candidates = []
+            for a in sorted(agents, key=lambda a: ratings[a][1], reverse=True):
+                candidates.extend(sorted(((a, b) for b in agents if b != a), key=quality, reverse=True))
+        else:
+            raise ValueError("Unknown matchmaking %r." % self.MATCHMAKING)
+        free, pairs = set(agents), []
+        for (a, b) in candidates:
+            if a in free and b in free:
+                pairs.append((a, b))
+                free -= set((a, b))
+        return pairs
+    
+    def _ladder(self, agents, path, output_folder=None, max_games=None):
+        """ Plays rounds of :meth:`_matchups` and updates the ratings in
+            the file at path after each, until the ranking is :meth:`ranked`.
+        """
+        pool, writer, finished = None, None, False
+        self._start()
+        try:
+            key = lambda agent: os.path.splitext(os.path.basename(agent))[0]
+            stored = json.load(open(path)) if os.path.exists(path) else {}
+            ratings = {} # Agent: [mu, sigma, games]
+            for agent in agents:
+                rating = stored.get(key(agent), {})
+                ratings[agent] = [rating.get('mu', trueskill.INITIAL_MU),
+                                  rating.get('sigma', trueskill.INITIAL_SIGMA),
+                                  rating.get('games', 0)]
+            if max_games is None:
+                max_games = self.LADDER_GAMES * len(agents) // 2
+            # Each agent plays its n-th game on the n-th field of the 
+            # corpus, and starts over when it has played on all of them.
+            fields = None
+            if self.CORPUS is not None:
+                fields = corpus.FieldCorpus(self.CORPUS)
+                fields.close()
+            seeder = random.Random(self.SEED)
+            if output_folder is not None:
+                writer = ResultWriter(output_folder, self.DRAW_MARGIN)
+            if self.JOBS != 1:
+                pool = multiprocessing.Pool(self.JOBS, _init_worker, (self,))
+            played = 0
+            ranking = sorted(agents, key=lambda a: ratings[a][0], reverse=True)
+            while played < max_games and not self.ranked(ranking, ratings):
+                games = []
+                for (a, b) in self._matchups(agents, ratings)[:max_games - played]:
+                    red, blue = (a, b) if seeder.random() < 0.5 else (b, a)
+                    index = ratings[red][2] if fields is None else ratings[red][2] % len(fields)
+                    games.append((played + len(games), red, blue, index, seeder.getrandbits(32)))
+                for (i, (red, blue, stats, _, _, _)) in self._play_games(games, writer, pool):
+                    points_red, points_blue = game_points(stats.score, self.DRAW_MARGIN)
+                    winner, loser = (red, blue) if points_red >= points_blue else (blue, red)
+                    new_winner, new_loser = trueskill.adjust(ratings[winner][:2], ratings[loser][:2], 
+                                                             draw=(points_red == points_blue))
+                    ratings[winner][:2], ratings[loser][:2] = new_winner, new_loser
+                    ratings[red][2] += 1
+                    ratings[blue][2] += 1
+                played += len(games)
+                # Store the ratings after every round
+                for agent, (mu, sigma, n) in ratings.iteritems():
+                    stored[key(agent)] = {'mu': mu, 'sigma': sigma, 'games': n}
+                f = open(path + '.tmp', 'w')
+                json.dump(stored, f, indent=1, sort_keys=True)
+                f.close()
+                os.rename(path + '.tmp', path)
+                ranking = sorted(agents, key=lambda a: ratings[a][0], reverse=True)
+            finished = True
+            print "Played %d games." % played
+            print markdown_table([(key(a), '%.1f' % ratings[a][0], '%.1f' % math.sqrt(ratings[a][1]), ratings[a][2])
+                                  for a in ranking], header=['Agent', 'Skill', 'Uncertainty', 'Games'])
+            return ranking
+        finally:
+            self._stop(pool, writer, finished)
+    
     def _write(self, gameinfo, output_folder, include_replays=True):
         """ Write a csv with all game results, all the replays in a zip and
-            a textfile with a summary to the output_folder
+            a textfile with a summary to the output_folder, for a list of
+            (red, blue, stats, replay, log, trace) tuples. 
+            See :class:`ResultWriter`.
         """
-        if os.path.exists(output_folder):
-            print "WARNING: Output directory exists; overwriting results"
-        else:
-            os.makedirs(output_folder)
-        # Write stats to a CSV
-        fieldnames = ('red_file', 'blue_file', 'score', 'score_red', 'score_blue', 'steps', 'ammo_red', 'ammo_blue')
-        now = datetime.datetime.now()
-        fn = os.path.join(output_folder,'%s'%now.strftime("%Y%m%d-%H%M"))
-        csvf = csv.DictWriter(open(fn+'_games.csv','w'), fieldnames, extrasaction='ignore')
-        csvf.writerow(dict(zip(fieldnames, fieldnames)))
-        # Create a zip with the replays
-        zipf = zipfile.ZipFile(fn+'_replays.zip','w')
-        logs = zipfile.ZipFile(fn+'_logs.zip','w')
-            
-        for i, (r, b, stats, replay, log) in enumerate(gameinfo):
-            # Write to the csv file
-            s = stats.__dict__
-            s.update([('red_file',r),('blue_file',b)])
-            csvf.writerow(s)
-            # Write a replay
-            r = os.path.splitext(os.path.basename(r))[0]
-            b = os.path.splitext(os.path.basename(b))[0]
-            zipf.writestr('replay_%04d_%s_vs_%s.pickle'%(i, r, b), pickle.dumps(replay, pickle.HIGHEST_PROTOCOL))
-            logs.writestr('log_%04d_%s_vs_%s.txt'%(i,r,b), log.truncated(kbs=32))
-        
-        zipf.close()
-        logs.close()
-        
-        # Write summary
-        sf = open(fn+'_summary.md','w')
-        sf.write('In total, %d games were played.\n\n' % len(gameinfo))
-        by_color = defaultdict(lambda: [0, 0])
-        by_match = defaultdict(lambda: [0, 0])
-        by_team = defaultdict(lambda: 0)
-        # Compile scores by color/team/matchup
-        for (r, b, stats, _, _) in gameinfo:
-            if abs(stats.score - 0.5) < self.DRAW_MARGIN:
-                points_red, points_blue = (1, 1)
-            elif stats.score > 0.5:
-                points_red, points_blue = (2, 0)
-            else:
-                points_red, points_blue = (0, 2)
-            by_color[(r,b)][0] += points_red
-            by_color[(r,b)][1] += points_blue
-            if r < b:
-                by_match[(r,b)][0] += points_red
-                by_match[(r,b)][1] += points_blue
-            else:
-                by_match[(b,r)][0] += points_blue
-                by_match[(b,r)][1] += points_red
-            by_team[r] += points_red
-            by_team[b] += points_blue
-        # Put the matches into a matchup matrix (team a on left, team b on top)
-        matrix = defaultdict(lambda: defaultdict(lambda: None))
-        for (a, b), (points) in by_match.items():
-            matrix[a][b] = points
-        order = sorted(by_team.keys())
-        table = [] #[[for _ in range(len(order)+1)] for _ in range(len(order))]
-        for left in order[:-1]:
-            table.append([left] + [matrix[left][top] for top in order[1:]])
-        # Final ranking
-        ranking = sorted(by_team.items(), key=lambda x: x[1], reverse=True)
-        # Write to output
-        sf.write(markdown_table([(r,b,pr,pb) for ((r,b),(pr,pb)) in by_color.items()], header=['Red','Blue','R','B']))
-        sf.write('\n')
-        sf.write(markdown_table(table, header=['']+order[1:]))
-        sf.write('\n')
-        sf.write(markdown_table(ranking, header=['Team','Points']))
+        writer = ResultWriter(output_folder, self.DRAW_MARGIN)
+        for i, info in enumerate(gameinfo):
+            writer.add(i, *info)
+        writer.close()
         
     
     @classmethod
@@ -218,16 +439,279 @@ class Scenario(object):
             :param output_folder: Folder in which results will be stored.
         """
         if folder is not None:
-            agents = glob.glob(os.path.join(folder,'*.py'))
+            agents = sorted(glob.glob(os.path.join(folder,'*.py')))
             if output_folder is None:
                 output_folder = folder
         pairs = list(all_pairs(agents))
         scen = cls()
         scen._multi(pairs, output_folder=output_folder)
+    
+    @classmethod
+    def ladder(cls, folder=None, agents=None, output_folder=None, ratings=None, max_games=None):
+        """ Ranks the agents specified by their TrueSkill rating, playing
+            only the most informative games (see :attr:`MATCHMAKING`) 
+            instead of a full tournament. Games are played in rounds in 
+            which each agent plays at most once, until the ratings tell
+            the agents apart, see :meth:`ranked`. Returns the agents 
+            from best to worst.
+            
+            :param agents:        A list of paths to agents
+            :param folder:        A folder that contains all agents, overrides the agents parameter.
+            :param output_folder: Folder in which results will be stored.
+            :param ratings:       The json file that the ratings are kept in, by agent name. 
+                                  Defaults to ``ratings.json`` in the folder, or the output folder.
+                                  Agents that are in it continue from their rating.
+            :param max_games:     Stop after this many games, defaults to :attr:`LADDER_GAMES` per agent.
+        """
+        if folder is not None:
+            agents = sorted(glob.glob(os.path.join(folder,'*.py')))
+            if output_folder is None:
+                output_folder = folder
+        if ratings is None:
+            ratings = os.path.join(folder or output_folder or '.', 'ratings.json')
+        scen = cls()
+        return scen._ladder(agents, ratings, output_folder=output_folder, max_games=max_games)
+        
+
+class ResultWriter(object):
+    """ Writes the results of a scenario while it runs: a csv with the 
+        stats of each game, zips with the replays and logs, and the traces.
+        Every game is written as soon as it is added, in any order, and 
+        the zips are closed again after each game, so the files on disk 
+        are always complete. Only the csv row of each game is kept, and
+        the csv is written again in the order of the games when the 
+        writer is closed. The summary is kept as running totals per team
+        and matchup, and written then too. So the replays, logs and 
+        traces of a game are not held on to after it is added.
+        
+        Given the list of games that will be played, it also keeps a 
+        manifest (``_manifest.jsonl``): a line with the games and their
+        seeds, and then a line with the results of each game that is done.
+        A new writer for the same games in the same folder continues from 
+        that manifest, see :attr:`done`, unless the writer that started it
+        was closed.
+    """
+    FIELDNAMES = ('red_file', 'blue_file', 'score', 'score_red', 'score_blue', 'steps', 'ammo_red', 'ammo_blue')
+    
+    def __init__(self, output_folder, draw_margin=0.05, games=None, resume=True):
+        """ Constructor for ResultWriter class.
+            
+            :param output_folder: Folder in which results will be stored.
+            :param draw_margin:   Games with a score this close to 0.5 are draws.
+            :param games:         The games that will be played, as a list of 
+                                  (i, red, blue, repeat, seed) tuples.
+            :param resume:        Continue an unfinished manifest for the same games.
+        """
+        self.draw_margin = draw_margin
+        self.games = 0
+        self.by_color = defaultdict(lambda: [0, 0])
+        self.by_match = defaultdict(lambda: [0, 0])
+        self.by_team = defaultdict(lambda: 0)
+        self.plan = games #: The games to play, with the seeds of the manifest when it continues
+        self.done = {}    #: The csv rows of the games that are done, by game
+        self.manifest = None
+        found = None
+        if games is not None and resume and os.path.exists(output_folder):
+            found = self._unfinished(output_folder, games)
+        if found is not None:
+            self.fn, self.plan, self.done = found
+            print "Continuing %s, %d of %d games are done." % (self.fn, len(self.done), len(self.plan))
+        else:
+            if os.path.exists(output_folder):
+                print "WARNING: Output directory exists; overwriting results"
+            else:
+                os.makedirs(output_folder)
+            now = datetime.datetime.now()
+            self.fn = os.path.join(output_folder,'%s'%now.strftime("%Y%m%d-%H%M"))
+            # Create the zips, games are appended to them
+            zipfile.ZipFile(self.fn+'_replays.zip','w').close()
+            zipfile.ZipFile(self.fn+'_logs.zip','w').close()
+            if games is not None:
+                self.manifest = open(self.fn+'_manifest.jsonl','w')
+                self.manifest.write(json.dumps({'games': games}) + '\n')
+                self.manifest.flush()
+        # (Re)write the csv, with the games that are done
+        self.csvfile = open(self.fn+'_games.csv','w')
+        self.csvf = csv.DictWriter(self.csvfile, self.FIELDNAMES, extrasaction='ignore')
+        self.csvf.writerow(dict(zip(self.FIELDNAMES, self.FIELDNAMES)))
+        for i in sorted(self.done):
+            row = self.done[i]
+            self.csvf.writerow(row)
+            self._count(row['red_file'], row['blue_file'], row['score'])
+        self.csvfile.flush()
+        if found is not None:
+            self.manifest = open(self.fn+'_manifest.jsonl','a')
+    
+    @staticmethod
+    def _unfinished(output_folder, games):
+        """ Finds the newest manifest in the folder for the same games, 
+            that is not finished yet, and returns its prefix, games and
+            the rows of the games that are done.
+        """
+        plan = [list(g[1:4]) for g in games]
+        for path in sorted(glob.glob(os.path.join(output_folder, '*_manifest.jsonl')), reverse=True):
+            lines = open(path).read().split('\n')
+            # The last line is empty, or was not finished
+            manifest, done, finished = json.loads(lines[0]), {}, False
+            for line in lines[1:-1]:
+                entry = json.loads(line)
+                if 'game' in entry:
+                    done[entry['game']] = entry['row']
+                finished = entry.get('finished', False)
+            if [g[1:4] for g in manifest['games']] == plan and not finished:
+                return path[:-len('_manifest.jsonl')], [tuple(g) for g in manifest['games']], done
+        return None
+    
+    def _count(self, red, blue, score):
+        """ Adds the points of a game to the totals. """
+        points_red, points_blue = game_points(score, self.draw_margin)
+        self.by_color[(red,blue)][0] += points_red
+        self.by_color[(red,blue)][1] += points_blue
+        if red < blue:
+            self.by_match[(red,blue)][0] += points_red
+            self.by_match[(red,blue)][1] += points_blue
+        else:
+            self.by_match[(blue,red)][0] += points_blue
+            self.by_match[(blue,red)][1] += points_red
+        self.by_team[red] += points_red
+        self.by_team[blue] += points_blue
+        self.games += 1
+    
+    def add(self, i, red, blue, stats, replay, log, trace=None):
+        """ Writes the results of game i.
+            
+            :param replay: A binary replay string, or a :class:`~domination.core.ReplayData`.
+            :param log:    The game log, or its text.
+            :param trace:  The :class:`~domination.core.StateTrace` of the game, if any.
+        """
+        # Write the replay and log, unless a run that stopped got that far
+        if not isinstance(replay, str):
+            data = StringIO()
+            core.ReplayWriter.convert(replay, data)
+            replay = data.getvalue()
+        if isinstance(log, core.GameLog):
+            log = log.truncated(kbs=32)
+        r = os.path.splitext(os.path.basename(red))[0]
+        b = os.path.splitext(os.path.basename(blue))[0]
+        for (suffix, name, data) in (('_replays.zip', 'replay_%04d_%s_vs_%s.replay'%(i, r, b), replay),
+                                     ('_logs.zip', 'log_%04d_%s_vs_%s.txt'%(i,r,b), log)):
+            zipf = zipfile.ZipFile(self.fn+suffix,'a', zipfile.ZIP_DEFLATED)
+            if name not in zipf.NameToInfo:
+                zipf.writestr(name, data)
+            zipf.close()
+        # Write the trace next to it
+        if trace:
+            if not os.path.exists(self.fn+'_traces'):
+                os.makedirs(self.fn+'_traces')
+            trace.save(os.path.join(self.fn+'_traces', 'trace_%04d_%s_vs_%s.npz'%(i, r, b)))
+        # Write to the csv file
+        s = stats.__dict__
+        s.update([('red_file',red),('blue_file',blue)])
+        self.csvf.writerow(s)
+        self.csvfile.flush()
+        self._count(red, blue, stats.score)
+        # Mark the game as done
+        row = dict((k, s[k]) for k in self.FIELDNAMES)
+        self.done[i] = row
+        if self.manifest is not None:
+            self.manifest.write(json.dumps({'game': i, 'row': row}) + '\n')
+            self.manifest.flush()
+    
+    def close(self, finished=True):
+        """ Writes the csv in the order of the games, and the summary.
+            
+            :param finished: Whether all games were played. If not, the
+                             manifest is left unfinished, so that a new 
+                             writer continues from it.
+        """
+        self.csvfile.close()
+        self.csvfile = open(self.fn+'_games.csv','w')
+        self.csvf = csv.DictWriter(self.csvfile, self.FIELDNAMES, extrasaction='ignore')
+        self.csvf.writerow(dict(zip(self.FIELDNAMES, self.FIELDNAMES)))
+        for i in sorted(self.done):
+            self.csvf.writerow(self.done[i])
+        self.csvfile.close()
+        if self.manifest is not None:
+            if finished:
+                self.manifest.write(json.dumps({'finished': True}) + '\n')
+            self.manifest.close()
+        sf = open(self.fn+'_summary.md','w')
+        sf.write('In total, %d games were played.\n\n' % self.games)
+        # Put the matches into a matchup matrix (team a on left, team b on top)
+        matrix = defaultdict(lambda: defaultdict(lambda: None))
+        for (a, b), (points) in self.by_match.items():
+            matrix[a][b] = points
+        order = sorted(self.by_team.keys())
+        table = []
+        for left in order[:-1]:
+            table.append([left] + [matrix[left][top] for top in order[1:]])
+        # Final ranking
+        ranking = sorted(self.by_team.items(), key=lambda x: x[1], reverse=True)
+        # Write to output
+        sf.write(markdown_table([(r,b,pr,pb) for ((r,b),(pr,pb)) in sorted(self.by_color.items())], header=['Red','Blue','R','B']))
+        sf.write('\n')
+        sf.write(markdown_table(table, header=['']+order[1:]))
+        sf.write('\n')
+        sf.write(markdown_table(ranking, header=['Team','Points']))
+        sf.close()
         
 
 ### HELPER FUNCTIONS ###
 
+def game_points(score, draw_margin=0.05):
+    """ Returns the points (red, blue) for a game with the given score:
+        2 for a win, 1 each for a draw.
+        
+        >>> game_points(0.52)
+        (1, 1)
+        >>> game_points(0.8)
+        (2, 0)
+    """
+    if abs(score - 0.5) < draw_margin:
+        return (1, 1)
+    elif score > 0.5:
+        return (2, 0)
+    return (0, 2)
+
+_scenario = None # The scenario that a worker process plays games for
+
+def _init_worker(scenario):
+    """ Starts a worker process of :meth:`Scenario._multi`. """
+    global _scenario
+    _scenario = scenario
+
+def _play_entry(game):
+    """ Plays one game of the playlist, in a worker process. """
+    return _scenario._play(game)
+
+def verify_replays(path, processes=None):
+    """ Replays every game in a ``_replays.zip`` archive without 
+        rendering, in parallel, and returns a dictionary with the first
+        step where each replay differs from its recording (None if it
+        matches). Replays that were recorded before digests were kept 
+        can't be checked, they are given as :data:`NO_DIGESTS`.
+        
+        :param path:      The zip file written by a :class:`Scenario`.
+        :param processes: The number of processes, defaults to the number of CPUs.
+    """
+    names = zipfile.ZipFile(path).namelist()
+    jobs = [(path, name) for name in names]
+    if processes == 1:
+        results = map(_verify_entry, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.map(_verify_entry, jobs)
+        pool.close()
+        pool.join()
+    return dict(zip(names, results))
+
+def _verify_entry((path, name)):
+    """ Verifies a single replay from a zip, in a worker process. """
+    replay = core.load_replay_data(zipfile.ZipFile(path).read(name))
+    if not getattr(replay, 'digests', None):
+        return NO_DIGESTS
+    return core.verify_replay(replay)
+
 def markdown_table(body, header=None):
     """ Generate a MultiMarkdown text table.
         :param body:    The body as a list-of-lists
@@ -0,0 +1,209 @@
+""" Domination game engine for Reinforcement Learning research.
+
+Contains functions for sharing the unpacked parts of a field between
+processes. The field is published once, to a file (in /dev/shm where
+there is one), and each process that needs it maps that file into memory
+instead of unpickling or computing its own copy. With numpy installed, the
+wall grid and navigation graph are numpy arrays that point straight into the
+mapped file, so every process reads the same memory. Without numpy they are
+copied into plain arrays. The file stays until it is removed with
+:func:`unpublish`.
+
+The file starts with a header and a table of sections; each section is a
+flat array of one type, aligned to 8 bytes.
+
+"""
+
+### IMPORTS ###
+# Python
+import os
+import mmap
+import struct
+import tempfile
+import cPickle as pickle
+from array import array
+
+# Optional
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Local
+import core
+from libs.csrgraph import CSRGraph
+
+### CONSTANTS ###
+
+MAGIC   = 'DOMSHRD1'
+HEADER  = struct.Struct('<8sIIII')  # Magic, width, height, tilesize, number of sections
+SECTION = struct.Struct('<16scQQ')  # Name, array typecode, offset, count
+DTYPES  = {'B': 'u1', 'i': '<i4', 'd': '<f8', 'c': 'S1'}
+EXTENSION = '.shared'
+
+### FUNCTIONS ###
+
+def default_folder():
+    """ Returns /dev/shm if it exists, so that published fields never
+        touch the disk, or the temporary folder otherwise.
+    """
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+def publish(field, folder=None):
+    """ Writes the unpacked parts of a field to a file that other
+        processes can attach to with :class:`SharedField`, and returns
+        its path. The file is named after :meth:`~domination.core.Field.hash`,
+        so a field that was already published is not written again.
+
+        :param field:  The field to publish.
+        :param folder: Where to put the file, see :func:`default_folder`.
+    """
+    if folder is None:
+        folder = default_folder()
+    path = os.path.join(folder, 'domination_%s%s' % (field.hash(), EXTENSION))
+    if os.path.exists(path):
+        return path
+    graph = field.navgraph
+    meta = {'tiles': str(field),
+            'mirrored': field.unpacked_data()['mirrored'],
+            'rectcounts': field.rect_counts,
+            'regions': field.unpacked_data()['regions']}
+    sections = [('grid', array('B', (v for row in field.wallgrid for v in row))),
+                ('wallrects', array('i', (v for rect in field.wallrects for v in rect))),
+                ('xs', array('d', graph.xs)),
+                ('ys', array('d', graph.ys)),
+                ('offsets', array('i', graph.offsets)),
+                ('targets', array('i', graph.targets)),
+                ('weights', array('d', graph.weights)),
+                ('meta', array('c', pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)))]
+    offset = HEADER.size + SECTION.size * len(sections)
+    table, data = [], []
+    for (name, arr) in sections:
+        offset += -offset % 8
+        table.append(SECTION.pack(name, arr.typecode, offset, len(arr)))
+        data.append((offset, arr.tostring()))
+        offset += len(data[-1][1])
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    f = open(tmp, 'wb')
+    f.write(HEADER.pack(MAGIC, field.width, field.height, field.tilesize, len(sections)))
+    f.write(''.join(table))
+    for (start, raw) in data:
+        f.write('\0' * (start - f.tell()))
+        f.write(raw)
+    f.close()
+    os.rename(tmp, path)
+    return path
+
+def unpublish(path):
+    """ Removes a field that was published with :func:`publish`.
+        Processes that are attached to it can keep using it until
+        they close it, but no new ones can attach.
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        if os.path.exists(path):
+            raise
+
+### CLASSES ###
+
+class SharedField(object):
+    """ A published field, mapped into memory. Made with :func:`publish`::
+
+            path = shared.publish(field)
+            # In each worker process
+            shared_field = shared.SharedField(path)
+            game = core.Game(field=shared_field.field(), ...)
+            # When all processes are done
+            shared.unpublish(path)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.width, self.height, self.tilesize, count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a shared field." % path)
+        self.sections = {}
+        for i in xrange(count):
+            name, typecode, offset, length = SECTION.unpack_from(self.data, HEADER.size + i * SECTION.size)
+            self.sections[name.rstrip('\0')] = (typecode, offset, length)
+        self._meta = None
+        self._unpacked = None
+
+    def array(self, name):
+        """ Returns a section as a read-only numpy array that shares
+            the mapped memory, or as a copy in an array without numpy.
+        """
+        typecode, offset, length = self.sections[name]
+        if np is not None:
+            return np.frombuffer(self.data, DTYPES[typecode], length, offset)
+        arr = array(typecode)
+        arr.fromstring(self.data[offset:offset + length * arr.itemsize])
+        return arr
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            self._meta = pickle.loads(self.array('meta').tostring())
+        return self._meta
+
+    @property
+    def grid(self):
+        """ The wall grid, as a height x width numpy array, or as a list
+            of lists without numpy.
+        """
+        grid = self.array('grid')
+        if np is not None:
+            return grid.reshape((self.height, self.width))
+        w = self.width
+        return [list(grid[i:i + w]) for i in xrange(0, len(grid), w)]
+
+    @property
+    def wallrects(self):
+        rects = self.array('wallrects')
+        return [tuple(int(v) for v in rects[i:i + 4]) for i in xrange(0, len(rects), 4)]
+
+    @property
+    def navgraph(self):
+        """ The nav mesh as a :class:`~domination.libs.csrgraph.CSRGraph`
+            on top of the shared arrays.
+        """
+        return CSRGraph.from_arrays(*[self.array(name) for name in
+                                      ('xs', 'ys', 'offsets', 'targets', 'weights')])
+
+    def field(self):
+        """ Returns a :class:`~domination.core.Field`, unpacked from
+            the shared data instead of being computed. The nav mesh
+            dictionary is only built for the first field, the fields
+            after that share it, and their flow fields. The ``wallgrid``
+            is a list of lists, like that of any field, because agents 
+            get it and index it per tile. With numpy, the ``navgraph`` of the field is on top of
+            the shared arrays themselves, which are read-only.
+        """
+        if self._unpacked is None:
+            graph = self.navgraph
+            grid = self.grid
+            if np is not None:
+                grid = grid.tolist()
+            mesh = {}
+            for n, p in enumerate(graph.positions):
+                mesh[p] = dict((graph.positions[int(m)], float(w)) for (m, w) in graph.neighbors(n))
+            self._unpacked = {'wallrects': self.wallrects,
+                              'mesh': mesh,
+                              'grid': grid,
+                              'navgraph': graph,
+                              'flowfields': {},
+                              'mirrored': self.meta['mirrored'],
+                              'rectcounts': self.meta['rectcounts'],
+                              'regions': self.meta['regions']}
+        field = core.Field.from_string(self.meta['tiles'])
+        field.tilesize = self.tilesize
+        field.unpack(cached=self._unpacked)
+        return field
+
+    def close(self):
+        self.data.close()
+        self.file.close()
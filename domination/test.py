@@ -8,13 +8,27 @@ working properly. This includes saving fields and replays.
 
 # Python Imports
 import os
+import csv
+import json
+import glob
+import random
+import operator
 import unittest
 import shutil
+import struct
 import tempfile
+import multiprocessing
+import zipfile
+import cPickle as pickle
+from cStringIO import StringIO
 
 # Local Imports
 import core
 import run
+import corpus
+import analysis
+import shared
+import analytics
 from utilities import *
 
 ### CONSTANTS
@@ -55,6 +69,15 @@ w _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ w
 w w w w w w w w w w w w w w w w w w w
 """
 
+### FUNCTIONS
+
+def count_shots(game):
+    return sum(1 for tank in game.tanks if tank.shoots and tank.respawn_in == -1)
+
+def float32(value):
+    """ Rounds a number to float32 precision, like traces store it. """
+    return struct.unpack('<f', struct.pack('<f', value))[0]
+
 ### CLASSES
 
 class TestDominationGame(unittest.TestCase):
@@ -101,6 +124,427 @@ class TestDominationGame(unittest.TestCase):
             self.assertEqual(len(f.find(core.Field.CONTROL)), 3)
             self.assertEqual(len(f.find(core.Field.AMMO)), 6)
                 
+    def test_array_field(self):
+        try:
+            import numpy
+        except ImportError:
+            print("It looks like you don't have numpy installed, skipping the array field test.")
+            return
+        f = core.FieldGenerator().generate()
+        af = core.ArrayField.from_field(f)
+        self.assertEqual(af, f)
+        self.assertEqual(core.ArrayField.from_string(str(f)), f)
+        self.assertEqual(af.wallgrid, f.wallgrid)
+        self.assertEqual(af.is_mirrored(), f.is_mirrored())
+        for match in (core.Field.WALL, core.Field.NOT + core.Field.WALL, 'W_.', core.Field.CONTROL):
+            self.assertEqual(af.find(match), f.find(match))
+            self.assertEqual(af.find(match, bounds=(3, 2, 20, 10)), f.find(match, bounds=(3, 2, 20, 10)))
+        state = random.getstate()
+        f.scatter(core.Field.SOURCE, 5)
+        random.setstate(state)
+        af.scatter(core.Field.SOURCE, 5)
+        self.assertEqual(af, f)
+        for (x, y) in f.find(core.Field.CONTROL):
+            f.set([(x-2, y), (x+2, y)], core.Field.WALL, match=core.Field.CLEAR)
+            af.set([(x-2, y), (x+2, y)], core.Field.WALL, match=core.Field.CLEAR)
+        self.assertEqual(af.valid(), f.valid())
+        f.fill_unreachable()
+        af.fill_unreachable()
+        self.assertEqual(af, f)
+        self.assertEqual(af.clone(), f)
+        # The tiles are a view onto the array, so editing them in place works
+        (x, y) = af.find(core.Field.CLEAR)[0]
+        tiles = af.tiles
+        tiles[y][x] = core.Field.WALL
+        f.tiles[y][x] = core.Field.WALL
+        self.assertEqual(af.tiles[y][x], core.Field.WALL)
+        self.assertEqual(af.find(core.Field.WALL), f.find(core.Field.WALL))
+        generator = core.FieldGenerator(mirror=False)
+        pts = f.find(core.Field.CLEAR)[:3]
+        self.assertEqual(generator._add_walls(af, pts, 0), generator._add_walls(f, pts, 0))
+        self.assertEqual(af, f)
+        self.assertEqual(af.find(core.Field.WALL), f.find(core.Field.WALL))
+
+    def test_field_connected(self):
+        for i in xrange(50):
+            f = core.FieldGenerator(width=random.randint(20, 80), height=random.randint(20, 50)).generate()
+            self.assertTrue(f.valid())
+            reach = reachable(f.tiles, f.find(core.Field.RED)[0], border=core.Field.WALL)
+            self.assertEqual(f.find(core.Field.NOT + core.Field.WALL), 
+                             f.find(core.Field.NOT + core.Field.WALL, mask=reach))
+
+    def test_field_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            core.Field.cache = core.FieldCache(tmpdir)
+            f = core.FieldGenerator().generate()
+            f.unpack()
+            self.assertEqual(len(os.listdir(tmpdir)), 1)
+            f2 = core.Field.from_string(str(f))
+            self.assertEqual(f2.hash(), f.hash())
+            # A cached field gives the same results without building the mesh
+            f2.unpack()
+            self.assertEqual(f2.mesh, f.mesh)
+            self.assertEqual(f2.wallrects, f.wallrects)
+            self.assertEqual(f2.wallgrid, f.wallgrid)
+            self.assertEqual(len(f2.get_objects()), len(f.get_objects()))
+            # Old entries are removed when the cache is full
+            size = os.path.getsize(os.path.join(tmpdir, os.listdir(tmpdir)[0]))
+            core.Field.cache.max_bytes = 2 * size
+            for i in xrange(4):
+                core.FieldGenerator().generate().unpack()
+            sizes = [os.path.getsize(os.path.join(tmpdir, fn)) for fn in os.listdir(tmpdir)]
+            self.assertTrue(sum(sizes) <= 2 * size)
+            # The folder is only made when something is stored, and a 
+            # folder that can't be made just means nothing is cached.
+            folder = os.path.join(tmpdir, 'fields')
+            cache = core.FieldCache(folder)
+            self.assertFalse(os.path.exists(folder))
+            cache.put('key', {'grid': []})
+            self.assertEqual(cache.get('key'), {'grid': []})
+            open(os.path.join(tmpdir, 'file'), 'w').close()
+            cache = core.FieldCache(os.path.join(tmpdir, 'file', 'fields'))
+            cache.put('key', {'grid': []})
+            self.assertEqual(cache.get('key'), None)
+            # A scenario puts back the cache that was there before it
+            class Cached(run.Scenario):
+                SETTINGS    = core.Settings(max_steps=20)
+                REPEATS     = 1
+                SWAP_TEAMS  = False
+                FIELD_CACHE = folder
+            before = core.Field.cache
+            Cached.one_on_one(core.DEFAULT_AGENT_FILE, core.DEFAULT_AGENT_FILE)
+            self.assertTrue(core.Field.cache is before)
+        finally:
+            core.Field.cache = None
+            shutil.rmtree(tmpdir)
+
+    def test_agent_cache(self):
+        agent = RANDOM_AGENT.replace('NAME = "randomagent"', 'NAME = "cachingagent"').replace(
+            """    def __init__(self, *args, **kwargs):
+        pass""", """    def __init__(self, id, team, cache_dir=None, **kwargs):
+        self.path = os.path.join(cache_dir, 'data_%d' % id)
+        self.loaded = os.path.exists(self.path)""").replace(
+            """    def finalize(self, interrupted=False):
+        pass""", """    def finalize(self, interrupted=False):
+        open(self.path, 'w').write('x' * 1000)""")
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = core.AgentCache(tmpdir)
+            field = core.Field.from_string(SMALL_FIELD)
+            settings = core.Settings(max_steps=5)
+            loaded = []
+            for i in xrange(2):
+                game = core.Game(red=agent, blue=RANDOM_AGENT, field=field, settings=settings,
+                                 rendered=False, verbose=False, agent_cache=cache).run()
+                loaded.append([t.brain.loaded for t in game.tanks_red])
+            self.assertEqual(loaded, [[False, False], [True, True]])
+            # Agents that take **kwargs get a folder too
+            self.assertEqual(len(os.listdir(tmpdir)), 2)
+            # Old fields are removed when the cache is full
+            field = core.FieldGenerator().generate()
+            cache.max_bytes = 1000 * len(field.find(core.Field.RED))
+            game = core.Game(red=agent, blue=RANDOM_AGENT, field=field, settings=settings,
+                             rendered=False, verbose=False, agent_cache=cache).run()
+            folders = os.listdir(os.path.join(tmpdir, cache.identity(game.red)))
+            self.assertEqual(len(folders), 2)
+            cache.evict()
+            folders = os.listdir(os.path.join(tmpdir, cache.identity(game.red)))
+            self.assertEqual(folders, [game.field.hash()])
+            # A scenario evicts once, after all of its games
+            class Cached(run.Scenario):
+                SETTINGS    = core.Settings(max_steps=5)
+                AGENT_CACHE = tmpdir
+                JOBS        = 2
+            evicted = os.path.join(tmpdir, 'evicted')
+            evict = core.AgentCache.evict
+            core.AgentCache.evict = lambda cache: open(evicted, 'a').write('%d\n' % os.getpid())
+            try:
+                Cached.one_on_one(core.DEFAULT_AGENT_FILE, core.DEFAULT_AGENT_FILE)
+            finally:
+                core.AgentCache.evict = evict
+            self.assertEqual(open(evicted).read(), '%d\n' % os.getpid())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_shared_field(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            field = core.FieldGenerator().generate()
+            path = shared.publish(field, tmpdir)
+            self.assertEqual(shared.publish(field, tmpdir), path)
+            shared_field = shared.SharedField(path)
+            f = shared_field.field()
+            self.assertEqual(f, field)
+            self.assertEqual(f.mesh, field.mesh)
+            self.assertEqual(f.wallrects, field.wallrects)
+            self.assertEqual(f.wallgrid, field.wallgrid)
+            graph = shared_field.navgraph
+            self.assertEqual(graph.astar(0, len(graph) - 1), field.navgraph.astar(0, len(graph) - 1))
+            # Later fields reuse what the first one unpacked
+            self.assertTrue(shared_field.field().mesh is f.mesh)
+            self.assertTrue(shared_field.field().wallgrid is f.wallgrid)
+            goal = field.find(core.Field.CONTROL)[0]
+            self.assertTrue(shared_field.field().flow_field(goal) is f.flow_field(goal))
+            settings = core.Settings(max_steps=20)
+            core.Game(field=f, settings=settings, rendered=False, verbose=False).run()
+            shared.unpublish(path)
+            self.assertFalse(os.path.exists(path))
+            # A scenario on a single field shares it with its workers, and
+            # removes it afterwards.
+            class Shared(run.Scenario):
+                SETTINGS   = core.Settings(max_steps=20)
+                GENERATOR  = None
+                FIELD      = field
+                REPEATS    = 1
+                SWAP_TEAMS = False
+                JOBS       = 2
+            # Agents in the workers can use the grid with the path utilities
+            found = os.path.join(tmpdir, 'found.txt')
+            (x, y) = field.find(core.Field.RED)[0]
+            (gx, gy) = field.find(core.Field.BLUE)[0]
+            agent = os.path.join(tmpdir, 'grid_agent.py')
+            open(agent, 'w').write(RANDOM_AGENT.replace('        pass\n', 
+                "        open(%r, 'a').write('%%s %%s\\n' %% (type(kwargs['field_grid']).__name__, "
+                "grid_path_length((%d, %d), (%d, %d), kwargs['field_grid'])))\n" % (found, x, y, gx, gy), 1))
+            scenario = Shared()
+            scenario._multi([(agent, core.DEFAULT_AGENT_FILE)])
+            self.assertFalse(os.path.exists(scenario._shared_path))
+            self.assertFalse(os.path.exists(scenario._shared_folder))
+            self.assertTrue(scenario.FIELD is field)
+            length = grid_path_length((x, y), (gx, gy), field.wallgrid)
+            self.assertEqual(set(open(found).read().split('\n')[:-1]), set(['list %d' % length]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_corpus(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'fields.corpus')
+            corpus.build_corpus(path, [5, 6, 7], processes=2)
+            fields = corpus.FieldCorpus(path)
+            self.assertEqual(fields.seeds, [5, 6, 7])
+            for i, seed in enumerate(fields.seeds):
+                f = fields.field(i)
+                g = corpus.generate_field(seed)
+                self.assertEqual(f, g)
+                self.assertEqual(f.mesh, g.mesh)
+                self.assertEqual(f.wallrects, g.wallrects)
+            self.assertRaises(IndexError, fields.field, 3)
+            self.assertRaises(IndexError, fields.field, -1)
+            fields.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_rects_decompose(self):
+        for i in xrange(20):
+            field = core.FieldGenerator().generate()
+            field.WALL_MERGE = 'minimal'
+            counts = field.rect_counts
+            self.assertEqual(counts['minimal'], len(field.wallrects))
+            self.assertTrue(counts['minimal'] <= counts['stack'])
+            covered = set()
+            for (x, y, w, h) in field.wallrects:
+                tiles = set((j, i) for j in xrange(x // 16, (x + w) // 16) for i in xrange(y // 16, (y + h) // 16))
+                self.assertFalse(tiles & covered)
+                covered |= tiles
+            self.assertEqual(covered, set(field.find(core.Field.WALL)))
+        settings = core.Settings(max_steps=50)
+        core.Game(field=field, settings=settings, rendered=False, verbose=False).run()
+
+    def test_regions(self):
+        for i in xrange(10):
+            field = core.FieldGenerator().generate()
+            regions = field.regions
+            self.assertTrue(field.regions is regions)
+            # Every open tile is in a region, chokepoints join neighbors
+            for (x, y) in field.find(core.Field.NOT + core.Field.WALL):
+                self.assertTrue(0 <= regions.labels[y][x] < len(regions))
+            for (a, b), points in regions.chokepoints.items():
+                self.assertTrue(b in regions.graph[a] and a in regions.graph[b])
+                for p in points:
+                    self.assertTrue(regions.region(p) in (a, b))
+            # The contents match the markers on the field
+            cps = sum((r['controlpoints'] for r in regions.contents), [])
+            self.assertEqual(sorted(cps), sorted(field.find(core.Field.CONTROL)))
+            for (x, y) in field.find(core.Field.RED):
+                self.assertTrue((x, y) in regions.contents[regions.region(((x + 0.5) * 16, (y + 0.5) * 16))]['red'])
+            # Agents get the same regions from the wall grid
+            again = analysis.Regions.from_grid(field.wallgrid, field.tilesize)
+            self.assertEqual(again.labels, regions.labels)
+            self.assertEqual(again.graph, regions.graph)
+
+    def test_flow_field(self):
+        field = core.FieldGenerator().generate()
+        ts = field.tilesize
+        for (x, y) in field.find(core.Field.CONTROL):
+            goal = ((x + 0.5) * ts, (y + 0.5) * ts)
+            ff = field.flow_field(goal)
+            self.assertTrue(field.flow_field(goal) is ff)
+            reach = reachable(field.wallgrid, (x, y))
+            for (j, i) in field.find(core.Field.NOT + core.Field.WALL):
+                loc = ((j + 0.5) * ts, (i + 0.5) * ts)
+                if reach[i][j]:
+                    self.assertTrue(ff.distance(loc) >= point_dist(loc, goal) - ts)
+                    self.assertNotEqual(ff.next(loc), None)
+                else:
+                    self.assertEqual(ff.distance(loc), inf)
+
+    def test_agent_field_analysis(self):
+        agent = RANDOM_AGENT.replace(
+            """    def __init__(self, *args, **kwargs):
+        pass""", """    def __init__(self, id, team, settings=None, field_rects=None, field_grid=None, nav_mesh=None, 
+                 flow_field=None, field_regions=None):
+        self.flow_field = flow_field
+        self.regions = field_regions""")
+        field = core.FieldGenerator().generate()
+        settings = core.Settings(max_steps=5)
+        game = core.Game(red=agent, blue=core.DEFAULT_AGENT_FILE, field=field, settings=settings,
+                         rendered=False, verbose=False).run()
+        goal = field.find(core.Field.CONTROL)[0]
+        flow_field = game.tanks_red[0].brain.flow_field
+        self.assertTrue(flow_field(goal) is field.flow_field(goal))
+        self.assertTrue(game.tanks_red[0].brain.regions is field.regions)
+        # Agents that don't know the field don't get them
+        settings = core.Settings(max_steps=5, field_known=False)
+        game = core.Game(red=agent, blue=core.DEFAULT_AGENT_FILE, field=field, settings=settings,
+                         rendered=False, verbose=False).run()
+        self.assertEqual(game.tanks_red[0].brain.flow_field, None)
+        self.assertEqual(game.tanks_red[0].brain.regions, None)
+
+    def test_mirrored_field(self):
+        field = core.FieldGenerator().generate()
+        self.assertTrue(field.is_mirrored())
+        ts = field.tilesize
+        rects = [(j*ts, i*ts, ts, ts) for (j, i) in field.find(core.Field.WALL)]
+        self.assertEqual(field.wallrects, rects_merge(rects))
+        mesh = field.mesh
+        for n1 in mesh:
+            for n2 in mesh[n1]:
+                self.assertEqual(mesh[field.mirror(n1)][field.mirror(n2)], mesh[n1][n2])
+        (x, y) = field.find(core.Field.AMMO)[0]
+        goal = ((x + 0.5) * ts, (y + 0.5) * ts)
+        field.flow_field(goal)
+        reflected = field.flow_field(field.mirror(goal))
+        fresh = FlowField(field.mirror(goal), field.wallgrid, ts)
+        self.assertEqual(reflected.dist, fresh.dist)
+        # Where shortest paths tie, the aim can differ from a fresh field,
+        # but it has to be in sight, and on a shortest path to the goal.
+        for n, aim in enumerate(reflected.aim):
+            if aim == fresh.aim[n]:
+                continue
+            i, j = divmod(n, field.width)
+            center = ((j + 0.5) * ts, (i + 0.5) * ts)
+            self.assertFalse(line_intersects_grid(center, aim, field.wallgrid, ts))
+            dx, dy = abs(aim[0] - center[0]), abs(aim[1] - center[1])
+            octile = max(dx, dy) + (2 ** 0.5 - 1) * min(dx, dy)
+            self.assertTrue(fresh.distance(aim) + octile <= fresh.dist[n] + 1e-6)
+        self.assertEqual(field.mirror(goal), mirror_point(goal, field.wallgrid, ts))
+        self.assertTrue(grid_is_mirrored(field.wallgrid))
+        field.set(field.find(core.Field.CLEAR, bounds=(0, 0, field.width // 2, field.height))[0], core.Field.WALL)
+        self.assertFalse(field.is_mirrored())
+
+    def test_grid_planner(self):
+        state = random.getstate()
+        random.seed(27)
+        field = core.FieldGenerator().generate()
+        random.setstate(state)
+        rng = random.Random(27)
+        free = field.find(core.Field.NOT + core.Field.WALL)
+        planner = GridPlanner(field.wallgrid, field.tilesize)
+        start, goal = free[0], free[-1]
+        for i in xrange(50):
+            # Let the start and goal drift around, like a chase.
+            start = rng.choice([p for p in free if point_dist(p, start) < 2])
+            goal = rng.choice([p for p in free if point_dist(p, goal) < 2])
+            path, length = planner.planner.plan(start, goal)
+            fresh = GridPlanner(field.wallgrid, field.tilesize)
+            self.assertAlmostEqual(length, fresh.planner.plan(start, goal)[1])
+        outside = (field.width * field.tilesize + 1, 1)
+        self.assertRaises(ValueError, planner.find_path, (24, 24), outside)
+
+    def test_navgraph(self):
+        field = core.FieldGenerator().generate()
+        free = field.find(core.Field.NOT + core.Field.WALL)
+        ts = field.tilesize
+        def length(start, path):
+            points = [start] + path
+            return sum(point_dist(a, b) for (a, b) in zip(points, points[1:]))
+        for i in xrange(50):
+            (sx, sy), (ex, ey) = random.choice(free), random.choice(free)
+            start, end = ((sx + 0.5) * ts, (sy + 0.5) * ts), ((ex + 0.5) * ts, (ey + 0.5) * ts)
+            path_mesh = find_path(start, end, field.mesh, field.wallgrid, ts)
+            path_csr = find_path(start, end, field.navgraph, field.wallgrid, ts)
+            self.assertAlmostEqual(length(start, path_mesh), length(start, path_csr))
+
+    def test_hierarchical_planner(self):
+        state = random.getstate()
+        random.seed(30)
+        field = core.FieldGenerator().generate()
+        random.setstate(state)
+        rng = random.Random(30)
+        free = field.find(core.Field.NOT + core.Field.WALL)
+        ts = field.tilesize
+        planner = HierarchicalPlanner(field.wallgrid, ts, cluster_size=8)
+        def length(start, path):
+            points = [start] + path
+            return sum(point_dist(a, b) for (a, b) in zip(points, points[1:]))
+        for i in xrange(50):
+            (sx, sy), (ex, ey) = rng.choice(free), rng.choice(free)
+            start, end = ((sx + 0.5) * ts, (sy + 0.5) * ts), ((ex + 0.5) * ts, (ey + 0.5) * ts)
+            path_mesh = find_path(start, end, field.mesh, field.wallgrid, ts)
+            path_hpa = planner.find_path(start, end)
+            self.assertEqual(bool(path_mesh), bool(path_hpa))
+            self.assertTrue(length(start, path_hpa) <= 1.1 * length(start, path_mesh) + ts)
+
+    def test_hierarchical_planner_random_grids(self):
+        # Cluttered grids, where the transitions between clusters are
+        # far apart, compared to the shortest path on the full grid.
+        rng = random.Random(30)
+        w, h, ts = 48, 40, 16
+        for density in (0.1, 0.25, 0.35):
+            grid = [[int(rng.random() < density) for x in xrange(w)] for y in xrange(h)]
+            free = [(x, y) for y in xrange(h) for x in xrange(w) if not grid[y][x]]
+            planner = HierarchicalPlanner(grid, ts, cluster_size=8)
+            for i in xrange(20):
+                s, e = rng.choice(free), rng.choice(free)
+                if s == e:
+                    continue
+                path, cost = planner.find_tile_path(s, e)
+                start, end = ((s[0] + 0.5) * ts, (s[1] + 0.5) * ts), ((e[0] + 0.5) * ts, (e[1] + 0.5) * ts)
+                path_grid = find_grid_path(start, end, grid, ts)
+                self.assertEqual(path is not None, bool(path_grid))
+                if path is not None:
+                    points = [start] + path_grid
+                    shortest = sum(point_dist(a, b) for (a, b) in zip(points, points[1:])) / ts
+                    self.assertTrue(cost <= 1.05 * shortest + 1e-6)
+
+    def test_jump_point_search(self):
+        field = core.FieldGenerator().generate()
+        free = field.find(core.Field.NOT + core.Field.WALL)
+        ts = field.tilesize
+        for i in xrange(50):
+            (sx, sy), (ex, ey) = random.choice(free), random.choice(free)
+            start, end = ((sx + 0.5) * ts, (sy + 0.5) * ts), ((ex + 0.5) * ts, (ey + 0.5) * ts)
+            path = find_grid_path(start, end, field.wallgrid, ts)
+            self.assertEqual(bool(path), bool(find_path(start, end, field.mesh, field.wallgrid, ts)))
+            for (a, b) in zip([start] + path, path):
+                self.assertFalse(line_intersects_grid(a, b, field.wallgrid, ts))
+
+    def test_grid_path_length(self):
+        field = core.FieldGenerator().generate()
+        grid = field.wallgrid
+        free = field.find(core.Field.NOT + core.Field.WALL)
+        goal = random.choice(free)
+        reach = reachable(grid, goal)
+        for start in free:
+            length = grid_path_length(start, goal, grid)
+            self.assertEqual(length, grid_path_search(start, goal, grid))
+            if reach[start[1]][start[0]]:
+                self.assertTrue(length >= abs(start[0] - goal[0]) + abs(start[1] - goal[1]))
+            else:
+                self.assertEqual(length, None)
+
     def test_string_agent(self):
         game = core.Game(red=RANDOM_AGENT, 
                          blue=RANDOM_AGENT, 
@@ -116,6 +560,327 @@ class TestDominationGame(unittest.TestCase):
             replaygame.run()
             self.assertEqual(replaygame.score_red, game.score_red)
             
+    def test_binary_replay(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'game.replay')
+            settings = core.Settings(max_steps=200)
+            game = core.Game(settings=settings, record=True, rendered=False, verbose=False, 
+                             replay_file=path).run()
+            replay = core.load_replay(path)
+            self.assertTrue(isinstance(replay, core.BinaryReplay))
+            self.assertEqual(replay.steps, 200)
+            self.assertEqual(replay.field, game.field)
+            for ours, theirs in zip(replay.actions_red + replay.actions_blue,
+                                    game.replay.actions_red + game.replay.actions_blue):
+                self.assertEqual(list(ours), [(t, s, bool(sh)) for (t, s, sh) in theirs])
+            # The actions are stored exactly as the agents gave them
+            turns = [t for actions in game.replay.actions_red for (t, _, _) in actions]
+            self.assertTrue(any(t != float32(t) for t in turns))
+            replaygame = core.Game(replay=replay, rendered=False, verbose=False).run()
+            self.assertEqual(replaygame.score_red, game.score_red)
+            # Converted replays are the same, and pickles still load
+            data = StringIO()
+            core.ReplayWriter.convert(game.replay, data)
+            self.assertEqual(core.BinaryReplay(data.getvalue()).step(100), replay.step(100))
+            replay.close()
+            pickle.dump(game.replay, open(path, 'wb'), pickle.HIGHEST_PROTOCOL)
+            self.assertTrue(isinstance(core.load_replay(path), core.ReplayData))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_replay_seek(self):
+        settings = core.Settings(max_steps=200)
+        game = core.Game(settings=settings, record=True, rendered=False, verbose=False).run()
+        self.assertEqual(sorted(game.replay.keyframes), [50, 100, 150])
+        data = StringIO()
+        core.ReplayWriter.convert(game.replay, data)
+        for replay in (game.replay, core.BinaryReplay(data.getvalue())):
+            states = {}
+            def remember(g):
+                states.setdefault(g.step, []).append([(t.x, t.y, t.angle, t.ammo) for t in g.tanks])
+            core.Game(replay=replay, rendered=False, verbose=False, step_callback=remember).run()
+            # Seeking restores a keyframe and plays on from there
+            seeking = core.Game(replay=replay, rendered=False, verbose=False, step_callback=remember)
+            seeking.seek(170)
+            self.assertEqual(seeking.step, 170)
+            seeking.run()
+            self.assertEqual(seeking.score_red, game.score_red)
+            for step in xrange(151, 201):
+                self.assertEqual(states[step][0], states[step][1])
+            states.clear()
+
+    def test_verify_replay(self):
+        settings = core.Settings(max_steps=100)
+        game = core.Game(settings=settings, record=True, rendered=False, verbose=False).run()
+        self.assertEqual(len(game.replay.digests), 100)
+        self.assertEqual(core.verify_replay(game.replay), None)
+        data = StringIO()
+        core.ReplayWriter.convert(game.replay, data)
+        good = data.getvalue()
+        self.assertEqual(core.verify_replay(core.BinaryReplay(good)), None)
+        # Change the actions, and the replay differs from that step on
+        for actions in game.replay.actions_red + game.replay.actions_blue:
+            actions[40] = (2.0, 40.0, True)
+        self.assertEqual(core.verify_replay(game.replay), 41)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'replays.zip')
+            zipf = zipfile.ZipFile(path, 'w')
+            zipf.writestr('good.replay', good)
+            zipf.writestr('bad.pickle', pickle.dumps(game.replay, pickle.HIGHEST_PROTOCOL))
+            # Old replays refer to domination.core, and have no digests
+            game.replay.digests = []
+            old = pickle.dumps(game.replay, 0).replace('ccore\n', 'cdomination.core\n')
+            zipf.writestr('old.pickle', old)
+            zipf.close()
+            self.assertEqual(run.verify_replays(path, processes=2), 
+                             {'good.replay': None, 'bad.pickle': 41, 'old.pickle': run.NO_DIGESTS})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_state_trace(self):
+        settings = core.Settings(max_steps=80)
+        positions = []
+        remember = lambda g: positions.append([(t.x, t.y) for t in g.tanks]) if g.step > 1 else None
+        game = core.Game(settings=settings, rendered=False, verbose=False, trace=True, 
+                         step_callback=remember).run()
+        trace = game.trace
+        self.assertEqual(trace.steps, 80)
+        self.assertEqual(trace.shape('x'), (80, len(game.tanks)))
+        self.assertEqual(trace.column('score_red')[-1], game.score_red)
+        # The state after a step is what the next step starts with
+        n = len(game.tanks)
+        for step, before in enumerate(positions):
+            xs = trace.column('x')[step * n:(step + 1) * n]
+            self.assertEqual(list(xs), [float32(x) for (x, _) in before])
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'trace.npz')
+            trace.save(path)
+            loaded = core.StateTrace.load(path)
+            for name in trace.columns:
+                self.assertEqual(loaded.column(name), trace.column(name))
+                self.assertEqual(loaded.shape(name), trace.shape(name))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_analytics(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            settings = core.Settings(max_steps=150)
+            archive = zipfile.ZipFile(os.path.join(tmpdir, 'games_replays.zip'), 'w')
+            for i in xrange(2):
+                game = core.Game(settings=settings, record=True, rendered=False, verbose=False).run()
+                data = StringIO()
+                core.ReplayWriter.convert(game.replay, data)
+                archive.writestr('game%d.replay' % i, data.getvalue())
+            archive.close()
+            pickle.dump(game.replay, open(os.path.join(tmpdir, 'game.pickle'), 'wb'), pickle.HIGHEST_PROTOCOL)
+            self.assertEqual(len(analytics.find_replays([tmpdir])), 3)
+            result = analytics.analyze([tmpdir], count_shots, lambda a, b: a + b, processes=1)
+            self.assertEqual(result['games'], 3)
+            stats = result['agents'][game.replay.red_name]
+            self.assertEqual(stats.games, 6)
+            self.assertEqual(stats.steps, 6 * 150)
+            self.assertTrue(sum(stats.positions.values()) <= 6 * 150 * len(game.tanks) / 2)
+            self.assertTrue(0 <= stats.cp_share <= 1)
+            self.assertEqual(sum(stats.shots.values()), result['value'])
+            # The pool gives the same result
+            pooled = analytics.analyze([tmpdir], count_shots, operator.add, processes=2)
+            self.assertEqual(pooled['value'], result['value'])
+            self.assertEqual(pooled['agents'][game.replay.red_name].deaths, stats.deaths)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parallel_scenario(self):
+        class Parallel(run.Scenario):
+            SETTINGS = core.Settings(max_steps=100, think_time=10.0)
+            REPEATS  = 1
+            SEED     = 42
+        tmpdir = tempfile.mkdtemp()
+        try:
+            outputs = []
+            for jobs in (1, 2):
+                Parallel.JOBS = jobs
+                folder = os.path.join(tmpdir, str(jobs))
+                Parallel().one_on_one(core.DEFAULT_AGENT_FILE, core.DEFAULT_AGENT_FILE, output_folder=folder)
+                output = {}
+                for fn in os.listdir(folder):
+                    kind = fn.split('_', 1)[1]
+                    if kind == 'replays.zip':
+                        replays = zipfile.ZipFile(os.path.join(folder, fn))
+                        output.update((name, replays.read(name)) for name in replays.namelist())
+                    elif kind == 'manifest.jsonl':
+                        # Games are marked as done in the order they finish
+                        output[kind] = sorted(open(os.path.join(folder, fn)).readlines())
+                    elif kind != 'logs.zip':
+                        output[kind] = open(os.path.join(folder, fn)).read()
+                outputs.append(output)
+            # Apart from the think times in the logs, the output is the same
+            self.assertEqual(len(outputs[0]), 5)
+            self.assertEqual(outputs[0], outputs[1])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_result_writer(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            writer = run.ResultWriter(tmpdir)
+            settings = core.Settings(max_steps=50)
+            # Games are written in the order they finish
+            for n, i in enumerate((2, 0, 1)):
+                game = core.Game(settings=settings, record=True, rendered=False, verbose=False).run()
+                writer.add(i, 'red%d.py' % i, 'blue.py', game.stats, game.replay, game.log)
+                # Everything so far is on disk already
+                self.assertEqual(len(zipfile.ZipFile(writer.fn + '_replays.zip').namelist()), n + 1)
+                self.assertEqual(len(open(writer.fn + '_games.csv').readlines()), n + 2)
+            writer.close()
+            rows = list(csv.DictReader(open(writer.fn + '_games.csv')))
+            self.assertEqual([row['red_file'] for row in rows], ['red0.py', 'red1.py', 'red2.py'])
+            self.assertEqual(len(zipfile.ZipFile(writer.fn + '_logs.zip').namelist()), 3)
+            summary = open(writer.fn + '_summary.md').read()
+            self.assertTrue(summary.startswith('In total, 3 games were played.'))
+            self.assertEqual(sum(writer.by_team.values()), 6)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_resume_scenario(self):
+        class Interrupted(Exception):
+            pass
+        class Resumable(run.Scenario):
+            SETTINGS = core.Settings(max_steps=50)
+            REPEATS  = 2
+            SEED     = 7
+            stop_after = None
+            def after_each(self, game):
+                Resumable.played += 1
+                if Resumable.played == self.stop_after:
+                    raise Interrupted()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            agents = (core.DEFAULT_AGENT_FILE, os.path.join(tmpdir, 'other.py'))
+            shutil.copy(core.DEFAULT_AGENT_FILE, agents[1])
+            Resumable.played, Resumable.stop_after = 0, 3
+            folder = os.path.join(tmpdir, 'resumed')
+            self.assertRaises(Interrupted, Resumable.one_on_one, *agents, output_folder=folder)
+            Resumable.played, Resumable.stop_after = 0, None
+            Resumable.one_on_one(*agents, output_folder=folder)
+            # Only the games that were not done are played again
+            self.assertEqual(Resumable.played, 2)
+            Resumable.one_on_one(*agents, output_folder=os.path.join(tmpdir, 'whole'))
+            read = lambda folder, kind: open(glob.glob(os.path.join(tmpdir, folder, '*_' + kind))[0]).read()
+            self.assertEqual(read('resumed', 'games.csv'), read('whole', 'games.csv'))
+            self.assertEqual(read('resumed', 'summary.md'), read('whole', 'summary.md'))
+            replays = zipfile.ZipFile(glob.glob(os.path.join(tmpdir, 'resumed', '*_replays.zip'))[0])
+            self.assertEqual(len(replays.namelist()), 4)
+            # When a worker fails, the pool is stopped before the shared
+            # field is removed, and the run can still be continued.
+            class Failing(run.Scenario):
+                SETTINGS  = core.Settings(max_steps=50)
+                GENERATOR = None
+                FIELD     = core.FieldGenerator().generate()
+                JOBS      = 2
+                fail      = True
+                def after_each(self, game):
+                    if self.fail:
+                        raise ValueError("Failed")
+            folder = os.path.join(tmpdir, 'failed')
+            scenario = Failing()
+            self.assertRaises(ValueError, scenario._multi, [agents], output_folder=folder)
+            self.assertEqual(multiprocessing.active_children(), [])
+            self.assertFalse(os.path.exists(scenario._shared_folder))
+            manifest = glob.glob(os.path.join(folder, '*_manifest.jsonl'))
+            self.assertFalse('finished' in open(manifest[0]).read())
+            Failing.JOBS, Failing.fail = 1, False
+            Failing()._multi([agents], output_folder=folder)
+            self.assertEqual(glob.glob(os.path.join(folder, '*_manifest.jsonl')), manifest)
+            self.assertTrue('finished' in open(manifest[0]).read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_adaptive_scenario(self):
+        class Adaptive(run.Scenario):
+            SETTINGS   = core.Settings(max_steps=200)
+            REPEATS    = 10
+            CONFIDENCE = 0.9
+        tmpdir = tempfile.mkdtemp()
+        try:
+            idle = os.path.join(tmpdir, 'idle.py')
+            open(idle, 'w').write(RANDOM_AGENT.replace('(-pi + rand()*2*pi, 100, True)', '(0, 0, False)'))
+            for jobs in (1, 2):
+                Adaptive.JOBS = jobs
+                folder = os.path.join(tmpdir, str(jobs))
+                Adaptive.one_on_one(core.DEFAULT_AGENT_FILE, idle, output_folder=folder)
+                rows = list(csv.DictReader(open(glob.glob(os.path.join(folder, '*_games.csv'))[0])))
+                # A clear winner after two rounds, instead of ten
+                self.assertEqual(len(rows), 4)
+                self.assertTrue(all(row['red_file'] != idle or float(row['score']) < 0.5 for row in rows))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_ladder(self):
+        class Ladder(run.Scenario):
+            SETTINGS    = core.Settings(max_steps=100)
+            MATCHMAKING = 'uncertainty'
+        tmpdir = tempfile.mkdtemp()
+        try:
+            shutil.copy(core.DEFAULT_AGENT_FILE, os.path.join(tmpdir, 'one.py'))
+            shutil.copy(core.DEFAULT_AGENT_FILE, os.path.join(tmpdir, 'two.py'))
+            open(os.path.join(tmpdir, 'idle.py'), 'w').write(
+                RANDOM_AGENT.replace('(-pi + rand()*2*pi, 100, True)', '(0, 0, False)'))
+            ranking = Ladder.ladder(folder=tmpdir, max_games=6)
+            self.assertEqual(len(ranking), 3)
+            ratings = json.load(open(os.path.join(tmpdir, 'ratings.json')))
+            self.assertEqual(sorted(ratings), ['idle', 'one', 'two'])
+            self.assertTrue(0 < sum(r['games'] for r in ratings.values()) <= 12)
+            self.assertTrue(ratings['idle']['mu'] < ratings['one']['mu'])
+            # The next ladder continues from the stored ratings
+            Ladder.ladder(folder=tmpdir, max_games=1)
+            again = json.load(open(os.path.join(tmpdir, 'ratings.json')))
+            self.assertEqual(sum(r['games'] for r in again.values()),
+                             sum(r['games'] for r in ratings.values()) + 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_ladder_corpus(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            class Ladder(run.Scenario):
+                SETTINGS = core.Settings(max_steps=20)
+                CORPUS   = os.path.join(tmpdir, 'fields.corpus')
+            corpus.build_corpus(Ladder.CORPUS, [1, 2], processes=1)
+            for name in ('one', 'two', 'three'):
+                shutil.copy(core.DEFAULT_AGENT_FILE, os.path.join(tmpdir, name + '.py'))
+            # Agents play more games than there are fields, also when
+            # a ladder continues from where an earlier one stopped.
+            path = os.path.join(tmpdir, 'ratings.json')
+            json.dump({'one': {'games': 5}, 'two': {'games': 2}}, open(path, 'w'))
+            Ladder.ladder(folder=tmpdir, max_games=6)
+            ratings = json.load(open(path))
+            self.assertEqual(sum(r['games'] for r in ratings.values()), 7 + 2 * 6)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_ladder_stops_when_ranked(self):
+        class Ordered(run.Scenario):
+            played = 0
+            def _play(self, (i, red, blue, index, seed), rendered=False):
+                # The agent with the higher number always wins
+                Ordered.played += 1
+                stats = core.GameStats()
+                stats.score = 1.0 if int(red[1:]) > int(blue[1:]) else 0.0
+                return i, (red, blue, stats, '', '', None)
+        agents = ['a%d' % n for n in xrange(10)]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ranking = Ordered.ladder(agents=agents, ratings=os.path.join(tmpdir, 'ratings.json'))
+            self.assertEqual(ranking, agents[::-1])
+            self.assertTrue(Ordered.played < Ordered.LADDER_GAMES * len(agents) // 2)
+            self.assertFalse(Ordered().ranked(ranking, dict((a, [100, 50, 0]) for a in agents)))
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_scenario(self):
         tmpdir = '_tmp'
         if not os.path.exists(tmpdir):
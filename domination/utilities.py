@@ -10,11 +10,16 @@ import math
 import time
 import copy
 from pprint import pprint
+from collections import OrderedDict
 from heapq import heappush, heappop
 from sys import maxint
 
 # Local libs
 from libs import astar
+from libs.dstarlite import DStarLite
+from libs.csrgraph import CSRGraph
+from libs.hpastar import HierarchicalPlanner
+from libs.jps import find_grid_path
 
 
 # Shortcuts
@@ -70,6 +75,50 @@ def stdev(iterable):
     avg = mean(nums)
     return sum((a - avg)**2 for a in nums)/float(max(n-1,1))
 
+def betainc(a, b, x):
+    """ The regularized incomplete beta function, the probability that 
+        a Beta(a, b) distributed value is below x.
+        
+        >>> round(betainc(2, 3, 0.5), 4)
+        0.6875
+    """
+    if x <= 0.0 or x >= 1.0:
+        return 0.0 if x <= 0.0 else 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                     a * math.log(x) + b * math.log(1.0 - x))
+    # The continued fraction converges fast on this side
+    if x > (a + 1.0) / (a + b + 2.0):
+        return 1.0 - betainc(b, a, 1.0 - x)
+    # Modified Lentz's method
+    tiny = 1e-30
+    c, d = 1.0, 1.0 - (a + b) * x / (a + 1.0)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    f = d
+    for m in xrange(1, 200):
+        for num in (m * (b - m) * x / ((a + 2*m - 1) * (a + 2*m)),
+                    -(a + m) * (a + b + m) * x / ((a + 2*m) * (a + 2*m + 1))):
+            d = 1.0 + num * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + num / c
+            c = c if abs(c) > tiny else tiny
+            f *= c * d
+        if abs(c * d - 1.0) < 1e-12:
+            break
+    return front * f / a
+
+def win_probability(wins, losses):
+    """ Returns the probability that a player who won and lost the given
+        number of games (draws count as half of each) is the stronger one,
+        that is, wins more than half of its games. Uses a uniform prior
+        on the win rate.
+        
+        >>> win_probability(4, 0)
+        0.96875
+        >>> win_probability(3, 3)
+        0.5
+    """
+    return 1.0 - betainc(wins + 1.0, losses + 1.0, 0.5)
+
 ### GEOMETRY ###
 
 def point_add(a, b):
@@ -94,6 +143,26 @@ def point_dist(a, b):
     """ Distance between two points. """
     return ((a[0]-b[0]) ** 2 + (a[1]-b[1]) ** 2) ** 0.5
 
+def mirror_point(point, grid, tilesize=16):
+    """ The mirror image of a point (in game units) on the other half
+        of a left/right symmetric field, given its wall grid. This is
+        the same as :meth:`~domination.core.Field.mirror`, for agents
+        that only have the ``field_grid``.
+
+        >>> mirror_point((8, 40), [[0, 0, 1, 1]], 16)
+        (56, 40)
+    """
+    return (len(grid[0]) * tilesize - point[0], point[1])
+
+def grid_is_mirrored(grid):
+    """ Whether the walls of a grid are left/right symmetric, like
+        on the fields made by a FieldGenerator with mirror=True.
+
+        >>> grid_is_mirrored([[1, 0, 0, 1], [0, 1, 1, 0]])
+        True
+    """
+    return all(list(row) == list(row[::-1]) for row in grid)
+
 
 def line_intersects_rect(p0, p1, r):
     """ Check where a line between p1 and p2 intersects
@@ -291,13 +360,20 @@ def rects_bound(rects):
         return (x,y,w,h)
     return reduce(rb, rects)
 
-def rects_merge(rects):
+def rects_merge(rects, mirror_width=None):
     """ Merge a list of rectangle (xywh) tuples.
         Returns a list of rectangles that cover the same 
-        surface. This is not necessarily optimal though.
+        surface. This is not necessarily optimal though,
+        :func:`rects_decompose` finds the fewest rectangles.
+        
+        If the rectangles are left/right symmetric within a width
+        of mirror_width, only the left half is merged, and the right
+        half is found by reflecting it. The result is the same.
         
         >>> rects_merge([(0,0,1,1),(1,0,1,1)])
         [(0, 0, 2, 1)]
+        >>> rects_merge([(0,0,1,1),(1,0,1,1),(3,0,1,1),(4,0,1,1)], mirror_width=5)
+        [(0, 0, 2, 1), (3, 0, 2, 1)]
     """
     def stack(rects, horizontal=False):
         """ Stacks rectangles that connect in either horizontal
@@ -326,8 +402,142 @@ def rects_merge(rects):
         if horizontal:
             newrects = [(x,y,w,h) for (y,x,h,w) in newrects]
         return newrects
-    # Stack twice, once in each direction
-    return stack(stack(rects),horizontal=True)
+    if mirror_width is None:
+        # Stack twice, once in each direction
+        return stack(stack(rects),horizontal=True)
+    half = stack(stack([r for r in rects if 2*r[0] < mirror_width]), horizontal=True)
+    merged = []
+    for (x,y,w,h) in half:
+        if 2*(x + w) >= mirror_width:
+            # Touches the midline, so it continues into its reflection
+            merged.append((x, y, mirror_width - 2*x, h))
+        else:
+            merged.append((x, y, w, h))
+            merged.append((mirror_width - x - w, y, w, h))
+    # Same order as stack() leaves them in
+    merged.sort(key=lambda (x,y,w,h): (y,x,h,w))
+    return merged
+
+def rects_decompose(grid, tilesize=1):
+    """ Splits the walls (1) in the grid into as few rectangles as 
+        possible, returned as (x,y,w,h) tuples in game units. 
+        
+        The edges of the walls meet at concave corners. Each chord 
+        that connects two of these corners, and that doesn't cross
+        another chord, saves a rectangle. So the largest set of chords 
+        that don't cross is found (through a bipartite matching 
+        between the horizontal and vertical chords), and those are cut 
+        first. Then a cut is made from every corner that isn't on 
+        a chord yet, until it meets a wall edge or another cut.
+        
+        >>> rects_decompose([[1,1,1],[1,0,0],[1,1,1]])
+        [(0, 0, 1, 3), (1, 0, 2, 1), (1, 2, 2, 1)]
+        >>> len(rects_decompose([[1,1,0],[1,1,1],[0,1,1]]))
+        3
+    """
+    h, w = len(grid), len(grid[0])
+    wall = lambda x, y: 0 <= x < w and 0 <= y < h and grid[y][x]
+    # Edges are named by the lattice point at their left (or top) end.
+    # Horizontal edge (x,y) lies between tiles (x,y-1) and (x,y),
+    # vertical edge (x,y) lies between tiles (x-1,y) and (x,y).
+    inner_h = lambda x, y: wall(x, y-1) and wall(x, y)
+    inner_v = lambda x, y: wall(x-1, y) and wall(x, y)
+    # Find the concave corners
+    corners = []
+    for y in xrange(h + 1):
+        for x in xrange(w + 1):
+            if wall(x-1, y-1) + wall(x, y-1) + wall(x-1, y) + wall(x, y) == 3:
+                corners.append((x, y))
+    corner_set = set(corners)
+    # Find chords between consecutive corners on the same line
+    hchords, vchords = [], []
+    for y in xrange(h + 1):
+        last = None
+        for x in xrange(w + 1):
+            if (x, y) in corner_set and last is not None:
+                hchords.append((last, x, y))
+            if (x, y) in corner_set and inner_h(x, y):
+                last = x
+            elif not inner_h(x, y):
+                last = None
+    for x in xrange(w + 1):
+        last = None
+        for y in xrange(h + 1):
+            if (x, y) in corner_set and last is not None:
+                vchords.append((last, y, x))
+            if (x, y) in corner_set and inner_v(x, y):
+                last = y
+            elif not inner_v(x, y):
+                last = None
+    # Horizontal and vertical chords conflict if they cross or touch
+    conflicts = [[j for j, (y0, y1, vx) in enumerate(vchords) 
+                  if x0 <= vx <= x1 and y0 <= hy <= y1]
+                 for (x0, x1, hy) in hchords]
+    # Maximum matching with augmenting paths
+    match_v = [None] * len(vchords)
+    def augment(i, seen):
+        for j in conflicts[i]:
+            if j not in seen:
+                seen.add(j)
+                if match_v[j] is None or augment(match_v[j], seen):
+                    match_v[j] = i
+                    return True
+        return False
+    for i in xrange(len(hchords)):
+        augment(i, set())
+    # The largest set of chords without conflicts (Konig's theorem):
+    # follow alternating paths from unmatched horizontal chords.
+    matched_h = set(i for i in match_v if i is not None)
+    reach_h = set(i for i in xrange(len(hchords)) if i not in matched_h)
+    reach_v = set()
+    edge = list(reach_h)
+    while edge:
+        i = edge.pop()
+        for j in conflicts[i]:
+            if j not in reach_v:
+                reach_v.add(j)
+                if match_v[j] is not None and match_v[j] not in reach_h:
+                    reach_h.add(match_v[j])
+                    edge.append(match_v[j])
+    # Make the cuts
+    cut_h, cut_v = set(), set()
+    for i in reach_h:
+        x0, x1, y = hchords[i]
+        cut_h.update((x, y) for x in xrange(x0, x1))
+    for j in xrange(len(vchords)):
+        if j not in reach_v:
+            y0, y1, x = vchords[j]
+            cut_v.update((x, y) for y in xrange(y0, y1))
+    for (x, y) in corners:
+        # The two edges at a corner that are inside the walls
+        ex = x if inner_h(x, y) else x - 1
+        ey = y if inner_v(x, y) else y - 1
+        if (ex, y) in cut_h or (x, ey) in cut_v:
+            continue
+        # Cut straight down or up, until meeting an edge or cut
+        dy = 1 if ey == y else -1
+        while True:
+            cut_v.add((x, ey))
+            y = ey + 1 if dy == 1 else ey
+            ey = y if dy == 1 else y - 1
+            if (not inner_v(x, ey) or (x, ey) in cut_v or 
+                (x - 1, y) in cut_h or (x, y) in cut_h):
+                break
+    # Collect the rectangles
+    rects = []
+    done = set()
+    for y in xrange(h):
+        for x in xrange(w):
+            if grid[y][x] and (x, y) not in done:
+                x1 = x + 1
+                while x1 < w and inner_v(x1, y) and (x1, y) not in cut_v:
+                    x1 += 1
+                y1 = y + 1
+                while y1 < h and inner_h(x, y1) and (x, y1) not in cut_h:
+                    y1 += 1
+                done.update((i, j) for i in xrange(x, x1) for j in xrange(y, y1))
+                rects.append((x * tilesize, y * tilesize, (x1 - x) * tilesize, (y1 - y) * tilesize))
+    return rects
 
 def angle_fix(theta):
     """ Fixes an angle to a value between -pi and pi.
@@ -366,54 +576,163 @@ def reachable(grid, (x, y), border=1):
         edge = newedge
     return reachability
     
-def grid_path_length((x,y),(gx,gy),g):
-    #Path list (current coords, cost, expected cost)
-    p = [((x,y),0,abs(gx-x)+abs(gy-y))]
-    #Nodes visited
-    h = []
-    #Max values of coords
-    m = (len(g[0]),len(g))
-    while (len(p) > 0):
-        #Sort based on best estimate of distance, with slight advantage 
-        #to paths already explored
-        p.sort(key=lambda o:0.99999*o[1]+o[2])
-        #Best current loc
-        (x,y) = p[0][0]
-        l = []
-        #Expand in all 4 directions, add if:
-        #   1. Not of of bounds 2. No wall present 3. Not yet visited
-        n = x-1
-        if n >= 0 and g[y][n] == 0 and (n,y) not in h:
-            l.append(((n,y),abs(gx-n)+abs(gy-y)))
-        n = x+1
-        if n < m[0] and g[y][n] == 0 and (n,y) not in h:
-            l.append(((n,y),abs(gx-n)+abs(gy-y)))
-        n = y-1
-        if n >= 0 and g[n][x] == 0 and (x,n) not in h:
-            l.append(((x,n),abs(gx-x)+abs(gy-n)))
-        n = y+1
-        if n < m[1] and g[n][x] == 0 and (x,n) not in h:
-            l.append(((x,n),abs(gx-x)+abs(gy-n)))
-        
-        #Add all new valid paths to path list and history
-        for i in l:
-            if i[1] == 0:
-                #Goal reached
-                return p[0][1]+1
-            h.append(i[0])
-            p.append((i[0],p[0][1]+1,i[1]))
-        #Remove old path
-        del p[0]
+def grid_path_length(start, goal, grid):
+    """ Length of the shortest 4-connected path from start to goal
+        over the given grid, in tiles. Returns None if there is no path.
+        Distance maps are cached per grid and goal, so that repeated
+        queries for the same goal are just lookups. The grid should
+        not be changed after it was first passed in.
+
+        >>> grid_path_length((0,0),(2,0),[[0,1,0],[0,0,0]])
+        4
+        >>> grid_path_length((0,0),(2,0),[[0,1,0],[1,0,0]]) is None
+        True
+    """
+    return grid_distances(grid).path_length(start, goal)
+
+def grid_path_search((x,y), (gx,gy), grid):
+    """ One-off version of :func:`grid_path_length` that doesn't
+        compute or cache a distance map. It is an A* search where 
+        the open list is kept in buckets by estimated length, 
+        because all steps cost the same.
+
+        >>> grid_path_search((0,0),(2,0),[[0,1,0],[0,0,0]])
+        4
+    """
+    w, h = len(grid[0]), len(grid)
+    if not (0 <= gx < w and 0 <= gy < h) or grid[gy][gx]:
+        return None
+    if (x, y) == (gx, gy):
+        return 0
+    # Each step changes the manhattan estimate by one, so f = g + h only
+    # ever stays equal or goes up by two. buckets[f] holds the open tiles.
+    f0 = abs(gx-x) + abs(gy-y)
+    buckets = {f0: [(x, y)]}
+    cost = {(x, y): 0}
+    f = f0
+    while buckets:
+        bucket = buckets.pop(f, None)
+        if not bucket:
+            f += 1
+            continue
+        while bucket:
+            (x, y) = bucket.pop()
+            c = cost[(x, y)] + 1
+            for (nx, ny) in ((x-1,y), (x+1,y), (x,y-1), (x,y+1)):
+                if 0 <= nx < w and 0 <= ny < h and not grid[ny][nx] and c < cost.get((nx, ny), c+1):
+                    if nx == gx and ny == gy:
+                        return c
+                    cost[(nx, ny)] = c
+                    nf = c + abs(gx-nx) + abs(gy-ny)
+                    if nf == f:
+                        bucket.append((nx, ny))
+                    else:
+                        buckets.setdefault(nf, []).append((nx, ny))
+        f += 1
     return None
 
+class GridDistances(object):
+    """ Computes breadth-first distance maps on a grid from goal tiles,
+        and keeps the most recently used ones around. Use 
+        :func:`grid_distances` to get the shared instance for a grid.
+        On left/right symmetric grids, the map for a goal is made by
+        reflecting the one for its mirror image, if that is known.
+    """
+    def __init__(self, grid, size=64):
+        """ :param grid: The wall grid, 1 for walls.
+            :param size: The maximum number of distance maps to keep.
+        """
+        self.grid  = grid
+        self.size  = size
+        self.w     = len(grid[0])
+        self.h     = len(grid)
+        self.maps  = OrderedDict()
+        self.mirrored = all(list(row) == list(row)[::-1] for row in grid)
+    
+    def distance_map(self, (gx, gy)):
+        """ Returns a flat list with the distance of each tile (index
+            y*width + x) to the goal, or -1 where it can't be reached.
+        """
+        key = (gx, gy)
+        if key in self.maps:
+            dist = self.maps.pop(key)
+        elif self.mirrored and (self.w-1-gx, gy) in self.maps:
+            # Reflect the distance map of the mirrored goal
+            other, w = self.maps[(self.w-1-gx, gy)], self.w
+            dist = [d for i in xrange(self.h) for d in reversed(other[i*w:(i+1)*w])]
+            if len(self.maps) >= self.size:
+                self.maps.popitem(last=False)
+        else:
+            grid, w, h = self.grid, self.w, self.h
+            dist = [-1] * (w * h)
+            if 0 <= gx < w and 0 <= gy < h and not grid[gy][gx]:
+                dist[gy*w + gx] = 0
+                edge = [(gx, gy)]
+                d = 0
+                while edge:
+                    d += 1
+                    newedge = []
+                    for (x, y) in edge:
+                        for (nx, ny) in ((x-1,y), (x+1,y), (x,y-1), (x,y+1)):
+                            if (0 <= nx < w and 0 <= ny < h and not grid[ny][nx] 
+                                and dist[ny*w + nx] == -1):
+                                dist[ny*w + nx] = d
+                                newedge.append((nx, ny))
+                    edge = newedge
+            if len(self.maps) >= self.size:
+                self.maps.popitem(last=False)
+        self.maps[key] = dist
+        return dist
+    
+    def path_length(self, (x, y), goal, cache=True):
+        """ Length of the shortest path from (x,y) to goal, or None. 
+            If cache is False and there is no distance map for the goal
+            yet, a one-off search is done instead of computing one.
+        """
+        if not cache and tuple(goal) not in self.maps:
+            return grid_path_search((x, y), goal, self.grid)
+        dist, w = self.distance_map(goal), self.w
+        if (x, y) == tuple(goal):
+            return 0 if dist[y*w + x] == 0 else None
+        # Agents standing on a wall tile can still step off it.
+        best = None
+        for (nx, ny) in ((x-1,y), (x+1,y), (x,y-1), (x,y+1)):
+            if 0 <= nx < w and 0 <= ny < self.h and dist[ny*w + nx] != -1:
+                if best is None or dist[ny*w + nx] < best:
+                    best = dist[ny*w + nx]
+        return None if best is None else best + 1
+
+_grid_distances = OrderedDict()
+
+def grid_distances(grid, max_grids=8):
+    """ Returns the :class:`GridDistances` for the given grid, shared
+        by everyone that passes in the same grid object.
+    """
+    entry = _grid_distances.pop(id(grid), None)
+    # Make sure the id wasn't reused for a different grid
+    if entry is None or entry.grid is not grid:
+        entry = GridDistances(grid)
+        if len(_grid_distances) >= max_grids:
+            _grid_distances.popitem(last=False)
+    _grid_distances[id(grid)] = entry
+    return entry
 
-def make_nav_mesh(walls, bounds=None, offset=7, simplify=0.001, add_points=[]):
+
+def make_nav_mesh(walls, bounds=None, offset=7, simplify=0.001, add_points=[], mirror_width=None):
     """ Generate an almost optimal navigation mesh
         between the given walls (rectangles), within
         the world bounds (a big rectangle).
         Mesh is a dictionary of dictionaries:
             mesh[point1][point2] = distance
+        
+        If the walls are left/right symmetric within a width of 
+        mirror_width, the connections are only computed for the left
+        half, and the mesh is kept symmetric while simplifying.
     """
+    if mirror_width is None:
+        mirror = lambda p: None
+    else:
+        mirror = lambda (x, y): (mirror_width - x, y)
     # If bounds not given, assume outer walls are bounds.
     if bounds is None:
         bounds = rects_bound(walls)
@@ -430,11 +749,17 @@ def make_nav_mesh(walls, bounds=None, offset=7, simplify=0.001, add_points=[]):
     # 3) Connect nodes that can "see" eachother
     walls = [rect_offset(w,-0.001) for w in walls]
     mesh = dict((n,{}) for n in nodes)
+    reflect = []
     for n1 in nodes:
+        if mirror_width is not None and 2*n1[0] > mirror_width and mirror(n1) in nodes:
+            reflect.append(n1)
+            continue
         for n2 in nodes:
             if n1 != n2:
                 if not any(line_intersects_rect(n1,n2,w) for w in walls):
                     mesh[n1][n2] = point_dist(n1,n2)
+    for n1 in reflect:
+        mesh[n1] = dict((mirror(n2), d) for (n2, d) in mesh[mirror(n1)].iteritems() if mirror(n2) in nodes)
     # 4) Remove direct connections that are not much shorter than indirect ones
     def astar_path_length(m, start, end):
         """ Length of a path from start to end """
@@ -449,28 +774,46 @@ def make_nav_mesh(walls, bounds=None, offset=7, simplify=0.001, add_points=[]):
         for n2 in mesh[n1]:
             connections.append((mesh[n1][n2],(n1,n2)))
     connections.sort(reverse=True) # Start with the longest connections
+    done = set()
     for length, (n1, n2) in connections:
+        if (n1, n2) in done:
+            continue
+        # Remove the reflected connection along with this one
+        m1, m2 = mirror(n1), mirror(n2)
+        if m1 in mesh and m2 in mesh[m1] and (m1, m2) != (n1, n2):
+            done.add((m1, m2))
+            mesh[m1].pop(m2)
+        else:
+            m1 = None
         mesh[n1].pop(n2) # Remove connection to see best path without it
         alternative_dist = astar_path_length(mesh, n1,n2)
         # Put the connection back if the alternative is much worse
         if alternative_dist > (1+simplify) * length:
             mesh[n1][n2] = length
+            if m1 is not None:
+                mesh[m1][m2] = length
         
     return mesh
 
 
 def find_path(start, end, mesh, grid, tilesize=16):
     """ Uses astar to find a path from start to end,
-        using the given mesh and tile grid.
+        using the given mesh and tile grid. The mesh can also
+        be a :class:`~domination.libs.csrgraph.CSRGraph`, which
+        is a lot faster if you convert the mesh only once.
         
         >>> grid = [[0,0,0,0,0],[0,0,0,0,0],[0,0,1,0,0],[0,0,0,0,0],[0,0,0,0,0]]
         >>> mesh = make_nav_mesh([(2,2,1,1)],(0,0,4,4),1)
         >>> find_path((0,0),(4,4),mesh,grid,1)
         [(4, 1), (4, 4)]
+        >>> find_path((0,0),(4,4),CSRGraph.from_mesh(mesh),grid,1)
+        [(1, 4), (4, 4)]
     """
     # If there is a straight line, just return the end point
     if not line_intersects_grid(start, end, grid, tilesize):
         return [end]
+    if isinstance(mesh, CSRGraph):
+        return _find_path_csr(start, end, mesh, grid, tilesize)
     # Copy mesh so we can add temp nodes
     mesh = copy.deepcopy(mesh)
     # Add temp notes for start
@@ -488,6 +831,239 @@ def find_path(start, end, mesh, grid, tilesize=16):
     nodes, length = astar(start, neighbours, goal, 0, cost, heuristic)
     return nodes
 
+def _find_path_csr(start, end, graph, grid, tilesize):
+    """ Like find_path, but over a CSRGraph. The start and end are
+        connected to the nodes they can see, without copying the graph.
+    """
+    # The line check is not quite symmetric, find_path would connect the
+    # end to the start if it can see it.
+    if not line_intersects_grid(end, start, grid, tilesize):
+        return [end]
+    sources, targets = [], {}
+    for n, p in enumerate(graph.positions):
+        if p == end:
+            targets[n] = 0.0
+        elif not line_intersects_grid(end, p, grid, tilesize):
+            targets[n] = point_dist(end, p)
+        if not line_intersects_grid(start, p, grid, tilesize):
+            sources.append((n, point_dist(start, p)))
+    nodes, length = graph.shortest_path(sources, targets, end)
+    path = [graph.positions[n] for n in nodes]
+    if length < inf and (not path or path[-1] != end):
+        path.append(end)
+    return path
+
+class FlowField(object):
+    """ A distance and steering field towards one or more goals.
+        The field is computed once with a multi-source Dijkstra
+        from the goal tiles over the wall grid (8-connected, but
+        without cutting wall corners), after which the distance
+        to the goal and the direction to drive in can be looked
+        up for any point on the map in constant time.
+
+        >>> grid = [[0,0,0,0],[0,1,1,0],[0,0,0,0]]
+        >>> ff = FlowField((56, 40), grid, 16)
+        >>> ff.distance((8, 8))
+        80.0
+        >>> ff.next((8, 40))
+        (56, 40)
+    """
+    DIAGONAL = 2 ** 0.5
+
+    def __init__(self, goals, grid, tilesize=16, lookahead=4):
+        """ Constructor for FlowField class.
+
+            :param goals:     A goal point (x,y) or a list of goal points,
+                              in game units.
+            :param grid:      The wall grid of the field.
+            :param tilesize:  Size of each tile in game units.
+            :param lookahead: How many tiles ahead along the flow the
+                              steering waypoint may be, if it can be seen.
+        """
+        if goals and not hasattr(goals[0], '__len__'):
+            goals = [goals]
+        self.goals    = [tuple(g) for g in goals]
+        self.tilesize = tilesize
+        self.width    = w = len(grid[0])
+        self.height   = h = len(grid)
+        self.dist     = dist = [inf] * (w * h)  #: Path length to goal per tile
+        self.step     = step = [-1] * (w * h)   #: Index of next tile per tile
+        self.aim      = [None] * (w * h)        #: Steering waypoint per tile
+        # Multi-source Dijkstra from the tiles containing the goals
+        heap = []
+        sources = set()
+        for (gx, gy) in self.goals:
+            j, i = int(gx // tilesize), int(gy // tilesize)
+            if 0 <= i < h and 0 <= j < w and not grid[i][j]:
+                dist[i*w + j] = 0.0
+                self.aim[i*w + j] = (gx, gy)
+                sources.add(i*w + j)
+                heap.append((0.0, i*w + j))
+        diag = self.DIAGONAL
+        while heap:
+            d, n = heappop(heap)
+            if d > dist[n]:
+                continue
+            i, j = divmod(n, w)
+            for di, dj in ((0,1),(0,-1),(1,0),(-1,0),(1,1),(1,-1),(-1,1),(-1,-1)):
+                ni, nj = i + di, j + dj
+                if not (0 <= ni < h and 0 <= nj < w) or grid[ni][nj]:
+                    continue
+                if di and dj:
+                    # Don't cut corners, tanks would get stuck on the wall.
+                    if grid[i][nj] or grid[ni][j]:
+                        continue
+                    nd = d + diag
+                else:
+                    nd = d + 1
+                m = ni*w + nj
+                if nd < dist[m]:
+                    dist[m] = nd
+                    step[m] = n
+                    heappush(heap, (nd, m))
+        # Convert distances to game units and pick a waypoint for each tile
+        for n in xrange(w * h):
+            if dist[n] == inf:
+                continue
+            dist[n] *= tilesize
+            if n in sources:
+                continue
+            i, j = divmod(n, w)
+            center = ((j + 0.5) * tilesize, (i + 0.5) * tilesize)
+            aim, nxt = step[n], step[n]
+            for _ in xrange(lookahead - 1):
+                if step[nxt] == -1:
+                    break
+                ni, nj = divmod(step[nxt], w)
+                if line_intersects_grid(center, ((nj + 0.5) * tilesize, (ni + 0.5) * tilesize), grid, tilesize):
+                    break
+                aim = nxt = step[nxt]
+            if aim in sources:
+                self.aim[n] = self.aim[aim]
+            else:
+                ai, aj = divmod(aim, w)
+                self.aim[n] = (int((aj + 0.5) * tilesize), int((ai + 0.5) * tilesize))
+
+    def mirrored(self):
+        """ Returns the flow field towards the mirror images of the goals,
+            for a grid that is left/right symmetric. It is made by 
+            reflecting this one, without searching again.
+        """
+        w, h, ts = self.width, self.height, self.tilesize
+        flip = lambda n: n + w - 1 - 2 * (n % w)  # Same tile in the mirrored column
+        other = FlowField.__new__(FlowField)
+        other.goals    = [(w * ts - x, y) for (x, y) in self.goals]
+        other.tilesize = ts
+        other.width    = w
+        other.height   = h
+        other.dist     = [self.dist[flip(n)] for n in xrange(w * h)]
+        other.step     = [(-1 if self.step[flip(n)] == -1 else flip(self.step[flip(n)])) 
+                          for n in xrange(w * h)]
+        other.aim      = [(None if a is None else (w * ts - a[0], a[1]))
+                          for a in (self.aim[flip(n)] for n in xrange(w * h))]
+        return other
+
+    def _index(self, (x, y)):
+        j, i = int(x // self.tilesize), int(y // self.tilesize)
+        if 0 <= i < self.height and 0 <= j < self.width:
+            return i * self.width + j
+        return None
+
+    def distance(self, point):
+        """ Path length (in game units) from given point to the closest goal,
+            or inf if the goal cannot be reached from there.
+        """
+        n = self._index(point)
+        return inf if n is None else self.dist[n]
+
+    def next(self, point):
+        """ Returns the waypoint to drive to from the given point,
+            or None if the goal cannot be reached.
+        """
+        n = self._index(point)
+        return None if n is None else self.aim[n]
+
+    def steer(self, loc, angle):
+        """ Returns a (turn, speed) tuple that drives an agent at loc,
+            facing in the given angle, along the field towards the goal.
+        """
+        aim = self.next(loc)
+        if aim is None:
+            return (0, 0)
+        dx = aim[0] - loc[0]
+        dy = aim[1] - loc[1]
+        return (angle_fix(math.atan2(dy, dx) - angle), (dx**2 + dy**2)**0.5)
+
+class GridPlanner(object):
+    """ Plans paths over the wall grid with D* Lite, keeping the search
+        state between calls. Each agent should own its own planner, so
+        that when it chases a moving target, only the part of the search
+        that changed is repaired instead of starting over.
+
+        >>> grid = [[0,0,0,0,0],[0,0,1,0,0],[0,0,1,0,0],[0,0,0,0,0]]
+        >>> planner = GridPlanner(grid, 1)
+        >>> planner.find_path((0.5,1.5),(4.5,1.5))
+        [(2.5, 0.5), (3.5, 0.5), (4.5, 1.5)]
+    """
+    DIAGONAL = 2 ** 0.5
+
+    def __init__(self, grid, tilesize=16, limit=2000):
+        """ Constructor for GridPlanner class.
+
+            :param grid:      The wall grid of the field.
+            :param tilesize:  Size of each tile in game units.
+            :param limit:     Default maximum number of tiles to expand per
+                              call, so that planning fits in the think time.
+        """
+        self.grid     = grid
+        self.tilesize = tilesize
+        self.limit    = limit
+        w, h = len(grid[0]), len(grid)
+        diag = self.DIAGONAL
+        def neighbors((j, i)):
+            for di, dj in ((0,1),(0,-1),(1,0),(-1,0),(1,1),(1,-1),(-1,1),(-1,-1)):
+                ni, nj = i + di, j + dj
+                if 0 <= ni < h and 0 <= nj < w and not grid[ni][nj]:
+                    if di and dj and (grid[i][nj] or grid[ni][j]):
+                        continue
+                    yield (nj, ni)
+        def cost(a, b):
+            return diag if (a[0] != b[0] and a[1] != b[1]) else 1
+        def heuristic(a, b):
+            dx, dy = abs(a[0] - b[0]), abs(a[1] - b[1])
+            return (dx + dy) + (diag - 2) * min(dx, dy)
+        self.planner = DStarLite(neighbors, cost, heuristic)
+
+    def find_path(self, start, end, limit=None):
+        """ Returns a list of waypoints from start to end, in game units,
+            like :func:`find_path` does. If the search could not be finished
+            within the limit, the best waypoints found so far are returned.
+            Raises a ValueError if start or end is outside the field.
+
+            >>> GridPlanner([[0,0],[0,0]], 1).find_path((0.5,0.5),(2.5,0.5))
+            Traceback (most recent call last):
+            ...
+            ValueError: End point (2.5, 0.5) is outside the field.
+        """
+        grid, ts = self.grid, self.tilesize
+        s = (int(start[0] // ts), int(start[1] // ts))
+        e = (int(end[0] // ts), int(end[1] // ts))
+        for name, point, (j, i) in (('Start', start, s), ('End', end, e)):
+            if not (0 <= i < len(grid) and 0 <= j < len(grid[0])):
+                raise ValueError("%s point %r is outside the field." % (name, point))
+        if not line_intersects_grid(start, end, grid, ts):
+            return [end]
+        if grid[e[1]][e[0]]:
+            return []
+        tiles, length = self.planner.plan(s, e, self.limit if limit is None else limit)
+        path = [((j + 0.5) * ts, (i + 0.5) * ts) for (j, i) in tiles]
+        if tiles and tiles[-1] == e:
+            path[-1] = end
+        # Skip waypoints that can be driven past in a straight line
+        while len(path) > 1 and not line_intersects_grid(start, path[1], grid, ts):
+            path.pop(0)
+        return path
+
 ### TIMING ###
 tictocs = {}
 